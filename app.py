@@ -17,23 +17,16 @@ import numpy as np
 import os
 import torch
 
-from video_depth_anything.video_depth import VideoDepthAnything
+from video_depth_anything.loader import load_model
 from utils.dc_utils import read_video_frames, save_video
 
 examples = [
     ['assets/example_videos/davis_rollercoaster.mp4', -1, -1, 1280],
 ]
 
-model_configs = {
-    'vits': {'encoder': 'vits', 'features': 64, 'out_channels': [48, 96, 192, 384]},
-    'vitl': {'encoder': 'vitl', 'features': 256, 'out_channels': [256, 512, 1024, 1024]},
-}
-
 encoder='vitl'
 
-video_depth_anything = VideoDepthAnything(**model_configs[encoder])
-video_depth_anything.load_state_dict(torch.load(f'./checkpoints/video_depth_anything_{encoder}.pth', map_location='cpu'), strict=True)
-video_depth_anything = video_depth_anything.to('cuda').eval()
+video_depth_anything = load_model(encoder, device='cuda')
 
 
 def infer_video_depth(
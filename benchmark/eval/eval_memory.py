@@ -0,0 +1,33 @@
+import argparse
+
+import torch
+
+from video_depth_anything.loader import load_model
+from video_depth_anything.util.memory import StagePeakMemory, estimate_window_memory
+from video_depth_anything.util.precision import autocast, resolve_precision
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Peak memory of every stage of one window')
+    parser.add_argument('--encoder', type=str, default='vitl', choices=['vits', 'vitb', 'vitl'])
+    parser.add_argument('--input_size', type=int, nargs=2, default=[518, 518], metavar=('HEIGHT', 'WIDTH'))
+    parser.add_argument('--num_frames', type=int, default=32)
+    parser.add_argument('--precision', type=str, default=None, choices=['fp32', 'bf16', 'fp16'])
+    parser.add_argument('--memory_budget', type=float, default=-1, help='micro-batching budget in GiB, -1 means no budget')
+    parser.add_argument('--optimize', action='store_true')
+
+    args = parser.parse_args()
+
+    DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
+    precision = resolve_precision(DEVICE, args.precision)
+    model = load_model(args.encoder, device=DEVICE, optimize=args.optimize)
+    model.memory_budget = args.memory_budget * 2**30 if args.memory_budget > 0 else None
+
+    height, width = args.input_size
+    x = torch.randn(1, args.num_frames, 3, height, width, device=DEVICE)
+    with torch.no_grad(), autocast(DEVICE, precision), StagePeakMemory(model, DEVICE) as memory:
+        model(x)
+
+    print(f"{args.encoder}, {args.num_frames} frames of {height}x{width}, {precision}, weights excluded")
+    print(memory.report())
+    print(f"estimate without micro-batching: {estimate_window_memory(model, height, width, precision, args.num_frames) / 2**20:.1f} MiB with weights")
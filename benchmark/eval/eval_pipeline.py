@@ -0,0 +1,49 @@
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from video_depth_anything.loader import load_model
+from video_depth_anything.pipeline import StagePipeline, default_stage_cores, parse_cpu_list
+from video_depth_anything.util.precision import resolve_precision
+
+
+def frames_per_second(model, frames, args, device):
+    start = time.perf_counter()
+    if args.streaming:
+        model.reset_session()
+        for _ in model.infer_video_depth_frames(frames, input_size=args.input_size, device=device, precision=args.precision):
+            pass
+    else:
+        model.infer_video_depth(frames, 30, input_size=args.input_size, device=device, precision=args.precision)
+    return len(frames) / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sustained fps with the encoder and head run one after the other and as pipelined stages')
+    parser.add_argument('--encoder', type=str, default='vitl', choices=['vits', 'vitb', 'vitl'])
+    parser.add_argument('--input_size', type=int, default=518)
+    parser.add_argument('--frame_size', type=int, nargs=2, default=[540, 960], metavar=('HEIGHT', 'WIDTH'))
+    parser.add_argument('--num_frames', type=int, default=120)
+    parser.add_argument('--precision', type=str, default=None, choices=['fp32', 'bf16', 'fp16'])
+    parser.add_argument('--streaming', action='store_true', help='run the streaming model frame by frame instead of the offline model')
+    parser.add_argument('--pipeline_cores', type=str, nargs=2, default=None, metavar=('ENCODER', 'HEAD'))
+
+    args = parser.parse_args()
+
+    DEVICE = 'cpu'
+    args.precision = resolve_precision(DEVICE, args.precision)
+    model = load_model(args.encoder, streaming=args.streaming, device=DEVICE)
+    frames = np.random.default_rng(0).integers(0, 256, (args.num_frames, *args.frame_size, 3), dtype=np.uint8)
+
+    sequential = frames_per_second(model, frames, args, DEVICE)
+    encoder_cores, head_cores = map(parse_cpu_list, args.pipeline_cores) if args.pipeline_cores else default_stage_cores()
+    model.pipeline = StagePipeline(encoder_cores, head_cores)
+    pipelined = frames_per_second(model, frames, args, DEVICE)
+    model.pipeline.shutdown()
+
+    print(f"{args.encoder}, {'streaming' if args.streaming else 'offline'}, {args.num_frames} frames at input size {args.input_size}, {args.precision}, "
+          f"{torch.get_num_threads()} threads")
+    print(f"sequential: {sequential:.2f} fps")
+    print(f"pipelined (encoder on {len(encoder_cores)} cores, head on {len(head_cores)}): {pipelined:.2f} fps, {pipelined / sequential:.2f}x")
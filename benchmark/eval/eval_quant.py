@@ -0,0 +1,70 @@
+import argparse
+import os
+import time
+
+import cv2
+import numpy as np
+import torch
+
+from metric import abs_relative_difference, delta1_acc
+from video_depth_anything.loader import load_model
+from utils.dc_utils import read_video_frames
+
+
+def flow_tae(depths, frames):
+    """Temporal alignment error without camera poses.
+
+    Like TAE, every depth map is warped onto its neighbour and compared with it, in both
+    directions, but the correspondences come from optical flow of the RGB frames instead of
+    the ground truth poses and intrinsics.
+    """
+    gray = [cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY) for frame in frames]
+    h, w = depths.shape[-2:]
+    grid = np.stack(np.meshgrid(np.arange(w), np.arange(h)), axis=-1).astype(np.float32)
+    errors = []
+    for i in range(len(depths) - 1):
+        for src, dst in ((i, i + 1), (i + 1, i)):
+            # flow from dst to src, so that src can be sampled on the grid of dst
+            flow = cv2.calcOpticalFlowFarneback(gray[dst], gray[src], None, 0.5, 3, 15, 3, 5, 1.2, 0)
+            coords = grid + flow
+            warped = cv2.remap(depths[src], coords[..., 0], coords[..., 1], cv2.INTER_LINEAR)
+            valid = (coords[..., 0] >= 0) & (coords[..., 0] <= w - 1) & (coords[..., 1] >= 0) & (coords[..., 1] <= h - 1) & (depths[dst] > 1e-3)
+            errors.append(np.abs(warped[valid] - depths[dst][valid]).mean() / depths[dst][valid].mean())
+    return float(np.mean(errors))
+
+
+def infer(model, frames, args):
+    start = time.perf_counter()
+    depths, _ = model.infer_video_depth(frames, 30, input_size=args.input_size, device='cpu', fp32=True)
+    return depths, (time.perf_counter() - start) / len(frames)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Accuracy and speed of the quantized model against fp32 on CPU')
+    parser.add_argument('--videos', type=str, nargs='+', default=['./assets/example_videos/davis_rollercoaster.mp4', './assets/example_videos/Tokyo-Walk_rgb.mp4'])
+    parser.add_argument('--input_size', type=int, default=518)
+    parser.add_argument('--max_res', type=int, default=1280)
+    parser.add_argument('--max_len', type=int, default=64, help='maximum length of each video, -1 means no limit')
+    parser.add_argument('--encoder', type=str, default='vitl', choices=['vits', 'vitb', 'vitl'])
+    parser.add_argument('--metric', action='store_true', help='use metric model')
+    parser.add_argument('--quantize', type=str, default='int8-dynamic', choices=['int8-dynamic'])
+
+    args = parser.parse_args()
+
+    reference = load_model(args.encoder, metric=args.metric, device='cpu')
+    quantized = load_model(args.encoder, metric=args.metric, device='cpu', quantize=args.quantize)
+
+    for video in args.videos:
+        frames, _ = read_video_frames(video, args.max_len, -1, args.max_res)
+        ref_depths, ref_time = infer(reference, frames, args)
+        q_depths, q_time = infer(quantized, frames, args)
+
+        ref_tensor = torch.from_numpy(ref_depths)
+        q_tensor = torch.from_numpy(q_depths)
+        valid_mask = ref_tensor > 1e-3
+
+        print(f"{os.path.basename(video)} ({len(frames)} frames)")
+        print(f"  time per frame fp32/{args.quantize}: {ref_time * 1000:.1f}/{q_time * 1000:.1f}ms, speedup {ref_time / q_time:.2f}x")
+        print(f"  abs_rel vs fp32: {abs_relative_difference(q_tensor, ref_tensor, valid_mask).item():.5f}")
+        print(f"  delta1 vs fp32: {delta1_acc(q_tensor, ref_tensor, valid_mask).item():.5f}")
+        print(f"  flow TAE fp32/{args.quantize}: {flow_tae(ref_depths, frames):.5f}/{flow_tae(q_depths, frames):.5f}")
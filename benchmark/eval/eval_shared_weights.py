@@ -0,0 +1,60 @@
+import argparse
+import multiprocessing
+
+import torch
+
+from video_depth_anything.loader import load_model
+from video_depth_anything.util.memory import process_memory, weight_memory
+from video_depth_anything.util.precision import autocast, resolve_precision
+from video_depth_anything.workers import fork_workers
+
+
+def infer(rank, model, args, results, measured):
+    if model is None:
+        model = load_model(args.encoder, device='cpu', optimize=args.optimize, quantize=args.quantize)
+    height, width = args.input_size
+    x = torch.randn(1, args.num_frames, 3, height, width)
+    with torch.no_grad(), autocast('cpu', args.precision):
+        model(x)
+    results.put((rank, process_memory()))
+    # stay alive until the parent is measured, the pages the workers share count in all of them
+    measured.wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Memory of forked workers with weights loaded once in shared memory, or loaded by every worker')
+    parser.add_argument('--encoder', type=str, default='vitl', choices=['vits', 'vitb', 'vitl'])
+    parser.add_argument('--input_size', type=int, nargs=2, default=[252, 252], metavar=('HEIGHT', 'WIDTH'))
+    parser.add_argument('--num_frames', type=int, default=8)
+    parser.add_argument('--precision', type=str, default=None, choices=['fp32', 'bf16', 'fp16'])
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--optimize', action='store_true')
+    parser.add_argument('--quantize', type=str, default=None, choices=['int8-dynamic'])
+    parser.add_argument('--per_worker_load', action='store_true', help='every worker loads its own model instead of sharing one loaded by the parent')
+
+    args = parser.parse_args()
+
+    if args.quantize is not None:
+        args.precision = 'fp32'
+    args.precision = resolve_precision('cpu', args.precision)
+    model = None
+    if not args.per_worker_load:
+        model = load_model(args.encoder, device='cpu', optimize=args.optimize, quantize=args.quantize, share_memory=True)
+        print(f"weights: {weight_memory(model) / 2**20:.1f} MiB in shared memory")
+
+    context = multiprocessing.get_context('fork')
+    results, measured = context.Queue(), context.Event()
+    workers = fork_workers(args.workers, infer, args=(model, args, results, measured))
+    memory = dict(results.get() for _ in workers)
+    parent = process_memory()
+    measured.set()
+    for worker in workers:
+        worker.join()
+
+    mode = 'weights loaded by every worker' if args.per_worker_load else 'shared weights'
+    print(f"{args.encoder}, {args.workers} workers, {args.num_frames} frames of {args.input_size[0]}x{args.input_size[1]}, {args.precision}"
+          f"{', optimized' if args.optimize else ''}{', ' + args.quantize if args.quantize else ''}, {mode}")
+    for rank, usage in sorted(memory.items()):
+        print(f"worker {rank}: rss {usage['rss'] / 2**20:.1f} MiB, pss {usage['pss'] / 2**20:.1f} MiB, private {usage['private'] / 2**20:.1f} MiB")
+    total = parent['pss'] + sum(usage['pss'] for usage in memory.values())
+    print(f"parent pss {parent['pss'] / 2**20:.1f} MiB, total pss {total / 2**20:.1f} MiB")
@@ -0,0 +1,54 @@
+import argparse
+import os
+import time
+
+import numpy as np
+import torch
+
+from metric import abs_relative_difference, delta1_acc
+from video_depth_anything.loader import load_model
+from utils.dc_utils import read_video_frames
+
+
+def infer(model, frames, args, device, refresh_interval, diff_threshold=8):
+    model.reset_session()
+    model.set_static_reuse(refresh_interval, diff_threshold=diff_threshold, halo=args.halo)
+    depths, recomputed = [], []
+    start = time.perf_counter()
+    for frame in frames:
+        depths.append(model.infer_video_depth_one(frame, input_size=args.input_size, device=device, precision=args.precision))
+        recomputed.append(model.reuse_state['recomputed'] if model.reuse_state is not None else 1.0)
+    elapsed = (time.perf_counter() - start) / len(frames)
+    model.set_static_reuse(0)
+    return torch.from_numpy(np.stack(depths)), elapsed, float(np.mean(recomputed))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Speed and depth error of static region reuse against full streaming inference')
+    parser.add_argument('--videos', type=str, nargs='+', default=['./assets/example_videos/davis_rollercoaster.mp4', './assets/example_videos/Tokyo-Walk_rgb.mp4'])
+    parser.add_argument('--input_size', type=int, default=518)
+    parser.add_argument('--max_res', type=int, default=1280)
+    parser.add_argument('--max_len', type=int, default=64, help='maximum length of each video, -1 means no limit')
+    parser.add_argument('--encoder', type=str, default='vitl', choices=['vits', 'vitb', 'vitl'])
+    parser.add_argument('--precision', type=str, default=None, choices=['fp32', 'bf16', 'fp16'])
+    parser.add_argument('--refresh_interval', type=int, default=16)
+    parser.add_argument('--thresholds', type=int, nargs='+', default=[4, 8, 16])
+    parser.add_argument('--halo', type=int, default=1)
+
+    args = parser.parse_args()
+
+    DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
+    model = load_model(args.encoder, streaming=True, device=DEVICE)
+
+    for video in args.videos:
+        frames, _ = read_video_frames(video, args.max_len, -1, args.max_res)
+        ref_depths, ref_time, _ = infer(model, frames, args, DEVICE, 0)
+        valid_mask = ref_depths > 1e-3
+
+        print(f"{os.path.basename(video)} ({len(frames)} frames), full inference: {ref_time * 1000:.1f}ms per frame")
+        for threshold in args.thresholds:
+            depths, reuse_time, recomputed = infer(model, frames, args, DEVICE, args.refresh_interval, threshold)
+            print(f"  threshold {threshold}: {reuse_time * 1000:.1f}ms per frame, speedup {ref_time / reuse_time:.2f}x, "
+                  f"recomputed patches {recomputed * 100:.1f}%, "
+                  f"abs_rel {abs_relative_difference(depths, ref_depths, valid_mask).item():.5f}, "
+                  f"delta1 {delta1_acc(depths, ref_depths, valid_mask).item():.5f}")
@@ -0,0 +1,34 @@
+import argparse
+
+from video_depth_anything.loader import load_model
+from video_depth_anything.pipeline import parse_cpu_list
+from video_depth_anything.util.precision import resolve_precision
+from video_depth_anything.workers import autotune_threads, core_groups, split_cores
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Throughput of every split of the cores into workers and intra-op threads, on a synthetic window')
+    parser.add_argument('--encoder', type=str, default='vitl', choices=['vits', 'vitb', 'vitl'])
+    parser.add_argument('--input_size', type=int, default=518)
+    parser.add_argument('--num_frames', type=int, default=8)
+    parser.add_argument('--precision', type=str, default=None, choices=['fp32', 'bf16', 'fp16'])
+    parser.add_argument('--streaming', action='store_true', help='time the streaming model frame by frame instead of the offline model')
+    parser.add_argument('--workers', type=int, default=0, help='time this many workers, 0 tries 1, 2, 4, ... workers')
+    parser.add_argument('--cpu_cores', type=str, default=None)
+
+    args = parser.parse_args()
+
+    DEVICE = 'cpu'
+    precision = resolve_precision(DEVICE, args.precision)
+    cores = parse_cpu_list(args.cpu_cores) if args.cpu_cores else None
+    workers = args.workers or None
+    # the candidates with several workers fork, the weights are loaded once for all of them
+    model = load_model(args.encoder, streaming=args.streaming, device=DEVICE, share_memory=workers != 1)
+
+    groups = core_groups(cores)
+    print(f"{sum(len(group) for group in groups)} cores, {len(groups)} physical")
+    print(f"{args.encoder}, {'streaming' if args.streaming else 'offline'}, {args.num_frames} frames at input size {args.input_size}, {precision}")
+    results = autotune_threads(model, input_size=args.input_size, num_frames=args.num_frames, precision=precision, workers=workers, cores=cores)
+    for count, threads, fps in results:
+        slices = ' '.join(','.join(map(str, cores)) for cores in split_cores(count, cores))
+        print(f"{count} workers x {threads} threads: {fps:.2f} fps  (cores {slices})")
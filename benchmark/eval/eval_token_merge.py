@@ -0,0 +1,47 @@
+import argparse
+import os
+import time
+
+import torch
+
+from metric import abs_relative_difference, delta1_acc
+from video_depth_anything.loader import load_model
+from utils.dc_utils import read_video_frames
+
+
+def infer(model, frames, args, device):
+    start = time.perf_counter()
+    depths, _ = model.infer_video_depth(frames, 30, input_size=args.input_size, device=device, precision=args.precision)
+    return torch.from_numpy(depths), (time.perf_counter() - start) / len(frames)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Speed and depth error of token merging against the full model')
+    parser.add_argument('--videos', type=str, nargs='+', default=['./assets/example_videos/davis_rollercoaster.mp4', './assets/example_videos/Tokyo-Walk_rgb.mp4'])
+    parser.add_argument('--input_size', type=int, default=518)
+    parser.add_argument('--max_res', type=int, default=1280)
+    parser.add_argument('--max_len', type=int, default=64, help='maximum length of each video, -1 means no limit')
+    parser.add_argument('--encoder', type=str, default='vitl', choices=['vits', 'vitb', 'vitl'])
+    parser.add_argument('--precision', type=str, default=None, choices=['fp32', 'bf16', 'fp16'])
+    parser.add_argument('--ratios', type=float, nargs='+', default=[0.1, 0.2, 0.3, 0.5])
+    parser.add_argument('--start_layer', type=int, default=None, help='first block that merges tokens, default is a quarter of the depth')
+
+    args = parser.parse_args()
+
+    DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
+    model = load_model(args.encoder, device=DEVICE)
+
+    for video in args.videos:
+        frames, _ = read_video_frames(video, args.max_len, -1, args.max_res)
+        model.pretrained.set_token_merging(0)
+        ref_depths, ref_time = infer(model, frames, args, DEVICE)
+        valid_mask = ref_depths > 1e-3
+
+        print(f"{os.path.basename(video)} ({len(frames)} frames), full model: {ref_time * 1000:.1f}ms per frame")
+        for ratio in args.ratios:
+            model.pretrained.set_token_merging(ratio, args.start_layer)
+            depths, merge_time = infer(model, frames, args, DEVICE)
+            print(f"  ratio {ratio:.2f}: {merge_time * 1000:.1f}ms per frame, speedup {ref_time / merge_time:.2f}x, "
+                  f"abs_rel {abs_relative_difference(depths, ref_depths, valid_mask).item():.5f}, "
+                  f"delta1 {delta1_acc(depths, ref_depths, valid_mask).item():.5f}")
+        model.pretrained.set_token_merging(0)
@@ -0,0 +1,83 @@
+import argparse
+import os
+import time
+
+import torch
+import torch.nn.functional as F
+
+from metric import abs_relative_difference, delta1_acc
+from video_depth_anything.loader import load_model
+from video_depth_anything.util.upsample import GuidedUpsampler, upsample_depth
+from utils.dc_utils import read_video_frames
+
+
+class TimedUpsampler:
+    """Runs `upsampler` (bilinear if None) and adds up the time it takes and the frames it upsamples."""
+
+    def __init__(self, upsampler):
+        self.upsampler = upsampler
+        self.time = 0.0
+        self.frames = 0
+        self.size = None
+
+    def __call__(self, depth, frames):
+        self.size = depth.shape[-2:]
+        start = time.perf_counter()
+        depth = upsample_depth(depth, frames[0].shape[:2], frames, self.upsampler)
+        self.time += time.perf_counter() - start
+        self.frames += len(depth)
+        return depth
+
+
+def edge_mask(depths, fraction):
+    """The `fraction` of the pixels of every frame of `depths` [T, H, W] with the largest gradient of the log depth."""
+    log_depth = depths.clamp(min=1e-3).log()
+    grad = torch.zeros_like(log_depth)
+    grad[:, :, 1:] += (log_depth[:, :, 1:] - log_depth[:, :, :-1]).abs()
+    grad[:, 1:, :] += (log_depth[:, 1:, :] - log_depth[:, :-1, :]).abs()
+    threshold = grad.flatten(1).kthvalue(int(grad[0].numel() * (1 - fraction)), dim=1).values
+    return grad >= threshold[:, None, None]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Depth error of bilinear and guided upsampling from lower input sizes, against the full input size')
+    parser.add_argument('--videos', type=str, nargs='+', default=['./assets/example_videos/davis_rollercoaster.mp4', './assets/example_videos/Tokyo-Walk_rgb.mp4'])
+    parser.add_argument('--input_size', type=int, default=518, help='input size of the reference depth')
+    parser.add_argument('--input_sizes', type=int, nargs='+', default=[280, 392])
+    parser.add_argument('--max_res', type=int, default=1280)
+    parser.add_argument('--max_len', type=int, default=32, help='maximum length of each video, -1 means no limit')
+    parser.add_argument('--encoder', type=str, default='vitl', choices=['vits', 'vitb', 'vitl'])
+    parser.add_argument('--precision', type=str, default=None, choices=['fp32', 'bf16', 'fp16'])
+    parser.add_argument('--radius', type=int, nargs='+', default=[1])
+    parser.add_argument('--eps', type=float, nargs='+', default=[1e-2])
+    parser.add_argument('--edge_fraction', type=float, default=0.05, help='part of the pixels, at the largest reference depth gradients, that the edge error is measured on')
+
+    args = parser.parse_args()
+
+    DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
+    model = load_model(args.encoder, device=DEVICE)
+    upsamplers = [('bilinear', None)] + [(f'guided r={radius} eps={eps:g}', GuidedUpsampler(radius, eps)) for radius in args.radius for eps in args.eps]
+
+    for video in args.videos:
+        frames, _ = read_video_frames(video, args.max_len, -1, args.max_res)
+        model.upsampler = None
+        ref_depths = torch.from_numpy(model.infer_video_depth(frames, 30, input_size=args.input_size, device=DEVICE, precision=args.precision)[0])
+        valid_mask = ref_depths > 1e-3
+        edges = edge_mask(ref_depths, args.edge_fraction) & valid_mask
+
+        print(f"{os.path.basename(video)} ({len(frames)} frames of {frames.shape[2]}x{frames.shape[1]}), reference input size {args.input_size}")
+        for input_size in args.input_sizes:
+            print(f"  input size {input_size}:")
+            for name, upsampler in upsamplers:
+                model.upsampler = TimedUpsampler(upsampler)
+                depths = torch.from_numpy(model.infer_video_depth(frames, 30, input_size=input_size, device=DEVICE, precision=args.precision)[0])
+                # the reference brought down to the model resolution and back, the error of the upsampling alone
+                low_ref = F.interpolate(ref_depths.unsqueeze(1), size=model.upsampler.size, mode='area')
+                ref_upsampled = upsample_depth(low_ref, frames.shape[1:3], frames, upsampler)[:, 0]
+                print(f"    {name}: {model.upsampler.time / model.upsampler.frames * 1000:.1f}ms per frame, "
+                      f"abs_rel {abs_relative_difference(depths, ref_depths, valid_mask).item():.5f}, "
+                      f"delta1 {delta1_acc(depths, ref_depths, valid_mask).item():.5f}, "
+                      f"edge abs_rel {abs_relative_difference(depths, ref_depths, edges).item():.5f}; "
+                      f"upsampling the reference: abs_rel {abs_relative_difference(ref_upsampled, ref_depths, valid_mask).item():.5f}, "
+                      f"edge abs_rel {abs_relative_difference(ref_upsampled, ref_depths, edges).item():.5f}")
+        model.upsampler = None
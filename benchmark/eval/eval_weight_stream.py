@@ -0,0 +1,58 @@
+import argparse
+import os
+import time
+
+import torch
+
+from video_depth_anything.loader import checkpoint_path, load_model
+from video_depth_anything.util.memory import StagePeakMemory, weight_memory
+from video_depth_anything.util.precision import autocast, resolve_precision
+
+
+def drop_page_cache(path):
+    """Drop the pages of `path` from the page cache, as memory pressure would; pages mapped by a process stay."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Resident memory and latency of one window, with or without weight streaming')
+    parser.add_argument('--encoder', type=str, default='vitl', choices=['vits', 'vitb', 'vitl'])
+    parser.add_argument('--input_size', type=int, nargs=2, default=[518, 518], metavar=('HEIGHT', 'WIDTH'))
+    parser.add_argument('--num_frames', type=int, default=32)
+    parser.add_argument('--precision', type=str, default=None, choices=['fp32', 'bf16', 'fp16'])
+    parser.add_argument('--windows', type=int, default=3, help='timed windows after a warm-up window')
+    parser.add_argument('--stream_weights', action='store_true')
+    parser.add_argument('--cold', action='store_true', help='drop the checkpoint from the page cache before every window, so streamed weights are read from disk')
+
+    args = parser.parse_args()
+
+    DEVICE = 'cpu'
+    precision = resolve_precision(DEVICE, args.precision)
+    model = load_model(args.encoder, device=DEVICE, stream_weights=args.stream_weights)
+    path = checkpoint_path(args.encoder)
+
+    height, width = args.input_size
+    x = torch.randn(1, args.num_frames, 3, height, width)
+    latencies = []
+    with torch.no_grad(), autocast(DEVICE, precision):
+        for i in range(args.windows + 1):
+            if args.cold:
+                drop_page_cache(path)
+            start = time.perf_counter()
+            model(x)
+            latencies.append(time.perf_counter() - start)
+        if args.cold:
+            drop_page_cache(path)
+        with StagePeakMemory(model, DEVICE) as memory:
+            model(x)
+
+    latency = sum(latencies[1:]) / max(len(latencies) - 1, 1)
+    mode = 'streamed weights' if args.stream_weights else 'resident weights'
+    print(f"{args.encoder}, {args.num_frames} frames of {height}x{width}, {precision}, {mode}{', cold page cache' if args.cold else ''}")
+    print(f"weights: {weight_memory(model) / 2**20:.1f} MiB")
+    print(f"peak resident set: {(memory.base + max(memory.peaks.values())) / 2**20:.1f} MiB")
+    print(f"latency: {latency:.2f}s per window ({latency / args.num_frames * 1000:.1f}ms per frame)")
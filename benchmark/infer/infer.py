@@ -6,7 +6,9 @@ import torch
 from tqdm import tqdm
 import numpy as np
 
-from video_depth_anything.video_depth import VideoDepthAnything
+from video_depth_anything.loader import load_model
+from video_depth_anything.pipeline import parse_cpu_list
+from video_depth_anything.workers import autotune_threads, configure_threads
 from utils.dc_utils import read_video_frames
 
 if __name__ == '__main__':
@@ -18,25 +20,27 @@ if __name__ == '__main__':
     
     parser.add_argument('--input_size', type=int, default=518)
     parser.add_argument('--encoder', type=str, default='vitl', choices=['vits', 'vitb', 'vitl'])
+    parser.add_argument('--quantize', type=str, default=None, choices=['int8-dynamic'], help='quantize the transformer layers, runs on CPU')
+    parser.add_argument('--cpu_cores', type=str, default=None, help='cpu list to run on, e.g. 0-15; default all cores this process may use')
+    parser.add_argument('--threads', type=str, default=None, help="intra-op threads on CPU, default one per physical core of --cpu_cores; 'auto' times the candidates on a synthetic window")
 
     args = parser.parse_args()
+
+    DEVICE = 'cuda' if torch.cuda.is_available() and args.quantize is None else 'cpu'
+    if args.cpu_cores or args.threads:
+        configure_threads(parse_cpu_list(args.cpu_cores) if args.cpu_cores else None, None if args.threads in (None, 'auto') else int(args.threads))
    
     for dataset in args.datasets:
 
         with open(args.json_file, 'r') as fs:
             path_json = json.load(fs)
 
-        DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
-
-        model_configs = {
-            'vits': {'encoder': 'vits', 'features': 64, 'out_channels': [48, 96, 192, 384]},
-            'vitb': {'encoder': 'vitb', 'features': 128, 'out_channels': [96, 192, 384, 768]},
-            'vitl': {'encoder': 'vitl', 'features': 256, 'out_channels': [256, 512, 1024, 1024]},
-        }
-
-        video_depth_anything = VideoDepthAnything(**model_configs[args.encoder])
-        video_depth_anything.load_state_dict(torch.load(f'./checkpoints/video_depth_anything_{args.encoder}.pth', map_location='cpu'), strict=True)
-        video_depth_anything = video_depth_anything.to(DEVICE).eval()
+        video_depth_anything = load_model(args.encoder, device=DEVICE, quantize=args.quantize)
+        if args.threads == 'auto' and DEVICE == 'cpu':
+            _, threads, fps = autotune_threads(video_depth_anything, input_size=args.input_size, precision='fp32')[0]
+            torch.set_num_threads(threads)
+            args.threads = str(threads)
+            print(f"{threads} threads, {fps:.2f} fps on a synthetic window")
         
         json_data = path_json[dataset]
         root_path = os.path.dirname(args.json_file)
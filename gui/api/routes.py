@@ -1,11 +1,15 @@
 import asyncio
+import struct
 import uuid
 from pathlib import Path
-from typing import Dict
+from typing import Dict, Optional
 
-from fastapi import APIRouter, HTTPException, UploadFile
+import cv2
+import numpy as np
+from fastapi import APIRouter, HTTPException, UploadFile, WebSocket, WebSocketDisconnect
 from fastapi.responses import FileResponse
 
+from gui.core.interfaces import StreamingDepthEstimator
 from gui.core.models import EncoderSize, JobConfig, ProcessingStage
 from gui.services.pipeline import Pipeline
 
@@ -15,17 +19,31 @@ router = APIRouter()
 _pipeline: Pipeline = None  # type: ignore
 _upload_dir: Path = None  # type: ignore
 _output_dir: Path = None  # type: ignore
+_stream_estimator: StreamingDepthEstimator = None  # type: ignore
 
 # Track active job
 _current_job_id: str = ""
 _processing: bool = False
 
 
-def configure(pipeline: Pipeline, upload_dir: Path, output_dir: Path) -> None:
-    global _pipeline, _upload_dir, _output_dir
+# /ws/depth reply header: frame index, height, width, depth min, depth max
+_DEPTH_HEADER = struct.Struct("<IHHff")
+# /ws/depth input sizes, the activations grow with the square of the input size
+_MIN_STREAM_INPUT_SIZE = 14
+_MAX_STREAM_INPUT_SIZE = 2048
+
+
+def configure(
+    pipeline: Pipeline,
+    upload_dir: Path,
+    output_dir: Path,
+    stream_estimator: Optional[StreamingDepthEstimator] = None,
+) -> None:
+    global _pipeline, _upload_dir, _output_dir, _stream_estimator
     _pipeline = pipeline
     _upload_dir = upload_dir
     _output_dir = output_dir
+    _stream_estimator = stream_estimator
 
 
 @router.get("/health")
@@ -76,6 +94,8 @@ async def process_video(
     max_res: int = 1280,
     max_len: int = -1,
     target_fps: int = -1,
+    metric: bool = False,
+    precision: Optional[str] = None,
 ):
     global _current_job_id, _processing
 
@@ -91,6 +111,9 @@ async def process_video(
     except ValueError:
         raise HTTPException(400, f"Invalid encoder: {encoder}")
 
+    if precision not in (None, "fp32", "bf16", "fp16", "int8"):
+        raise HTTPException(400, f"Invalid precision: {precision}")
+
     config = JobConfig(
         input_path=input_path,
         output_dir=_output_dir,
@@ -99,6 +122,8 @@ async def process_video(
         max_res=max_res,
         max_len=max_len,
         target_fps=target_fps,
+        metric=metric,
+        precision=precision,
     )
 
     _current_job_id = str(uuid.uuid4())
@@ -143,3 +168,144 @@ async def download_file(filename: str):
         media_type="video/mp4",
         filename=filename,
     )
+
+
+def _decode_frame(data: bytes, width: int, height: int) -> np.ndarray:
+    if width > 0 and height > 0:
+        if len(data) != width * height * 3:
+            raise ValueError(f"Expected {width * height * 3} bytes of raw RGB, got {len(data)}")
+        return np.frombuffer(data, dtype=np.uint8).reshape(height, width, 3)
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("Could not decode frame")
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+def _encode_depth(depth: np.ndarray, index: int, output: str, depth_range: list) -> bytes:
+    if output == "uint16":
+        d_min, d_max = float(depth.min()), float(depth.max())
+        scale = 65535 / max(d_max - d_min, 1e-6)
+        payload = ((depth - d_min) * scale).astype("<u2").tobytes()
+    else:
+        # running range so that the colors do not flicker from frame to frame
+        depth_range[0] = min(depth_range[0], float(depth.min()))
+        depth_range[1] = max(depth_range[1], float(depth.max()))
+        d_min, d_max = depth_range
+        scale = 255 / max(d_max - d_min, 1e-6)
+        depth_norm = np.clip((depth - d_min) * scale, 0, 255).astype(np.uint8)
+        colored = cv2.applyColorMap(depth_norm, cv2.COLORMAP_INFERNO)
+        payload = cv2.imencode(".jpg", colored, [cv2.IMWRITE_JPEG_QUALITY, 85])[1].tobytes()
+    header = _DEPTH_HEADER.pack(index, depth.shape[0], depth.shape[1], d_min, d_max)
+    return header + payload
+
+
+@router.websocket("/ws/depth")
+async def depth_stream(
+    websocket: WebSocket,
+    encoder: str = "vits",
+    input_size: int = 518,
+    output: str = "uint16",
+    width: int = 0,
+    height: int = 0,
+    drop: bool = False,
+    precision: Optional[str] = None,
+    fp32: bool = False,
+):
+    """Real-time streaming depth.
+
+    The client sends frames as binary messages: encoded images (JPEG/PNG), or raw RGB bytes
+    when width and height are given. Every inferred frame is answered with a 16-byte header
+    (frame index, height, width, depth min, depth max) followed by little-endian uint16 depth
+    normalized to [min, max], or by a colorized JPEG. At most two frames wait per connection;
+    when full, reading from the socket pauses, or with drop=true the oldest frame is dropped.
+    precision is fp32, bf16 or fp16, by default the one of the device; fp32=true is the same as
+    precision=fp32. input_size is a multiple of 14 up to 2048, and all frames have the size of
+    the first one. Invalid parameters close the connection with 1008, invalid frames with 1003
+    and inference errors with 1011.
+    """
+    await websocket.accept()
+    if _stream_estimator is None:
+        await websocket.close(code=1011, reason="Streaming depth is not configured")
+        return
+    try:
+        encoder_enum = EncoderSize(encoder)
+    except ValueError:
+        await websocket.close(code=1008, reason=f"Invalid encoder: {encoder}")
+        return
+    if output not in ("uint16", "jpeg"):
+        await websocket.close(code=1008, reason=f"Invalid output: {output}")
+        return
+    if not (_MIN_STREAM_INPUT_SIZE <= input_size <= _MAX_STREAM_INPUT_SIZE and input_size % 14 == 0):
+        await websocket.close(
+            code=1008,
+            reason=f"Invalid input_size: {input_size}, a multiple of 14 in [{_MIN_STREAM_INPUT_SIZE}, {_MAX_STREAM_INPUT_SIZE}]",
+        )
+        return
+
+    if fp32:
+        # older spelling of precision=fp32
+        precision = "fp32"
+    if precision not in (None, "fp32", "bf16", "fp16"):
+        await websocket.close(code=1008, reason=f"Invalid precision: {precision}")
+        return
+
+    loop = asyncio.get_event_loop()
+    try:
+        session = await loop.run_in_executor(
+            None, _stream_estimator.open_session, encoder_enum, input_size, precision
+        )
+    except ValueError as e:
+        await websocket.close(code=1008, reason=str(e)[:123])
+        return
+    pending: asyncio.Queue = asyncio.Queue(maxsize=2)
+
+    async def receive() -> None:
+        index = 0
+        try:
+            while True:
+                data = await websocket.receive_bytes()
+                if drop and pending.full():
+                    pending.get_nowait()
+                await pending.put((index, data))
+                index += 1
+        except WebSocketDisconnect:
+            pass
+        finally:
+            if pending.full():
+                pending.get_nowait()
+            pending.put_nowait(None)
+
+    receiver = asyncio.create_task(receive())
+    depth_range = [float("inf"), float("-inf")]
+    # the streaming model keeps the resolution of the first frame for the whole session
+    frame_shape = None
+    try:
+        while True:
+            item = await pending.get()
+            if item is None:
+                break
+            index, data = item
+            try:
+                frame = _decode_frame(data, width, height)
+            except ValueError as e:
+                await websocket.close(code=1003, reason=str(e))
+                break
+            if frame_shape is None:
+                frame_shape = frame.shape
+            elif frame.shape != frame_shape:
+                await websocket.close(
+                    code=1003, reason=f"Frame of {frame.shape[1]}x{frame.shape[0]}, the stream is {frame_shape[1]}x{frame_shape[0]}"
+                )
+                break
+            try:
+                depth = await loop.run_in_executor(None, _stream_estimator.infer, session, frame)
+            except Exception as e:
+                # only this connection goes, the other streams keep the shared model
+                await websocket.close(code=1011, reason=f"Inference failed: {type(e).__name__}"[:123])
+                break
+            await websocket.send_bytes(_encode_depth(depth, index, output, depth_range))
+    except WebSocketDisconnect:
+        pass
+    finally:
+        receiver.cancel()
+        _stream_estimator.close_session(session)
@@ -8,6 +8,7 @@ from gui.services.audio_service import AudioService
 from gui.services.depth_service import DepthService
 from gui.services.merge_service import MergeService
 from gui.services.pipeline import Pipeline
+from gui.services.stream_service import StreamingDepthService
 from gui.services.video_service import VideoService
 
 _GUI_DIR = Path(__file__).resolve().parent.parent
@@ -24,6 +25,7 @@ def create_app() -> FastAPI:
     audio_service = AudioService()
     depth_service = DepthService()
     merge_service = MergeService()
+    stream_service = StreamingDepthService()
 
     pipeline = Pipeline(
         video_io=video_service,
@@ -32,7 +34,7 @@ def create_app() -> FastAPI:
         merger=merge_service,
     )
 
-    routes.configure(pipeline, _UPLOAD_DIR, _OUTPUT_DIR)
+    routes.configure(pipeline, _UPLOAD_DIR, _OUTPUT_DIR, stream_service)
     app.include_router(routes.router)
 
     # Serve frontend static files
@@ -33,7 +33,13 @@ class AudioIO(ABC):
 
 class DepthEstimator(ABC):
     @abstractmethod
-    def load_model(self, encoder: EncoderSize, device: str) -> None:
+    def load_model(
+        self,
+        encoder: EncoderSize,
+        device: str,
+        metric: bool = False,
+        precision: Optional[str] = None,
+    ) -> None:
         """Load or switch the depth estimation model."""
 
     @abstractmethod
@@ -45,10 +51,25 @@ class DepthEstimator(ABC):
         device: str,
         fp32: bool,
         on_progress: Optional[ProgressCallback] = None,
+        precision: Optional[str] = None,
     ) -> Tuple[np.ndarray, float]:
         """Run depth estimation, return (depths [N,H,W] float, fps)."""
 
 
+class StreamingDepthEstimator(ABC):
+    @abstractmethod
+    def open_session(self, encoder: EncoderSize, input_size: int, precision: Optional[str] = None) -> object:
+        """Start a new stream in `precision` (None for the device default), return an opaque session handle."""
+
+    @abstractmethod
+    def infer(self, session: object, frame: np.ndarray) -> np.ndarray:
+        """Infer one RGB uint8 frame [H,W,3] of the session's stream, return depth [H,W] float."""
+
+    @abstractmethod
+    def close_session(self, session: object) -> None:
+        """Release the state of a stream."""
+
+
 class RGBDMerger(ABC):
     @abstractmethod
     def merge(
@@ -32,6 +32,8 @@ class JobConfig:
     max_len: int = -1
     target_fps: int = -1
     fp32: bool = False
+    metric: bool = False
+    precision: Optional[str] = None
 
     @property
     def video_stem(self) -> str:
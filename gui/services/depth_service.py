@@ -1,7 +1,8 @@
+import os
 import sys
 import unittest.mock
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import List, Optional, Tuple, Union
 
 import numpy as np
 import torch
@@ -13,38 +14,85 @@ _PROJECT_ROOT = str(Path(__file__).resolve().parents[2])
 if _PROJECT_ROOT not in sys.path:
     sys.path.insert(0, _PROJECT_ROOT)
 
+from video_depth_anything.loader import checkpoint_path, load_model
+from video_depth_anything.util.precision import resolve_precision
 from video_depth_anything.video_depth import VideoDepthAnything
+from video_depth_anything.workers import autotune_threads, configure_threads
 
-MODEL_CONFIGS = {
-    "vits": {"encoder": "vits", "features": 64, "out_channels": [48, 96, 192, 384]},
-    "vitb": {"encoder": "vitb", "features": 128, "out_channels": [96, 192, 384, 768]},
-    "vitl": {"encoder": "vitl", "features": 256, "out_channels": [256, 512, 1024, 1024]},
-}
+from gui.services.model_pool import ModelKey, ModelPool, default_memory_budget
 
 CHECKPOINT_DIR = Path(_PROJECT_ROOT) / "checkpoints"
 
 
 class DepthService(DepthEstimator):
-    def __init__(self):
-        self._model: Optional[VideoDepthAnything] = None
-        self._current_encoder: Optional[EncoderSize] = None
-        self._device: str = "cpu"
+    """Offline depth estimation with a pool of loaded models.
+
+    Models are kept per (encoder, metric, quantized) in a `ModelPool` of `memory_budget` bytes
+    (default half of the device memory), so switching between models does not reload them
+    from disk, and the model likely to be requested next is loaded in the background. A job
+    keeps using its model even if the pool evicts it meanwhile.
 
-    def load_model(self, encoder: EncoderSize, device: str) -> None:
-        if self._model is not None and self._current_encoder == encoder:
-            return  # Already loaded
+    With `cpu_cores` or `threads`, the process is pinned to `cpu_cores` with `threads` intra-op
+    threads before the first model is loaded on CPU (see `configure_threads`); with
+    threads="auto" the thread count is timed on a synthetic window at the input size of the
+    first CPU job. Without either, the thread pools keep the torch and OpenCV defaults.
+    """
 
-        config = MODEL_CONFIGS[encoder.value]
-        model = VideoDepthAnything(**config)
-        ckpt_path = CHECKPOINT_DIR / f"video_depth_anything_{encoder.value}.pth"
-        model.load_state_dict(
-            torch.load(str(ckpt_path), map_location="cpu"), strict=True
+    def __init__(
+        self,
+        memory_budget: Optional[int] = None,
+        prefetch: bool = True,
+        cpu_cores: Optional[List[int]] = None,
+        threads: Union[int, str, None] = None,
+    ):
+        self._model: Optional[VideoDepthAnything] = None
+        self._current_key: Optional[ModelKey] = None
+        self._device: str = "cpu"
+        self._memory_budget = memory_budget
+        self._prefetch = prefetch
+        self._pool: Optional[ModelPool] = None
+        self._cpu_cores = cpu_cores
+        self._threads = threads
+        self._cpu_configured = False
+
+    def _load(self, key: ModelKey) -> VideoDepthAnything:
+        # the quantized kernels run on CPU
+        device = "cpu" if key.quantized else self._device
+        if device == "cpu" and not self._cpu_configured and (self._cpu_cores is not None or self._threads is not None):
+            configure_threads(self._cpu_cores, None if self._threads == "auto" else self._threads)
+            self._cpu_configured = True
+        return load_model(
+            key.encoder.value,
+            metric=key.metric,
+            checkpoint_dir=str(CHECKPOINT_DIR),
+            device=device,
+            quantize="int8-dynamic" if key.quantized else None,
         )
-        model = model.to(device).eval()
 
-        self._model = model
-        self._current_encoder = encoder
-        self._device = device
+    def _size_of(self, key: ModelKey) -> int:
+        path = checkpoint_path(key.encoder.value, key.metric, str(CHECKPOINT_DIR))
+        size = os.path.getsize(path)
+        # int8 weights of the Linear layers, which hold most of the parameters
+        return size // 4 if key.quantized else size
+
+    def load_model(
+        self,
+        encoder: EncoderSize,
+        device: str,
+        metric: bool = False,
+        precision: Optional[str] = None,
+    ) -> None:
+        if self._pool is None or device != self._device:
+            self._device = device
+            budget = self._memory_budget or default_memory_budget(device)
+            self._pool = ModelPool(self._load, self._size_of, budget, prefetch=self._prefetch)
+
+        if precision != "int8":
+            # fail before loading, e.g. fp16 on CPU
+            resolve_precision(device, precision)
+        key = ModelKey(encoder, metric=metric, quantized=precision == "int8")
+        self._model = self._pool.get(key)
+        self._current_key = key
 
     def estimate(
         self,
@@ -54,17 +102,28 @@ class DepthService(DepthEstimator):
         device: str,
         fp32: bool,
         on_progress: Optional[ProgressCallback] = None,
+        precision: Optional[str] = None,
     ) -> Tuple[np.ndarray, float]:
         if self._model is None:
             raise RuntimeError("Model not loaded. Call load_model() first.")
 
+        if self._current_key.quantized:
+            # the quantized model runs on CPU in float32
+            device, precision = "cpu", "fp32"
+
+        if device == "cpu" and self._threads == "auto":
+            _, self._threads, _ = autotune_threads(
+                self._model, input_size=input_size, precision=resolve_precision(device, precision, fp32)
+            )[0]
+            torch.set_num_threads(self._threads)
+
         if on_progress:
             return self._estimate_with_progress(
-                frames, target_fps, input_size, device, fp32, on_progress
+                frames, target_fps, input_size, device, fp32, on_progress, precision
             )
 
         depths, fps = self._model.infer_video_depth(
-            frames, target_fps, input_size=input_size, device=device, fp32=fp32
+            frames, target_fps, input_size=input_size, device=device, fp32=fp32, precision=precision
         )
         return depths, fps
 
@@ -76,6 +135,7 @@ class DepthService(DepthEstimator):
         device: str,
         fp32: bool,
         on_progress: ProgressCallback,
+        precision: Optional[str] = None,
     ) -> Tuple[np.ndarray, float]:
         """Run inference with tqdm monkey-patching for progress callbacks."""
         import tqdm as tqdm_module
@@ -124,7 +184,7 @@ class DepthService(DepthEstimator):
 
         try:
             depths, fps = self._model.infer_video_depth(
-                frames, target_fps, input_size=input_size, device=device, fp32=fp32
+                frames, target_fps, input_size=input_size, device=device, fp32=fp32, precision=precision
             )
         finally:
             vd_module.tqdm = original_vd_tqdm
@@ -0,0 +1,145 @@
+import os
+import threading
+from collections import Counter, OrderedDict, defaultdict
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional
+
+import torch
+
+from gui.core.models import EncoderSize
+
+
+@dataclass(frozen=True)
+class ModelKey:
+    """Identity of a set of weights in the pool.
+
+    The float precisions (fp32, bf16, fp16) run under autocast on the same weights, so they
+    share one entry; only int8 quantization builds different weights.
+    """
+
+    encoder: EncoderSize
+    metric: bool = False
+    quantized: bool = False
+
+    @property
+    def checkpoint_name(self) -> str:
+        name = "metric_video_depth_anything" if self.metric else "video_depth_anything"
+        return f"{name}_{self.encoder.value}"
+
+
+def default_memory_budget(device: str) -> int:
+    """Half of the memory of `device`, in bytes."""
+    if torch.device(device).type == "cuda":
+        return torch.cuda.get_device_properties(torch.device(device)).total_memory // 2
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // 2
+
+
+def weight_bytes(model: torch.nn.Module) -> int:
+    return sum(t.numel() * t.element_size() for t in list(model.parameters()) + list(model.buffers()))
+
+
+class ModelPool:
+    """Loaded models keyed by `ModelKey`, evicted least recently used beyond a memory budget.
+
+    Every job asking for the same key gets the same model, whose weights are only read. The
+    size of a model is known from its checkpoint before it is loaded, and models are evicted
+    until it fits `memory_budget` bytes; the most recently requested model is never evicted,
+    so one model always fits. `get` also learns which model tends to be requested after which,
+    and with `prefetch` loads the likely next one in the background if it fits without
+    evicting the current one.
+    """
+
+    def __init__(
+        self,
+        loader: Callable[[ModelKey], torch.nn.Module],
+        size_of: Callable[[ModelKey], int],
+        memory_budget: int,
+        prefetch: bool = True,
+    ):
+        self._loader = loader
+        self._size_of = size_of
+        self.memory_budget = memory_budget
+        self.prefetch = prefetch
+        self._models: "OrderedDict[ModelKey, torch.nn.Module]" = OrderedDict()
+        self._sizes: Dict[ModelKey, int] = {}
+        self._loading: Dict[ModelKey, threading.Event] = {}
+        self._successors: Dict[ModelKey, Counter] = defaultdict(Counter)
+        self._last: Optional[ModelKey] = None
+        self._lock = threading.Lock()
+
+    @property
+    def resident(self) -> list:
+        """Keys of the loaded models, least recently used first."""
+        with self._lock:
+            return list(self._models)
+
+    def get(self, key: ModelKey) -> torch.nn.Module:
+        with self._lock:
+            if self._last is not None and self._last != key:
+                self._successors[self._last][key] += 1
+            self._last = key
+        model = self._load(key, keep=key)
+        if self.prefetch:
+            self._prefetch_after(key)
+        return model
+
+    def _load(self, key: ModelKey, keep: ModelKey, force: bool = True) -> Optional[torch.nn.Module]:
+        while True:
+            with self._lock:
+                if key in self._models:
+                    self._models.move_to_end(key)
+                    return self._models[key]
+                loading = self._loading.get(key)
+                if loading is None:
+                    if not self._make_room(self._size_of(key), keep, force):
+                        return None
+                    loading = self._loading[key] = threading.Event()
+                    break
+            # loaded by another thread (e.g. a prefetch), wait for it and look again
+            loading.wait()
+
+        try:
+            model = self._loader(key)
+            with self._lock:
+                self._models[key] = model
+                self._sizes[key] = weight_bytes(model)
+                if key != keep:
+                    # a prefetched model is not used yet, it goes first if room is needed
+                    self._models.move_to_end(key, last=False)
+            return model
+        finally:
+            with self._lock:
+                del self._loading[key]
+            loading.set()
+
+    def _make_room(self, size: int, keep: ModelKey, force: bool) -> bool:
+        """Evict models, least recently used first and never `keep`, until `size` more bytes fit. Called with the lock held.
+
+        Without `force` nothing is evicted unless that makes it fit, and False means it does not.
+        """
+        used = sum(self._sizes.values()) + sum(self._size_of(key) for key in self._loading)
+        victims = [key for key in self._models if key != keep]
+        if not force and used - sum(self._sizes[key] for key in victims) + size > self.memory_budget:
+            return False
+        for victim in victims:
+            if used + size <= self.memory_budget:
+                break
+            del self._models[victim]
+            used -= self._sizes.pop(victim)
+        return True
+
+    def _prefetch_after(self, key: ModelKey) -> None:
+        with self._lock:
+            successors = self._successors.get(key)
+            if not successors:
+                return
+            likely = successors.most_common(1)[0][0]
+            if likely in self._models or likely in self._loading:
+                return
+        threading.Thread(target=self._load, args=(likely, key, False), daemon=True).start()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._models.clear()
+            self._sizes.clear()
+
@@ -69,7 +69,9 @@ class Pipeline:
             self._report(
                 ProcessingStage.ESTIMATING_DEPTH, 0.0, "Loading depth model..."
             )
-            self._depth.load_model(config.encoder, self._device)
+            self._depth.load_model(
+                config.encoder, self._device, metric=config.metric, precision=config.precision
+            )
 
             # 4. Estimate depth
             depths, fps = self._depth.estimate(
@@ -79,6 +81,7 @@ class Pipeline:
                 device=self._device,
                 fp32=config.fp32,
                 on_progress=self._on_depth_progress,
+                precision=config.precision,
             )
 
             # 5. Save source video
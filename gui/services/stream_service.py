@@ -0,0 +1,91 @@
+import sys
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Optional
+
+import numpy as np
+import torch
+
+from gui.core.interfaces import StreamingDepthEstimator
+from gui.core.models import EncoderSize
+from gui.services.depth_service import CHECKPOINT_DIR
+
+_PROJECT_ROOT = str(Path(__file__).resolve().parents[2])
+if _PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, _PROJECT_ROOT)
+
+from video_depth_anything.loader import load_model
+from video_depth_anything.util.precision import resolve_precision
+from video_depth_anything.video_depth_stream import VideoDepthAnything
+
+
+@dataclass(eq=False)
+class StreamSession:
+    encoder: EncoderSize
+    input_size: int
+    precision: str
+    state: Optional[dict] = None
+    frames: int = 0
+
+
+class StreamingDepthService(StreamingDepthEstimator):
+    """Streaming depth for many concurrent connections.
+
+    One streaming model is loaded per encoder and shared by all sessions using it. The model
+    holds the state of one stream at a time, so the active session is exported and the next
+    one imported whenever a different session is served.
+    """
+
+    def __init__(self, device: Optional[str] = None):
+        self._device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        self._models: Dict[EncoderSize, VideoDepthAnything] = {}
+        self._active: Dict[EncoderSize, Optional[StreamSession]] = {}
+        self._locks: Dict[EncoderSize, threading.Lock] = {}
+        self._load_lock = threading.Lock()
+
+    def _get_model(self, encoder: EncoderSize) -> VideoDepthAnything:
+        with self._load_lock:
+            if encoder not in self._models:
+                self._models[encoder] = load_model(
+                    encoder.value, streaming=True, checkpoint_dir=str(CHECKPOINT_DIR), device=self._device
+                )
+                self._active[encoder] = None
+                self._locks[encoder] = threading.Lock()
+            return self._models[encoder]
+
+    def open_session(self, encoder: EncoderSize, input_size: int, precision: Optional[str] = None) -> StreamSession:
+        # raises ValueError for a precision the device cannot run, before loading anything
+        precision = resolve_precision(self._device, precision)
+        self._get_model(encoder)
+        return StreamSession(encoder=encoder, input_size=input_size, precision=precision)
+
+    def infer(self, session: StreamSession, frame: np.ndarray) -> np.ndarray:
+        model = self._get_model(session.encoder)
+        with self._locks[session.encoder]:
+            active = self._active[session.encoder]
+            if active is not session:
+                if active is not None:
+                    active.state = model.export_session()
+                if session.state is None:
+                    model.reset_session()
+                else:
+                    model.import_session(session.state, device=self._device)
+                    session.state = None
+                self._active[session.encoder] = session
+
+            depth = model.infer_video_depth_one(
+                frame, input_size=session.input_size, device=self._device, precision=session.precision
+            )
+        session.frames += 1
+        return depth
+
+    def close_session(self, session: StreamSession) -> None:
+        lock = self._locks.get(session.encoder)
+        if lock is None:
+            return
+        with lock:
+            if self._active[session.encoder] is session:
+                self._models[session.encoder].reset_session()
+                self._active[session.encoder] = None
+            session.state = None
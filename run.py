@@ -16,7 +16,12 @@ import numpy as np
 import os
 import torch
 
-from video_depth_anything.video_depth import VideoDepthAnything
+from video_depth_anything.compile import DEFAULT_CACHE_DIR
+from video_depth_anything.loader import load_model
+from video_depth_anything.pipeline import StagePipeline, parse_cpu_list
+from video_depth_anything.util.precision import resolve_precision
+from video_depth_anything.util.upsample import GuidedUpsampler
+from video_depth_anything.workers import autotune_threads, configure_threads
 from utils.dc_utils import read_video_frames, save_video
 
 if __name__ == '__main__':
@@ -29,7 +34,23 @@ if __name__ == '__main__':
     parser.add_argument('--max_len', type=int, default=-1, help='maximum length of the input video, -1 means no limit')
     parser.add_argument('--target_fps', type=int, default=-1, help='target fps of the input video, -1 means the original fps')
     parser.add_argument('--metric', action='store_true', help='use metric model')
-    parser.add_argument('--fp32', action='store_true', help='model infer with torch.float32, default is torch.float16')
+    parser.add_argument('--fp32', action='store_true', help='model infer with torch.float32, same as --precision fp32')
+    parser.add_argument('--precision', type=str, default=None, choices=['fp32', 'bf16', 'fp16'], help='inference precision, default is fp16 on CUDA and bf16 on CPU')
+    parser.add_argument('--quantize', type=str, default=None, choices=['int8-dynamic'], help='quantize the transformer layers for CPU inference, implies --precision fp32 and CPU')
+    parser.add_argument('--optimize', action='store_true', help='fold the input normalization, LayerScale and norm affines into the adjacent layers and pack the temporal q/k/v projections')
+    parser.add_argument('--stream_weights', action='store_true', help='keep the weights memory-mapped and page them in per block, for hosts with little RAM; runs on CPU')
+    parser.add_argument('--pipeline', action='store_true', help='run the encoder of the next window while the head decodes this one, on their own cores')
+    parser.add_argument('--pipeline_cores', type=str, nargs=2, default=None, metavar=('ENCODER', 'HEAD'), help='cpu lists of the two --pipeline stages, e.g. 0-15 16-31; default splits the sockets, or the cores, in half')
+    parser.add_argument('--cpu_cores', type=str, default=None, help='cpu list to run on, e.g. 0-15; default all cores this process may use')
+    parser.add_argument('--threads', type=str, default=None, help="intra-op threads on CPU, default one per physical core of --cpu_cores; 'auto' times the candidates on a synthetic window after loading")
+    parser.add_argument('--guided_upsample', action='store_true', help='upsample the depth to the frame resolution with a guided filter on the frame instead of bilinear, keeps the edges sharp at a lower --input_size')
+    parser.add_argument('--compile', action='store_true', help='compile the model with torch.compile, the first frames of every input size are slow')
+    parser.add_argument('--token_merge_ratio', type=float, default=0.0, help='merge this part of the patch tokens in each of the later ViT blocks (ToMe), 0 means no merging')
+    parser.add_argument('--tiles', type=int, default=0, help='tiled high-resolution inference with this many tiles across the shorter side, 0 means no tiling; combine with --max_res -1')
+    parser.add_argument('--tile_overlap', type=float, default=0.25, help='overlap of neighbouring tiles as a fraction of the tile size')
+    parser.add_argument('--memory_budget', type=float, default=-1, help='peak memory in GiB, picks the micro-batch sizes of the encoder and head and, with --tiles, the tile input size; -1 means no budget')
+    parser.add_argument('--feature_cache', type=str, default=None, help='keep the encoder outputs of every frame in this directory, later runs on the same video, model, input size and precision only run the head')
+    parser.add_argument('--compile_cache_dir', type=str, default=DEFAULT_CACHE_DIR, help='compile cache shared by later runs')
     parser.add_argument('--grayscale', action='store_true', help='do not apply colorful palette')
     parser.add_argument('--save_npz', action='store_true', help='save depths as npz')
     parser.add_argument('--save_exr', action='store_true', help='save depths as exr')
@@ -42,19 +63,45 @@ if __name__ == '__main__':
 
     DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
 
-    model_configs = {
-        'vits': {'encoder': 'vits', 'features': 64, 'out_channels': [48, 96, 192, 384]},
-        'vitb': {'encoder': 'vitb', 'features': 128, 'out_channels': [96, 192, 384, 768]},
-        'vitl': {'encoder': 'vitl', 'features': 256, 'out_channels': [256, 512, 1024, 1024]},
-    }
-    checkpoint_name = 'metric_video_depth_anything' if args.metric else 'video_depth_anything'
-
-    video_depth_anything = VideoDepthAnything(**model_configs[args.encoder], metric=args.metric)
-    video_depth_anything.load_state_dict(torch.load(f'./checkpoints/{checkpoint_name}_{args.encoder}.pth', map_location='cpu'), strict=True)
-    video_depth_anything = video_depth_anything.to(DEVICE).eval()
+    if args.quantize is not None:
+        # the quantized kernels run on CPU in float32
+        DEVICE = 'cpu'
+        args.precision = 'fp32'
+    if args.stream_weights:
+        # the weights are paged in from the checkpoint mapping in host memory
+        DEVICE = 'cpu'
+    try:
+        # fail before loading the model, e.g. fp16 on CPU
+        resolve_precision(DEVICE, args.precision, args.fp32)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.cpu_cores or args.threads:
+        # before any operator runs, the thread pools inherit the affinity
+        configure_threads(parse_cpu_list(args.cpu_cores) if args.cpu_cores else None, None if args.threads in (None, 'auto') else int(args.threads))
+    video_depth_anything = load_model(args.encoder, metric=args.metric, streaming=False, device=DEVICE, quantize=args.quantize,
+                                      compiled=args.compile, compile_cache_dir=args.compile_cache_dir, optimize=args.optimize,
+                                      stream_weights=args.stream_weights)
+    if args.threads == 'auto' and DEVICE == 'cpu':
+        _, threads, fps = autotune_threads(video_depth_anything, input_size=args.input_size, precision=resolve_precision(DEVICE, args.precision, args.fp32))[0]
+        torch.set_num_threads(threads)
+        print(f"{threads} threads, {fps:.2f} fps on a synthetic window")
+    if args.pipeline:
+        video_depth_anything.pipeline = StagePipeline(*map(parse_cpu_list, args.pipeline_cores)) if args.pipeline_cores else StagePipeline()
+    if args.guided_upsample:
+        video_depth_anything.upsampler = GuidedUpsampler()
+    if args.token_merge_ratio > 0:
+        video_depth_anything.pretrained.set_token_merging(args.token_merge_ratio)
+    memory_budget = args.memory_budget * 2**30 if args.memory_budget > 0 else None
+    video_depth_anything.memory_budget = memory_budget
 
     frames, target_fps = read_video_frames(args.input_video, args.max_len, args.target_fps, args.max_res)
-    depths, fps = video_depth_anything.infer_video_depth(frames, target_fps, input_size=args.input_size, device=DEVICE, fp32=args.fp32)
+    if args.tiles > 0:
+        depths, fps = video_depth_anything.infer_video_depth_tiled(frames, target_fps, input_size=args.input_size, tiles=args.tiles, tile_overlap=args.tile_overlap,
+                                                                   memory_budget=memory_budget, device=DEVICE, fp32=args.fp32, precision=args.precision,
+                                                                   feature_cache=args.feature_cache)
+    else:
+        depths, fps = video_depth_anything.infer_video_depth(frames, target_fps, input_size=args.input_size, device=DEVICE, fp32=args.fp32, precision=args.precision,
+                                                             feature_cache=args.feature_cache)
 
     video_name = os.path.basename(args.input_video)
     os.makedirs(args.output_dir, exist_ok=True)
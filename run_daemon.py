@@ -0,0 +1,235 @@
+# Copyright (2025) Bytedance Ltd. and/or its affiliates
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import argparse
+import os
+import selectors
+import signal
+import socket
+import sys
+import time
+
+import numpy as np
+import torch
+
+from video_depth_anything.loader import load_model
+from video_depth_anything.pipeline import parse_cpu_list
+from video_depth_anything.util.precision import resolve_precision
+from video_depth_anything.workers import autotune_threads, configure_threads, fork_workers
+from utils.shm_ring import MAGIC, HELLO, READY, REQUEST, REPLY, FrameRing
+
+# largest frame side and ring a client may ask for, the ring is allocated before the first frame
+MAX_FRAME_SIDE = 8192
+MAX_SLOTS = 64
+
+
+def bind_listener(socket_path):
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_path)
+    listener.listen()
+    return listener
+
+
+def serve_worker(rank, model, listener, args, device):
+    # release the shared memory of open connections on SIGTERM as well
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    daemon = DepthDaemon(model, args.socket, input_size=args.input_size, device=device, fp32=args.fp32, precision=args.precision)
+    daemon.serve(listener)
+
+
+class DepthDaemon:
+    """Serve the streaming model to local clients over a Unix socket, with frames in shared memory.
+
+    Every connection is its own stream: the model's session is exported and imported whenever
+    requests from another connection are served. With several worker processes (`serve_worker`)
+    a connection stays with the worker that accepted it.
+    """
+
+    def __init__(self, model, socket_path, input_size=518, device='cuda', fp32=False, precision=None):
+        self.model = model
+        self.socket_path = socket_path
+        self.input_size = input_size
+        self.device = device
+        self.fp32 = fp32
+        self.precision = precision
+
+        self.selector = selectors.DefaultSelector()
+        self.connections = {}
+        self.active = None
+
+    def serve_forever(self):
+        listener = bind_listener(self.socket_path)
+        print(f"listening on {self.socket_path}")
+        try:
+            self.serve(listener)
+        finally:
+            listener.close()
+            os.unlink(self.socket_path)
+
+    def serve(self, listener):
+        """Serve the connections accepted on `listener`, which other worker processes may accept on as well."""
+        listener.setblocking(False)
+        self.selector.register(listener, selectors.EVENT_READ)
+        try:
+            while True:
+                for key, _ in self.selector.select():
+                    if key.fileobj is listener:
+                        try:
+                            conn, _ = listener.accept()
+                        except BlockingIOError:
+                            # accepted by another worker
+                            continue
+                        conn.setblocking(True)
+                        self.connections[conn] = {'buffer': b'', 'ring': None, 'session': None}
+                        self.selector.register(conn, selectors.EVENT_READ)
+                    else:
+                        self.handle(key.fileobj)
+        finally:
+            for conn in list(self.connections):
+                self.disconnect(conn)
+            self.selector.unregister(listener)
+
+    def handle(self, conn):
+        state = self.connections[conn]
+        try:
+            data = conn.recv(65536)
+        except ConnectionError:
+            data = b''
+        if not data:
+            self.disconnect(conn)
+            return
+        state['buffer'] += data
+
+        if state['ring'] is None:
+            if len(state['buffer']) < HELLO.size:
+                return
+            magic, height, width, num_slots = HELLO.unpack(state['buffer'][:HELLO.size])
+            state['buffer'] = state['buffer'][HELLO.size:]
+            if magic != MAGIC or not (0 < height <= MAX_FRAME_SIDE and 0 < width <= MAX_FRAME_SIDE and 0 < num_slots <= MAX_SLOTS):
+                print(f"rejected HELLO {magic!r} {height}x{width} with {num_slots} slots")
+                self.disconnect(conn)
+                return
+            try:
+                state['ring'] = FrameRing(height, width, num_slots, create=True)
+                conn.sendall(READY.pack(state['ring'].name.encode()))
+            except OSError as e:
+                print(f"connection closed: {e}")
+                self.disconnect(conn)
+                return
+
+        while len(state['buffer']) >= REQUEST.size:
+            slot, seq = REQUEST.unpack(state['buffer'][:REQUEST.size])
+            state['buffer'] = state['buffer'][REQUEST.size:]
+            if slot >= state['ring'].num_slots:
+                print(f"rejected REQUEST of slot {slot} of {state['ring'].num_slots}")
+                self.disconnect(conn)
+                return
+            try:
+                infer_ms = self.infer(conn, slot)
+                conn.sendall(REPLY.pack(slot, seq, infer_ms))
+            except Exception as e:
+                # only this connection goes, the other streams and the worker keep running
+                print(f"connection closed: {type(e).__name__}: {e}")
+                self.disconnect(conn)
+                return
+
+    def infer(self, conn, slot):
+        if self.active is not conn:
+            if self.active is not None:
+                self.connections[self.active]['session'] = self.model.export_session()
+            session = self.connections[conn]['session']
+            if session is None:
+                self.model.reset_session()
+            else:
+                self.model.import_session(session, device=self.device)
+            self.active = conn
+
+        ring = self.connections[conn]['ring']
+        start = time.perf_counter()
+        depth = self.model.infer_video_depth_one(ring.frames[slot], input_size=self.input_size, device=self.device, fp32=self.fp32, precision=self.precision)
+        np.copyto(ring.depths[slot], depth)
+        return (time.perf_counter() - start) * 1000
+
+    def disconnect(self, conn):
+        state = self.connections.pop(conn)
+        self.selector.unregister(conn)
+        conn.close()
+        if state['ring'] is not None:
+            state['ring'].close()
+        if self.active is conn:
+            self.active = None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Video Depth Anything daemon')
+    parser.add_argument('--socket', type=str, default='/tmp/video_depth_anything.sock')
+    parser.add_argument('--input_size', type=int, default=518)
+    parser.add_argument('--encoder', type=str, default='vitl', choices=['vits', 'vitb', 'vitl'])
+    parser.add_argument('--metric', action='store_true', help='use metric model')
+    parser.add_argument('--fp32', action='store_true', help='model infer with torch.float32, same as --precision fp32')
+    parser.add_argument('--precision', type=str, default=None, choices=['fp32', 'bf16', 'fp16'], help='inference precision, default is fp16 on CUDA and bf16 on CPU')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes forked after loading, sharing the weights in memory; more than one runs on CPU')
+    parser.add_argument('--cpu_cores', type=str, default=None, help='cpu list to run on, split between the workers; default all cores this process may use')
+    parser.add_argument('--threads', type=str, default=None, help="intra-op threads of every worker on CPU, default one per physical core of its cores; 'auto' times the candidates on synthetic frames after loading")
+
+    args = parser.parse_args()
+
+    DEVICE = 'cuda' if torch.cuda.is_available() and args.workers == 1 else 'cpu'
+
+    try:
+        # fail before loading the model, e.g. fp16 on CPU
+        resolve_precision(DEVICE, args.precision, args.fp32)
+    except ValueError as e:
+        parser.error(str(e))
+
+    cores = parse_cpu_list(args.cpu_cores) if args.cpu_cores else None
+    threads = None if args.threads in (None, 'auto') else int(args.threads)
+    if args.workers == 1 and (args.cpu_cores or args.threads):
+        cores, threads = configure_threads(cores, threads)
+
+    # forked workers share the weights loaded here instead of loading a copy each
+    video_depth_anything = load_model(args.encoder, metric=args.metric, streaming=True, device=DEVICE, share_memory=args.workers > 1)
+    if args.threads == 'auto' and DEVICE == 'cpu':
+        # with several workers the candidates are timed in forked workers, this process stays single-threaded
+        _, threads, fps = autotune_threads(video_depth_anything, input_size=args.input_size, precision=resolve_precision(DEVICE, args.precision, args.fp32),
+                                           workers=args.workers, cores=cores)[0]
+        if args.workers == 1:
+            torch.set_num_threads(threads)
+        print(f"{threads} threads per worker, {fps:.2f} fps on synthetic frames")
+
+    # release the shared memory of open connections on SIGTERM as well
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    if args.workers == 1:
+        daemon = DepthDaemon(video_depth_anything, args.socket, input_size=args.input_size, device=DEVICE, fp32=args.fp32, precision=args.precision)
+        try:
+            daemon.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    else:
+        listener = bind_listener(args.socket)
+        workers = fork_workers(args.workers, serve_worker, args=(video_depth_anything, listener, args, DEVICE), cores=cores, threads=threads)
+        print(f"listening on {args.socket} with {args.workers} workers")
+        try:
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for worker in workers:
+                worker.terminate()
+                worker.join()
+            listener.close()
+            os.unlink(args.socket)
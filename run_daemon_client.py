@@ -0,0 +1,92 @@
+# Copyright (2025) Bytedance Ltd. and/or its affiliates
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import argparse
+import os
+import time
+
+import cv2
+import numpy as np
+
+from utils.dc_utils import DepthVideoWriter
+from utils.shm_ring import DepthDaemonClient
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stand-in client for run_daemon.py')
+    parser.add_argument('--socket', type=str, default='/tmp/video_depth_anything.sock')
+    parser.add_argument('--input_video', type=str, default='./assets/example_videos/davis_rollercoaster.mp4')
+    parser.add_argument('--output_dir', type=str, default='', help='save the depth visualization here, nothing is saved by default')
+    parser.add_argument('--max_res', type=int, default=1280)
+    parser.add_argument('--max_len', type=int, default=-1, help='maximum length of the input video, -1 means no limit')
+    parser.add_argument('--num_slots', type=int, default=2, help='number of shared memory slots, i.e. frames in flight')
+
+    args = parser.parse_args()
+
+    cap = cv2.VideoCapture(args.input_video)
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    if args.max_res > 0 and max(height, width) > args.max_res:
+        scale = args.max_res / max(height, width)
+        height, width = round(height * scale), round(width * scale)
+
+    client = DepthDaemonClient(args.socket, height, width, num_slots=args.num_slots)
+    writer = None
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+        video_name = os.path.splitext(os.path.basename(args.input_video))[0]
+        writer = DepthVideoWriter(os.path.join(args.output_dir, video_name + '_daemon_vis.mp4'), fps=fps)
+
+    round_trips, infer_times = [], []
+    in_flight = 0
+    frame_count = 0
+    start = time.perf_counter()
+    while args.max_len < 0 or frame_count < args.max_len:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        if in_flight == args.num_slots:
+            _, depth, round_trip_ms, infer_ms = client.receive()
+            in_flight -= 1
+            round_trips.append(round_trip_ms)
+            infer_times.append(infer_ms)
+            if writer is not None:
+                writer.write(depth)
+
+        # convert and resize straight into the shared memory slot
+        slot = frame_count % args.num_slots
+        if frame.shape[:2] != (height, width):
+            frame = cv2.resize(frame, (width, height))
+        cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=client.ring.frames[slot])
+        client.submit(slot)
+        in_flight += 1
+        frame_count += 1
+
+    while in_flight > 0:
+        _, depth, round_trip_ms, infer_ms = client.receive()
+        in_flight -= 1
+        round_trips.append(round_trip_ms)
+        infer_times.append(infer_ms)
+        if writer is not None:
+            writer.write(depth)
+    end = time.perf_counter()
+
+    cap.release()
+    client.close()
+    if writer is not None:
+        writer.close()
+
+    round_trips, infer_times = np.array(round_trips), np.array(infer_times)
+    print(f"frames: {frame_count}, fps: {frame_count / (end - start):.2f}")
+    print(f"round trip mean/p50/p95: {round_trips.mean():.2f}/{np.percentile(round_trips, 50):.2f}/{np.percentile(round_trips, 95):.2f}ms")
+    print(f"inference mean: {infer_times.mean():.2f}ms, transport and queueing mean: {(round_trips - infer_times).mean():.2f}ms")
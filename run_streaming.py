@@ -12,14 +12,21 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import argparse
-import numpy as np
 import os
+import queue
+import threading
 import torch
 import time
 import cv2
 
-from video_depth_anything.video_depth_stream import VideoDepthAnything
-from utils.dc_utils import save_video
+from video_depth_anything.compile import DEFAULT_CACHE_DIR
+from video_depth_anything.loader import load_model
+from video_depth_anything.pipeline import StagePipeline, parse_cpu_list
+from video_depth_anything.util.precision import resolve_precision
+from video_depth_anything.util.upsample import GuidedUpsampler
+from video_depth_anything.workers import autotune_threads, configure_threads
+from video_depth_anything.stream_driver import RealtimeStreamDriver
+from utils.dc_utils import DepthVideoWriter
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Video Depth Anything')
@@ -31,23 +38,72 @@ if __name__ == '__main__':
     parser.add_argument('--max_len', type=int, default=-1, help='maximum length of the input video, -1 means no limit')
     parser.add_argument('--target_fps', type=int, default=-1, help='target fps of the input video, -1 means the original fps')
     parser.add_argument('--metric', action='store_true', help='use metric model')
-    parser.add_argument('--fp32', action='store_true', help='model infer with torch.float32, default is torch.float16')
+    parser.add_argument('--fp32', action='store_true', help='model infer with torch.float32, same as --precision fp32')
+    parser.add_argument('--precision', type=str, default=None, choices=['fp32', 'bf16', 'fp16'], help='inference precision, default is fp16 on CUDA and bf16 on CPU')
+    parser.add_argument('--quantize', type=str, default=None, choices=['int8-dynamic'], help='quantize the transformer layers for CPU inference, implies --precision fp32 and CPU')
+    parser.add_argument('--optimize', action='store_true', help='fold the input normalization, LayerScale and norm affines into the adjacent layers and pack the temporal q/k/v projections')
+    parser.add_argument('--stream_weights', action='store_true', help='keep the weights memory-mapped and page them in per block, for hosts with little RAM; runs on CPU')
+    parser.add_argument('--pipeline', action='store_true', help='run the encoder of the next frame while the head decodes this one, on their own cores; not with --latency_budget')
+    parser.add_argument('--pipeline_cores', type=str, nargs=2, default=None, metavar=('ENCODER', 'HEAD'), help='cpu lists of the two --pipeline stages, e.g. 0-15 16-31; default splits the sockets, or the cores, in half')
+    parser.add_argument('--cpu_cores', type=str, default=None, help='cpu list to run on, e.g. 0-15; default all cores this process may use')
+    parser.add_argument('--threads', type=str, default=None, help="intra-op threads on CPU, default one per physical core of --cpu_cores; 'auto' times the candidates on synthetic frames after loading")
+    parser.add_argument('--guided_upsample', action='store_true', help='upsample the depth to the frame resolution with a guided filter on the frame instead of bilinear, keeps the edges sharp at a lower --input_size')
+    parser.add_argument('--compile', action='store_true', help='compile the model with torch.compile, the first frames of every input size are slow')
+    parser.add_argument('--token_merge_ratio', type=float, default=0.0, help='merge this part of the patch tokens in each of the later ViT blocks (ToMe), 0 means no merging')
+    parser.add_argument('--static_reuse_interval', type=int, default=0, help='static camera approximation: re-encode only changed patches and the whole frame every this many frames, 0 means off')
+    parser.add_argument('--static_reuse_threshold', type=int, default=8, help='pixel difference (0-255) above which a patch counts as changed for --static_reuse_interval')
+    parser.add_argument('--compile_cache_dir', type=str, default=DEFAULT_CACHE_DIR, help='compile cache shared by later runs')
     parser.add_argument('--grayscale', action='store_true', help='do not apply colorful palette')
+    parser.add_argument('--latency_budget', type=float, default=-1, help='per-frame latency budget in ms, treat the input as a live source and drop frames that cannot meet it, -1 means no budget')
+    parser.add_argument('--max_catchup', type=int, default=1, help='with a latency budget, infer up to this many pending frames in one batched step, the same depth as one by one except with --quantize')
+    parser.add_argument('--load_session', type=str, default='', help='resume the stream from a session snapshot instead of a cold start')
+    parser.add_argument('--save_session', type=str, default='', help='save a session snapshot after the last frame')
+    parser.add_argument('--queue_size', type=int, default=8, help='capacity of the queues between the decode, infer and encode threads')
+    parser.add_argument('--depth_min', type=float, default=0.0, help='lower bound of the fixed depth range used for visualization')
+    parser.add_argument('--depth_max', type=float, default=None, help='upper bound of the fixed depth range, if not set a running range is used')
 
     args = parser.parse_args()
+    if args.pipeline and args.latency_budget > 0:
+        # the real-time driver steps and batches frames itself, it does not run on the pipeline stages
+        parser.error('--pipeline cannot be combined with --latency_budget')
+    if args.token_merge_ratio > 0 and args.static_reuse_interval > 0:
+        # static reuse recomputes single patch tokens, which merging would mix with others
+        parser.error('--token_merge_ratio cannot be combined with --static_reuse_interval')
 
     DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
 
-    model_configs = {
-        'vits': {'encoder': 'vits', 'features': 64, 'out_channels': [48, 96, 192, 384]},
-        'vitb': {'encoder': 'vitb', 'features': 128, 'out_channels': [96, 192, 384, 768]},
-        'vitl': {'encoder': 'vitl', 'features': 256, 'out_channels': [256, 512, 1024, 1024]},
-    }
-    checkpoint_name = 'metric_video_depth_anything' if args.metric else 'video_depth_anything'
-
-    video_depth_anything = VideoDepthAnything(**model_configs[args.encoder])
-    video_depth_anything.load_state_dict(torch.load(f'./checkpoints/{checkpoint_name}_{args.encoder}.pth', map_location='cpu'), strict=True)
-    video_depth_anything = video_depth_anything.to(DEVICE).eval()
+    if args.quantize is not None:
+        # the quantized kernels run on CPU in float32
+        DEVICE = 'cpu'
+        args.precision = 'fp32'
+    if args.stream_weights:
+        # the weights are paged in from the checkpoint mapping in host memory
+        DEVICE = 'cpu'
+    try:
+        # fail before loading the model, e.g. fp16 on CPU
+        resolve_precision(DEVICE, args.precision, args.fp32)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.cpu_cores or args.threads:
+        # before any operator runs, the thread pools inherit the affinity
+        configure_threads(parse_cpu_list(args.cpu_cores) if args.cpu_cores else None, None if args.threads in (None, 'auto') else int(args.threads))
+    video_depth_anything = load_model(args.encoder, metric=args.metric, streaming=True, device=DEVICE, quantize=args.quantize,
+                                      compiled=args.compile, compile_cache_dir=args.compile_cache_dir, optimize=args.optimize,
+                                      stream_weights=args.stream_weights)
+    if args.threads == 'auto' and DEVICE == 'cpu':
+        _, threads, fps = autotune_threads(video_depth_anything, input_size=args.input_size, precision=resolve_precision(DEVICE, args.precision, args.fp32))[0]
+        torch.set_num_threads(threads)
+        print(f"{threads} threads, {fps:.2f} fps on synthetic frames")
+    if args.pipeline:
+        video_depth_anything.pipeline = StagePipeline(*map(parse_cpu_list, args.pipeline_cores)) if args.pipeline_cores else StagePipeline()
+    if args.guided_upsample:
+        video_depth_anything.upsampler = GuidedUpsampler()
+    if args.token_merge_ratio > 0:
+        video_depth_anything.pretrained.set_token_merging(args.token_merge_ratio)
+    if args.static_reuse_interval > 0:
+        video_depth_anything.set_static_reuse(args.static_reuse_interval, diff_threshold=args.static_reuse_threshold)
+    if args.load_session:
+        video_depth_anything.load_session(args.load_session, device=DEVICE)
 
     cap = cv2.VideoCapture(args.input_video)
     original_fps = cap.get(cv2.CAP_PROP_FPS)
@@ -64,33 +120,115 @@ if __name__ == '__main__':
 
     stride = max(round(original_fps / fps), 1)
 
-    depths = []
-    frame_count = 0
-    start = time.time()
-    while cap.isOpened():
-        ret, frame = cap.read()
-        if not ret or (args.max_len > 0 and frame_count >= args.max_len):
-            break
-        if frame_count % stride == 0:
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)  # Convert BGR to RGB
-            if args.max_res > 0 and max(original_height, original_width) > args.max_res:
-                frame = cv2.resize(frame, (width, height))  # Resize frame
+    video_name = os.path.basename(args.input_video)
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
 
+    depth_vis_path = os.path.join(args.output_dir, os.path.splitext(video_name)[0]+'_vis.mp4')
+    depth_range = (args.depth_min, args.depth_max) if args.depth_max is not None else None
+
+    # decode -> infer -> encode, each stage on its own thread with bounded queues in between
+    frame_queue = queue.Queue(maxsize=args.queue_size)
+    depth_queue = queue.Queue(maxsize=args.queue_size)
+    stop_event = threading.Event()
+    errors = []
+
+    def put(q, item):
+        while not stop_event.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(q):
+        while not stop_event.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return None
+
+    def run_stage(func):
+        def wrapper():
+            try:
+                func()
+            except Exception as e:
+                errors.append(e)
+                stop_event.set()
+        return wrapper
+
+    def decode():
+        frame_count = 0
+        try:
+            while cap.isOpened():
+                ret, frame = cap.read()
+                if not ret or (args.max_len > 0 and frame_count >= args.max_len):
+                    break
+                if frame_count % stride == 0:
+                    frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)  # Convert BGR to RGB
+                    if args.max_res > 0 and max(original_height, original_width) > args.max_res:
+                        frame = cv2.resize(frame, (width, height))  # Resize frame
+                    if not put(frame_queue, frame):
+                        return
+                frame_count += 1
+                if frame_count % 50 == 0:
+                    print(f"frame: {frame_count}/{total_frames}")
+        finally:
+            cap.release()
+            put(frame_queue, None)
+
+    def frames():
+        frame = get(frame_queue)
+        while frame is not None:
+            yield frame
+            frame = get(frame_queue)
+
+    def infer():
+        try:
+            if args.latency_budget > 0:
+                # treat the video as a live source released at its frame rate, and drop frames
+                # that cannot meet the latency budget
+                driver = RealtimeStreamDriver(video_depth_anything, args.latency_budget / 1000, input_size=args.input_size,
+                                              device=DEVICE, fp32=args.fp32, precision=args.precision, drop_policy='repeat', max_catchup=args.max_catchup)
+                for _, depth, _ in driver.run(frames(), source_fps=fps):
+                    if depth is not None and not put(depth_queue, depth):
+                        return
+                stats = driver.stats
+                print(f"achieved fps: {stats['achieved_fps']:.2f}/{stats['input_fps']:.2f}, "
+                      f"dropped frames: {stats['dropped']}/{stats['received']}, "
+                      f"latency mean/p95: {stats['latency_mean'] * 1000:.1f}/{stats['latency_p95'] * 1000:.1f}ms")
+                return
             # Inference depth
-            depth = video_depth_anything.infer_video_depth_one(frame, input_size=args.input_size, device=DEVICE, fp32=args.fp32)
-            depths.append(depth)
-        frame_count += 1
-        if frame_count % 50 == 0:
-            print(f"frame: {frame_count}/{total_frames}")
+            for depth in video_depth_anything.infer_video_depth_frames(frames(), input_size=args.input_size, device=DEVICE, fp32=args.fp32, precision=args.precision):
+                if not put(depth_queue, depth):
+                    return
+        finally:
+            put(depth_queue, None)
+
+    def encode():
+        writer = DepthVideoWriter(depth_vis_path, fps=fps, grayscale=args.grayscale, depth_range=depth_range)
+        try:
+            while True:
+                depth = get(depth_queue)
+                if depth is None:
+                    break
+                writer.write(depth)
+        finally:
+            writer.close()
+
+    start = time.time()
+    threads = [threading.Thread(target=run_stage(stage), daemon=True) for stage in (decode, infer, encode)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
     end = time.time()
 
-    cap.release()
+    if errors:
+        raise errors[0]
     print(f"time: {end - start}s")
 
-    video_name = os.path.basename(args.input_video)
-    if not os.path.exists(args.output_dir):
-        os.makedirs(args.output_dir)
-
-    depth_vis_path = os.path.join(args.output_dir, os.path.splitext(video_name)[0]+'_vis.mp4')
-    depths = np.stack(depths, axis=0)
-    save_video(depths, depth_vis_path, fps=fps, is_depths=True, grayscale=args.grayscale)
+    if args.save_session:
+        video_depth_anything.save_session(args.save_session)
@@ -84,3 +84,32 @@ def save_video(frames, output_video_path, fps=10, is_depths=False, grayscale=Fal
             writer.append_data(frames[i])
 
     writer.close()
+
+
+class DepthVideoWriter:
+    """Write depth frames to a video one at a time.
+
+    Unlike `save_video`, the depth range is not taken from the whole sequence.
+    With `depth_range=(d_min, d_max)` every frame is normalized with that fixed
+    range; otherwise a running range is kept that only ever widens, so a frame
+    can be written as soon as it is produced.
+    """
+
+    def __init__(self, output_video_path, fps=10, grayscale=False, depth_range=None):
+        self.writer = imageio.get_writer(output_video_path, fps=fps, macro_block_size=1, codec='libx264', ffmpeg_params=['-crf', '18'])
+        self.colormap = np.array(cm.get_cmap("inferno").colors)
+        self.grayscale = grayscale
+        self.fixed_range = depth_range is not None
+        self.d_min, self.d_max = depth_range if depth_range is not None else (np.inf, -np.inf)
+
+    def write(self, depth):
+        if not self.fixed_range:
+            self.d_min = min(self.d_min, float(depth.min()))
+            self.d_max = max(self.d_max, float(depth.max()))
+        scale = 255 / max(self.d_max - self.d_min, 1e-6)
+        depth_norm = (np.clip((depth - self.d_min) * scale, 0, 255)).astype(np.uint8)
+        depth_vis = (self.colormap[depth_norm] * 255).astype(np.uint8) if not self.grayscale else depth_norm
+        self.writer.append_data(depth_vis)
+
+    def close(self):
+        self.writer.close()
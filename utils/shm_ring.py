@@ -0,0 +1,109 @@
+# Copyright (2025) Bytedance Ltd. and/or its affiliates
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Shared-memory frame transport between `run_daemon.py` and local clients.
+
+Frames and depth maps live in a `multiprocessing.shared_memory` ring of slots created by the
+daemon for every connection. Only small fixed-size control messages go over the Unix socket:
+
+    client -> daemon  HELLO    (magic, height, width, num_slots)
+    daemon -> client  READY    (shared memory name)
+    client -> daemon  REQUEST  (slot, seq)                 frame written to slot
+    daemon -> client  REPLY    (slot, seq, infer_ms)       depth written to slot
+"""
+import socket
+import struct
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+MAGIC = b'VDA1'
+HELLO = struct.Struct('<4sIII')
+READY = struct.Struct('<64s')
+REQUEST = struct.Struct('<II')
+REPLY = struct.Struct('<IIf')
+
+
+def recv_exact(sock, size):
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            raise ConnectionError("socket closed")
+        buf += chunk
+    return bytes(buf)
+
+
+class FrameRing:
+    """`num_slots` RGB uint8 frames followed by as many float32 depth maps in one shared memory block."""
+
+    def __init__(self, height, width, num_slots, name=None, create=False):
+        frame_bytes = num_slots * height * width * 3
+        depth_offset = (frame_bytes + 63) // 64 * 64
+        size = depth_offset + num_slots * height * width * 4
+
+        self.owner = create
+        self.shm = shared_memory.SharedMemory(name=name, create=create, size=size)
+        if not create:
+            # the creating process owns the block, do not let this process' tracker unlink it at exit
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+        self.name = self.shm.name
+        self.num_slots = num_slots
+        self.frames = np.ndarray((num_slots, height, width, 3), dtype=np.uint8, buffer=self.shm.buf)
+        self.depths = np.ndarray((num_slots, height, width), dtype=np.float32, buffer=self.shm.buf, offset=depth_offset)
+
+    def close(self):
+        del self.frames, self.depths
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class DepthDaemonClient:
+    """Client of `run_daemon.py`.
+
+    Write a frame in place into `ring.frames[slot]` (e.g. decode straight into it), `submit` the
+    slot and `receive` the reply; up to `num_slots` requests may be in flight. The returned depth
+    is a view of the shared memory, valid until the slot is submitted again.
+    """
+
+    def __init__(self, socket_path, height, width, num_slots=4):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path)
+        self.sock.sendall(HELLO.pack(MAGIC, height, width, num_slots))
+        name = READY.unpack(recv_exact(self.sock, READY.size))[0].rstrip(b'\0').decode()
+        self.ring = FrameRing(height, width, num_slots, name=name)
+        self.seq = 0
+        self.sent_time = {}
+
+    def submit(self, slot):
+        self.sent_time[self.seq] = time.perf_counter()
+        self.sock.sendall(REQUEST.pack(slot, self.seq))
+        self.seq += 1
+
+    def receive(self):
+        """Return (slot, depth, round_trip_ms, infer_ms) of the oldest request in flight."""
+        slot, seq, infer_ms = REPLY.unpack(recv_exact(self.sock, REPLY.size))
+        round_trip_ms = (time.perf_counter() - self.sent_time.pop(seq)) * 1000
+        return slot, self.ring.depths[slot], round_trip_ms, infer_ms
+
+    def infer(self, frame):
+        slot = self.seq % self.ring.num_slots
+        np.copyto(self.ring.frames[slot], frame)
+        self.submit(slot)
+        return self.receive()
+
+    def close(self):
+        self.sock.close()
+        self.ring.close()
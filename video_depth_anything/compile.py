@@ -0,0 +1,52 @@
+# Copyright (2025) Bytedance Ltd. and/or its affiliates
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+
+import torch
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'video_depth_anything', 'inductor')
+
+
+def enable_compile_cache(cache_dir=DEFAULT_CACHE_DIR):
+    """Keep the compiled kernels and FX graphs of inductor in `cache_dir`, so later processes start warm."""
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ['TORCHINDUCTOR_CACHE_DIR'] = cache_dir
+    os.environ['TORCHINDUCTOR_FX_GRAPH_CACHE'] = '1'
+    import torch._inductor.config as inductor_config
+    if hasattr(inductor_config, 'fx_graph_cache'):
+        inductor_config.fx_graph_cache = True
+
+
+def compile_model(model, size_bucket=56, cache_dir=DEFAULT_CACHE_DIR, mode=None):
+    """Compile the forward passes of `model` with torch.compile and return it.
+
+    For the offline model this is `forward_features` and `forward_head`, for the streaming model
+    `forward_features` and `forward_depth`: the encoder and the head are compiled separately, so
+    that they also run compiled as the stages of a `pipeline.StagePipeline`. Every input shape is
+    compiled once, so the transforms snap the longer side of the input to a multiple of
+    `size_bucket` (see `Resize`) to bound the number of shapes a process meets. With `cache_dir` the compile results persist across processes.
+
+    The streaming catch-up step (`infer_video_depth_catchup`) batches a varying number of frames;
+    beyond torch._dynamo's cache size limit of shapes it falls back to eager execution.
+    """
+    if cache_dir is not None:
+        enable_compile_cache(cache_dir)
+    model.size_bucket = size_bucket
+    if hasattr(model, 'forward_depth'):
+        model.forward_features = torch.compile(model.forward_features, mode=mode, dynamic=False)
+        model.forward_depth = torch.compile(model.forward_depth, mode=mode, dynamic=False)
+    else:
+        model.forward_features = torch.compile(model.forward_features, mode=mode, dynamic=False)
+        model.forward_head = torch.compile(model.forward_head, mode=mode, dynamic=False)
+    return model
@@ -10,14 +10,15 @@
 from functools import partial
 import math
 import logging
-from typing import Sequence, Tuple, Union, Callable
+from typing import Sequence, Tuple, Union, Callable, List
 
 import torch
 import torch.nn as nn
 import torch.utils.checkpoint
 from torch.nn.init import trunc_normal_
 
-from .dinov2_layers import Mlp, PatchEmbed, SwiGLUFFNFused, MemEffAttention, NestedTensorBlock as Block
+from .util.lru import LRUCache
+from .dinov2_layers import Mlp, PatchEmbed, SwiGLUFFNFused, MemEffAttention, NestedTensorBlock as Block, TokenMergeState
 
 
 logger = logging.getLogger("dinov2")
@@ -108,6 +109,7 @@ class DinoVisionTransformer(nn.Module):
 
         self.cls_token = nn.Parameter(torch.zeros(1, 1, embed_dim))
         self.pos_embed = nn.Parameter(torch.zeros(1, num_patches + self.num_tokens, embed_dim))
+        self.pos_embed_cache = LRUCache()
         assert num_register_tokens >= 0
         self.register_tokens = (
             nn.Parameter(torch.zeros(1, num_register_tokens, embed_dim)) if num_register_tokens else None
@@ -116,7 +118,8 @@ class DinoVisionTransformer(nn.Module):
         if drop_path_uniform is True:
             dpr = [drop_path_rate] * depth
         else:
-            dpr = [x.item() for x in torch.linspace(0, drop_path_rate, depth)]  # stochastic depth decay rule
+            # on CPU explicitly, so that the model can also be built under a meta device context
+            dpr = [x.item() for x in torch.linspace(0, drop_path_rate, depth, device="cpu")]  # stochastic depth decay rule
 
         if ffn_layer == "mlp":
             logger.info("using MLP layer as FFN")
@@ -166,6 +169,9 @@ class DinoVisionTransformer(nn.Module):
         self.head = nn.Identity()
 
         self.mask_token = nn.Parameter(torch.zeros(1, embed_dim))
+        self.token_merging = False
+        # set by the static reuse mode of the streaming model, which cannot merge tokens
+        self.token_reuse = False
 
         self.init_weights()
 
@@ -182,6 +188,13 @@ class DinoVisionTransformer(nn.Module):
         N = self.pos_embed.shape[1] - 1
         if npatch == N and w == h:
             return self.pos_embed
+        # storage and version counter key out embeddings interpolated before a weight update
+        key = (w, h, previous_dtype, x.device, self.pos_embed.data_ptr(), self.pos_embed._version)
+        return self.pos_embed_cache.get(key, lambda: self._interpolate_pos_encoding(x, w, h))
+
+    def _interpolate_pos_encoding(self, x, w, h):
+        previous_dtype = x.dtype
+        N = self.pos_embed.shape[1] - 1
         pos_embed = self.pos_embed.float()
         class_pos_embed = pos_embed[:, 0]
         patch_pos_embed = pos_embed[:, 1:]
@@ -268,15 +281,60 @@ class DinoVisionTransformer(nn.Module):
             "masks": masks,
         }
 
+    def set_token_merging(self, ratio, start_layer=None):
+        """Merge redundant patch tokens (ToMe) to speed up the blocks from `start_layer` on.
+
+        Each of these blocks merges `ratio` of its input patch tokens (at most half), and the
+        full token grid is restored for every intermediate layer that is returned, so the
+        outputs keep their shape. `start_layer` defaults to a quarter of the depth, 0 turns it off.
+        """
+        assert not self.chunked_blocks, "token merging needs unchunked blocks"
+        if ratio > 0 and self.token_reuse:
+            raise ValueError("token merging cannot be combined with static reuse, turn static reuse off first")
+        start_layer = self.n_blocks // 4 if start_layer is None else start_layer
+        for i, blk in enumerate(self.blocks):
+            blk.merge_ratio = ratio if i >= start_layer else 0.0
+        self.token_merging = ratio > 0
+
     def _get_intermediate_layers_not_chunked(self, x, n=1):
         x = self.prepare_tokens_with_masks(x)
+        merge_state = TokenMergeState(x, 1 + self.num_register_tokens) if self.token_merging else None
         # If n is an int, take the n last blocks. If it's a list, take them
         output, total_block_len = [], len(self.blocks)
         blocks_to_take = range(total_block_len - n, total_block_len) if isinstance(n, int) else n
         for i, blk in enumerate(self.blocks):
-            x = blk(x)
+            x = blk(x, merge_state) if merge_state is not None else blk(x)
             if i in blocks_to_take:
-                output.append(x)
+                output.append(x if merge_state is None else merge_state.unmerge(x))
+        assert len(output) == len(blocks_to_take), f"only {len(output)} / {len(blocks_to_take)} blocks found"
+        return output
+
+    def _get_intermediate_layers_reuse(self, x, n, reuse_cache, rows=None):
+        """Recompute only the tokens at positions `rows` and reuse the rest from `reuse_cache`.
+
+        The other tokens keep their keys and values in every block and their outputs of the
+        taken blocks from the pass that last computed them. `rows` None runs a full pass and
+        (re)fills the cache.
+        """
+        assert not self.chunked_blocks and not self.token_merging, "token reuse needs unchunked blocks without token merging"
+        x = self.prepare_tokens_with_masks(x)
+        if rows is None:
+            reuse_cache.clear()
+            reuse_cache['kv'] = [[] for _ in self.blocks]
+            reuse_cache['output'] = {}
+        else:
+            x = x[:, rows]
+        output, total_block_len = [], len(self.blocks)
+        blocks_to_take = range(total_block_len - n, total_block_len) if isinstance(n, int) else n
+        for i, blk in enumerate(self.blocks):
+            x = blk.forward_cached_kv(x, reuse_cache['kv'][i], rows)
+            if i in blocks_to_take:
+                if rows is not None:
+                    x_full = reuse_cache['output'][i].index_copy(1, rows, x.to(reuse_cache['output'][i].dtype))
+                else:
+                    x_full = x
+                reuse_cache['output'][i] = x_full
+                output.append(x_full)
         assert len(output) == len(blocks_to_take), f"only {len(output)} / {len(blocks_to_take)} blocks found"
         return output
 
@@ -300,14 +358,28 @@ class DinoVisionTransformer(nn.Module):
         n: Union[int, Sequence] = 1,  # Layers or n last layers to take
         reshape: bool = False,
         return_class_token: bool = False,
-        norm=True
+        norm=True,
+        reuse_cache=None,
+        reuse_rows=None,
+        micro_batch_size=None,
     ) -> Tuple[Union[torch.Tensor, Tuple[torch.Tensor]]]:
-        if self.chunked_blocks:
+        if micro_batch_size is not None and x.shape[0] > micro_batch_size:
+            # the images are independent, so slices of the batch give the same result with a lower peak
+            chunks = [self.get_intermediate_layers(x_i, n, reshape, return_class_token, norm) for x_i in x.split(micro_batch_size)]
+            if return_class_token:
+                return tuple((torch.cat([c[i][0] for c in chunks]), torch.cat([c[i][1] for c in chunks])) for i in range(len(chunks[0])))
+            return tuple(torch.cat([c[i] for c in chunks]) for i in range(len(chunks[0])))
+        if reuse_cache is not None:
+            outputs = self._get_intermediate_layers_reuse(x, n, reuse_cache, reuse_rows)
+        elif self.chunked_blocks:
             outputs = self._get_intermediate_layers_chunked(x, n)
         else:
             outputs = self._get_intermediate_layers_not_chunked(x, n)
         if norm:
-            outputs = [self.norm(out) for out in outputs]
+            # in place, so that every non-normalized output is released as soon as it is normalized
+            for i, out in enumerate(outputs):
+                outputs[i] = self.norm(out)
+            del out
         class_tokens = [out[:, 0] for out in outputs]
         outputs = [out[:, 1 + self.num_register_tokens:] for out in outputs]
         if reshape:
@@ -320,6 +392,32 @@ class DinoVisionTransformer(nn.Module):
             return tuple(zip(outputs, class_tokens))
         return tuple(outputs)
 
+    def get_intermediate_layers_list(
+        self,
+        x_list: List[torch.Tensor],
+        n: Union[int, Sequence] = 1,
+        return_class_token: bool = False,
+        norm=True,
+    ) -> List[Tuple[Union[torch.Tensor, Tuple[torch.Tensor]]]]:
+        """`get_intermediate_layers` of inputs of different sizes run as one nested batch, with one result per input."""
+        assert not self.chunked_blocks and not self.token_merging, "nested batches need unchunked blocks without token merging"
+        x = [self.prepare_tokens_with_masks(x) for x in x_list]
+        output, total_block_len = [], len(self.blocks)
+        blocks_to_take = range(total_block_len - n, total_block_len) if isinstance(n, int) else n
+        for i, blk in enumerate(self.blocks):
+            x = blk(x)
+            if i in blocks_to_take:
+                output.append(x)
+        assert len(output) == len(blocks_to_take), f"only {len(output)} / {len(blocks_to_take)} blocks found"
+
+        results = []
+        for j in range(len(x_list)):
+            outputs = [self.norm(out[j]) if norm else out[j] for out in output]
+            class_tokens = [out[:, 0] for out in outputs]
+            outputs = [out[:, 1 + self.num_register_tokens:] for out in outputs]
+            results.append(tuple(zip(outputs, class_tokens)) if return_class_token else tuple(outputs))
+        return results
+
     def forward(self, *args, is_training=False, **kwargs):
         ret = self.forward_features(*args, **kwargs)
         if is_training:
@@ -9,9 +9,13 @@
 #   https://github.com/rwightman/pytorch-image-models/tree/master/timm/models/vision_transformer.py
 
 import logging
+from typing import List, Optional, Tuple
+
+import torch
 
 from torch import Tensor
 from torch import nn
+import torch.nn.functional as F
 
 
 logger = logging.getLogger("dinov2")
@@ -50,17 +54,51 @@ class Attention(nn.Module):
         B, N, C = x.shape
         qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
 
-        q, k, v = qkv[0] * self.scale, qkv[1], qkv[2]
-        attn = q @ k.transpose(-2, -1)
-
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
+        q, k, v = qkv[0], qkv[1], qkv[2]
+        # fused kernel, which does not materialize the N x N attention matrix
+        x = F.scaled_dot_product_attention(q, k, v, dropout_p=self.attn_drop.p if self.training else 0.0, scale=self.scale)
+        x = x.transpose(1, 2).reshape(B, N, C)
+        x = self.proj(x)
+        x = self.proj_drop(x)
+        return x
 
-        x = (attn @ v).transpose(1, 2).reshape(B, N, C)
+    def forward_cached_kv(self, x: Tensor, kv_cache: List[Tensor], rows: Optional[Tensor] = None) -> Tensor:
+        """Attention of the tokens `x` at positions `rows` of the sequence to the whole sequence.
+
+        `kv_cache` holds the keys and values of the whole sequence from an earlier pass; the
+        entries at `rows` are replaced by those of `x` in place. With `rows` None, `x` is the
+        whole sequence and the cache is filled.
+        """
+        B, M, C = x.shape
+        qkv = self.qkv(x).reshape(B, M, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
+        q, k, v = qkv[0], qkv[1], qkv[2]
+        if rows is None:
+            kv_cache[:] = [k, v]
+        else:
+            kv_cache[0].index_copy_(2, rows, k.to(kv_cache[0].dtype))
+            kv_cache[1].index_copy_(2, rows, v.to(kv_cache[1].dtype))
+        k_all, v_all = kv_cache
+        x = F.scaled_dot_product_attention(q, k_all.to(q.dtype), v_all.to(q.dtype))
+        x = x.transpose(1, 2).reshape(B, M, C)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x
 
+    def forward_split(self, x: Tensor, shapes: List[Tuple[int, int]]) -> Tensor:
+        """Attention of the tokens of several inputs concatenated in `x` of shape (1, sum(B * N), C).
+
+        `shapes` holds (B, N) of every input, the tokens attend within their own sequence only.
+        """
+        C = x.shape[-1]
+        qkv = self.qkv(x)
+        outputs = []
+        for qkv_i, (B, N) in zip(qkv.split([B * N for B, N in shapes], dim=1), shapes):
+            q, k, v = qkv_i.reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
+            outputs.append(F.scaled_dot_product_attention(q, k, v).transpose(1, 2).reshape(1, B * N, C))
+        x = self.proj(torch.cat(outputs, dim=1))
+        x = self.proj_drop(x)
+        return x
+
 
 class MemEffAttention(Attention):
     def forward(self, x: Tensor, attn_bias=None) -> Tensor:
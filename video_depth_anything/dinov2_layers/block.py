@@ -9,7 +9,7 @@
 #   https://github.com/rwightman/pytorch-image-models/tree/master/timm/layers/patch_embed.py
 
 import logging
-from typing import Callable, List, Any, Tuple, Dict
+from typing import Callable, List, Any, Tuple, Dict, Optional
 
 import torch
 from torch import nn, Tensor
@@ -18,6 +18,7 @@ from .attention import Attention, MemEffAttention
 from .drop_path import DropPath
 from .layer_scale import LayerScale
 from .mlp import Mlp
+from .token_merge import TokenMergeState
 
 
 logger = logging.getLogger("dinov2")
@@ -78,8 +79,13 @@ class Block(nn.Module):
         self.drop_path2 = DropPath(drop_path) if drop_path > 0.0 else nn.Identity()
 
         self.sample_drop_ratio = drop_path
+        # part of the patch tokens merged before this block when token merging is on
+        self.merge_ratio = 0.0
+
+    def forward(self, x: Tensor, merge_state: Optional[TokenMergeState] = None) -> Tensor:
+        if merge_state is not None and self.merge_ratio > 0:
+            x = merge_state.merge(x, self.merge_ratio)
 
-    def forward(self, x: Tensor) -> Tensor:
         def attn_residual_func(x: Tensor) -> Tensor:
             return self.ls1(self.attn(self.norm1(x)))
 
@@ -106,6 +112,12 @@ class Block(nn.Module):
             x = x + ffn_residual_func(x)
         return x
 
+    def forward_cached_kv(self, x: Tensor, kv_cache: List[Tensor], rows: Optional[Tensor] = None) -> Tensor:
+        """Inference of the tokens at positions `rows` only, see `Attention.forward_cached_kv`."""
+        x = x + self.ls1(self.attn.forward_cached_kv(self.norm1(x), kv_cache, rows))
+        x = x + self.ls2(self.mlp(self.norm2(x)))
+        return x
+
 
 def drop_add_residual_stochastic_depth(
     x: Tensor,
@@ -242,11 +254,24 @@ class NestedTensorBlock(Block):
             x = x + ffn_residual_func(x)
             return attn_bias.split(x)
 
-    def forward(self, x_or_x_list):
+    def forward_nested_split(self, x_list: List[Tensor]) -> List[Tensor]:
+        """
+        forward_nested without xFormers: the token-wise layers run on all tensors concatenated,
+        the attention on each tensor of x_list separately
+        """
+        assert not (self.training and self.sample_drop_ratio > 0.0), "stochastic depth on nested tensors needs xFormers"
+        shapes = [(x.shape[0], x.shape[1]) for x in x_list]
+        x = torch.cat([x.reshape(1, -1, x.shape[-1]) for x in x_list], dim=1)
+        x = x + self.ls1(self.attn.forward_split(self.norm1(x), shapes))
+        x = x + self.ls2(self.mlp(self.norm2(x)))
+        return [x_i.view_as(x_in) for x_i, x_in in zip(x.split([B * N for B, N in shapes], dim=1), x_list)]
+
+    def forward(self, x_or_x_list, merge_state: Optional[TokenMergeState] = None):
         if isinstance(x_or_x_list, Tensor):
-            return super().forward(x_or_x_list)
+            return super().forward(x_or_x_list, merge_state)
         elif isinstance(x_or_x_list, list):
-            assert XFORMERS_AVAILABLE, "Please install xFormers for nested tensors usage"
+            if not XFORMERS_AVAILABLE:
+                return self.forward_nested_split(x_or_x_list)
             return self.forward_nested(x_or_x_list)
         else:
             raise AssertionError
@@ -0,0 +1,74 @@
+# References:
+#   Token Merging: Your ViT But Faster, https://github.com/facebookresearch/ToMe
+
+import torch
+from torch import Tensor
+
+
+class TokenMergeState:
+    """Bookkeeping of token merging across the blocks of one forward pass.
+
+    `positions[b, j]` is the index of the token that the j-th token of the full grid has been
+    merged into, and `size` counts the original tokens in every current token. The prefix
+    tokens (class and register tokens) are never merged.
+    """
+
+    def __init__(self, x: Tensor, num_prefix_tokens: int) -> None:
+        B, N, _ = x.shape
+        self.num_prefix_tokens = num_prefix_tokens
+        self.positions = torch.arange(N, device=x.device).expand(B, N)
+        self.size = torch.ones(B, N, 1, device=x.device, dtype=x.dtype)
+
+    def merge(self, x: Tensor, ratio: float) -> Tensor:
+        """Merge the `ratio` most redundant part of the patch tokens of `x` (at most half of them).
+
+        ToMe bipartite soft matching: the patch tokens are split into alternating sets A and B,
+        every token of A is matched to its most similar token of B by cosine similarity, and the
+        best matched tokens of A are merged into their match as a size-weighted average.
+        """
+        P = self.num_prefix_tokens
+        B, N, C = x.shape
+        num_a = (N - P + 1) // 2
+        r = min(int((N - P) * ratio), num_a)
+        if r <= 0:
+            return x
+
+        with torch.no_grad():
+            metric = x[:, P:] / x[:, P:].norm(dim=-1, keepdim=True)
+            scores = metric[:, 0::2] @ metric[:, 1::2].transpose(-1, -2)
+            node_max, node_idx = scores.max(dim=-1)
+            edge_idx = node_max.argsort(dim=-1, descending=True)[..., None]
+            unm_idx = edge_idx[:, r:]
+            src_idx = edge_idx[:, :r]
+            dst_idx = node_idx[..., None].gather(dim=1, index=src_idx)
+
+        def merge_wavg(t: Tensor) -> Tensor:
+            prefix, a, b = t[:, :P], t[:, P:][:, 0::2], t[:, P:][:, 1::2]
+            c = t.shape[-1]
+            unm = a.gather(dim=1, index=unm_idx.expand(-1, -1, c))
+            src = a.gather(dim=1, index=src_idx.expand(-1, -1, c))
+            b = b.scatter_reduce(1, dst_idx.expand(-1, -1, c), src, reduce="sum")
+            return torch.cat([prefix, unm, b], dim=1)
+
+        size = self.size.to(x.dtype)
+        x = merge_wavg(x * size)
+        size = merge_wavg(size)
+        self.size = size
+
+        # new index of every current token: prefix, then the unmerged A tokens, then the B tokens
+        num_unm = num_a - r
+        a_positions = torch.empty(B, num_a, dtype=torch.long, device=x.device)
+        a_positions.scatter_(1, unm_idx[..., 0], torch.arange(P, P + num_unm, device=x.device).expand(B, -1))
+        a_positions.scatter_(1, src_idx[..., 0], P + num_unm + dst_idx[..., 0])
+        b_positions = torch.arange(P + num_unm, N - r, device=x.device).expand(B, -1)
+        new_positions = torch.empty(B, N, dtype=torch.long, device=x.device)
+        new_positions[:, :P] = torch.arange(P, device=x.device)
+        new_positions[:, P:][:, 0::2] = a_positions
+        new_positions[:, P:][:, 1::2] = b_positions
+        self.positions = new_positions.gather(dim=1, index=self.positions)
+
+        return x / size
+
+    def unmerge(self, x: Tensor) -> Tensor:
+        """Restore the full token grid, every original token takes the value of its merged token."""
+        return x.gather(dim=1, index=self.positions[..., None].expand(-1, -1, x.shape[-1]))
@@ -16,7 +16,9 @@ import torch.nn.functional as F
 import torch.nn as nn
 from .dpt import DPTHead
 from .motion_module.motion_module import TemporalModule
+from .util.precision import float32_island
 from easydict import EasyDict
+from functools import partial
 
 
 class DPTHeadTemporal(DPTHead):
@@ -50,76 +52,97 @@ class DPTHeadTemporal(DPTHead):
                            **motion_module_kwargs)
         ])
 
-    def forward(self, out_features, patch_h, patch_w, frame_length, micro_batch_size=4, cached_hidden_state_list=None):
+    def forward(self, out_features, patch_h, patch_w, frame_length, micro_batch_size=4, cached_hidden_state_list=None, attention_mask=None, position_ids=None,
+                return_hidden_states=True):
+        """
+        micro_batch_size is the number of frames that run together through refinenet2, refinenet1 and
+        the output convolutions, or a dict with a size for each of the stages 'project' (readout
+        projections and resize layers), 'motion' (spatial positions of the motion modules, which
+        always see all frames), 'refine' (refinenet4 and refinenet3) and 'output' (the former), see
+        `util.memory.micro_batch_sizes`. None or a missing stage runs the stage at once.
+
+        return_hidden_states=False returns an empty list instead of the motion module inputs that the
+        streaming model caches, so that they are not kept alive until the end.
+        """
+        if not isinstance(micro_batch_size, dict):
+            micro_batch_size = {'output': micro_batch_size}
+
+        # every intermediate is released as soon as nothing downstream needs it; if out_features is
+        # a list, the encoder outputs are dropped from it once projected
         out = []
-        for i, x in enumerate(out_features):
-            if self.use_clstoken:
-                x, cls_token = x[0], x[1]
-                readout = cls_token.unsqueeze(1).expand_as(x)
-                x = self.readout_projects[i](torch.cat((x, readout), -1))
-            else:
-                x = x[0]
-
-            x = x.permute(0, 2, 1).reshape((x.shape[0], x.shape[-1], patch_h, patch_w)).contiguous()
-
-            B, T = x.shape[0] // frame_length, frame_length
-            x = self.projects[i](x)
-            x = self.resize_layers[i](x)
-
-            out.append(x)
+        for i in range(len(out_features)):
+            out.append(micro_batched(partial(self.project_layer, i, patch_h=patch_h, patch_w=patch_w), micro_batch_size.get('project'), *out_features[i]))
+            if isinstance(out_features, list):
+                out_features[i] = None
 
         layer_1, layer_2, layer_3, layer_4 = out
+        del out
 
         B, T = layer_1.shape[0] // frame_length, frame_length
         if cached_hidden_state_list is not None:
             N = len(cached_hidden_state_list) // len(self.motion_modules)
         else:
             N = 0
+        hidden_state_list = []
 
-        layer_3, h0 = self.motion_modules[0](layer_3.unflatten(0, (B, T)).permute(0, 2, 1, 3, 4), None, None, cached_hidden_state_list[0:N] if N else None)
+        layer_3, h = self.motion_modules[0](layer_3.unflatten(0, (B, T)).permute(0, 2, 1, 3, 4), None, attention_mask, cached_hidden_state_list[0:N] if N else None, position_ids,
+                                             micro_batch_size.get('motion'))
+        hidden_state_list += h if return_hidden_states else []
         layer_3 = layer_3.permute(0, 2, 1, 3, 4).flatten(0, 1)
-        layer_4, h1 = self.motion_modules[1](layer_4.unflatten(0, (B, T)).permute(0, 2, 1, 3, 4), None, None, cached_hidden_state_list[N:2*N] if N else None)
+        layer_4, h = self.motion_modules[1](layer_4.unflatten(0, (B, T)).permute(0, 2, 1, 3, 4), None, attention_mask, cached_hidden_state_list[N:2*N] if N else None, position_ids,
+                                             micro_batch_size.get('motion'))
+        hidden_state_list += h if return_hidden_states else []
         layer_4 = layer_4.permute(0, 2, 1, 3, 4).flatten(0, 1)
 
         layer_1_rn = self.scratch.layer1_rn(layer_1)
         layer_2_rn = self.scratch.layer2_rn(layer_2)
         layer_3_rn = self.scratch.layer3_rn(layer_3)
         layer_4_rn = self.scratch.layer4_rn(layer_4)
+        del layer_1, layer_2, layer_3, layer_4
 
-        path_4 = self.scratch.refinenet4(layer_4_rn, size=layer_3_rn.shape[2:])
-        path_4, h2 = self.motion_modules[2](path_4.unflatten(0, (B, T)).permute(0, 2, 1, 3, 4), None, None, cached_hidden_state_list[2*N:3*N] if N else None)
+        path_4 = micro_batched(partial(self.scratch.refinenet4, size=layer_3_rn.shape[2:]), micro_batch_size.get('refine'), layer_4_rn)
+        del layer_4_rn
+        path_4, h = self.motion_modules[2](path_4.unflatten(0, (B, T)).permute(0, 2, 1, 3, 4), None, attention_mask, cached_hidden_state_list[2*N:3*N] if N else None, position_ids,
+                                            micro_batch_size.get('motion'))
+        hidden_state_list += h if return_hidden_states else []
         path_4 = path_4.permute(0, 2, 1, 3, 4).flatten(0, 1)
-        path_3 = self.scratch.refinenet3(path_4, layer_3_rn, size=layer_2_rn.shape[2:])
-        path_3, h3 = self.motion_modules[3](path_3.unflatten(0, (B, T)).permute(0, 2, 1, 3, 4), None, None, cached_hidden_state_list[3*N:] if N else None)
+        path_3 = micro_batched(partial(self.scratch.refinenet3, size=layer_2_rn.shape[2:]), micro_batch_size.get('refine'), path_4, layer_3_rn)
+        del path_4, layer_3_rn
+        path_3, h = self.motion_modules[3](path_3.unflatten(0, (B, T)).permute(0, 2, 1, 3, 4), None, attention_mask, cached_hidden_state_list[3*N:] if N else None, position_ids,
+                                            micro_batch_size.get('motion'))
+        hidden_state_list += h if return_hidden_states else []
+        del h
         path_3 = path_3.permute(0, 2, 1, 3, 4).flatten(0, 1)
 
-        batch_size = layer_1_rn.shape[0]
-        if batch_size <= micro_batch_size or batch_size % micro_batch_size != 0:
-            path_2 = self.scratch.refinenet2(path_3, layer_2_rn, size=layer_1_rn.shape[2:])
-            path_1 = self.scratch.refinenet1(path_2, layer_1_rn)
-
-            out = self.scratch.output_conv1(path_1)
-            out = F.interpolate(
-                out, (int(patch_h * 14), int(patch_w * 14)), mode="bilinear", align_corners=True
-            )
-            ori_type = out.dtype
-            with torch.autocast(device_type="cuda", enabled=False):
-                out = self.scratch.output_conv2(out.float())
-
-            output = out.to(ori_type) 
-        else:
-            ret = []
-            for i in range(0, batch_size, micro_batch_size):
-                path_2 = self.scratch.refinenet2(path_3[i:i + micro_batch_size], layer_2_rn[i:i + micro_batch_size], size=layer_1_rn[i:i + micro_batch_size].shape[2:])
-                path_1 = self.scratch.refinenet1(path_2, layer_1_rn[i:i + micro_batch_size])
-                out = self.scratch.output_conv1(path_1)
-                out = F.interpolate(
-                    out, (int(patch_h * 14), int(patch_w * 14)), mode="bilinear", align_corners=True
-                )
-                ori_type = out.dtype
-                with torch.autocast(device_type="cuda", enabled=False):
-                    out = self.scratch.output_conv2(out.float())
-                ret.append(out.to(ori_type))
-            output = torch.cat(ret, dim=0)
-        
-        return output, h0 + h1 + h2 + h3
+        output = micro_batched(partial(self.forward_output, patch_h=patch_h, patch_w=patch_w), micro_batch_size.get('output'), path_3, layer_2_rn, layer_1_rn)
+
+        return output, hidden_state_list
+
+    def project_layer(self, i, x, cls_token, patch_h, patch_w):
+        if self.use_clstoken:
+            readout = cls_token.unsqueeze(1).expand_as(x)
+            x = self.readout_projects[i](torch.cat((x, readout), -1))
+
+        x = x.permute(0, 2, 1).reshape((x.shape[0], x.shape[-1], patch_h, patch_w)).contiguous()
+        x = self.projects[i](x)
+        return self.resize_layers[i](x)
+
+    def forward_output(self, path_3, layer_2_rn, layer_1_rn, patch_h, patch_w):
+        path_2 = self.scratch.refinenet2(path_3, layer_2_rn, size=layer_1_rn.shape[2:])
+        path_1 = self.scratch.refinenet1(path_2, layer_1_rn)
+        out = self.scratch.output_conv1(path_1)
+        out = F.interpolate(
+            out, (int(patch_h * 14), int(patch_w * 14)), mode="bilinear", align_corners=True
+        )
+        ori_type = out.dtype
+        with float32_island(out):
+            out = self.scratch.output_conv2(out.float())
+        return out.to(ori_type)
+
+
+def micro_batched(func, micro_batch_size, *inputs):
+    """Run `func` on slices of at most `micro_batch_size` along the first dim of `inputs` and concatenate the results."""
+    batch_size = inputs[0].shape[0]
+    if micro_batch_size is None or batch_size <= micro_batch_size:
+        return func(*inputs)
+    return torch.cat([func(*(x[i:i + micro_batch_size] for x in inputs)) for i in range(0, batch_size, micro_batch_size)], dim=0)
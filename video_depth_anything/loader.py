@@ -0,0 +1,120 @@
+# Copyright (2025) Bytedance Ltd. and/or its affiliates
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+
+import torch
+
+try:
+    from safetensors.torch import load_file as load_safetensors
+
+    SAFETENSORS_AVAILABLE = True
+except ImportError:
+    SAFETENSORS_AVAILABLE = False
+
+from .compile import DEFAULT_CACHE_DIR, compile_model
+from .optimize import optimize_for_inference
+from .quantization import quantize_model
+from .util.weight_stream import stream_weights as stream_model_weights
+from .workers import share_weights, single_threaded
+
+MODEL_CONFIGS = {
+    'vits': {'encoder': 'vits', 'features': 64, 'out_channels': [48, 96, 192, 384]},
+    'vitb': {'encoder': 'vitb', 'features': 128, 'out_channels': [96, 192, 384, 768]},
+    'vitl': {'encoder': 'vitl', 'features': 256, 'out_channels': [256, 512, 1024, 1024]},
+}
+
+
+def checkpoint_path(encoder, metric=False, checkpoint_dir='./checkpoints'):
+    """Path of the checkpoint, a .safetensors file next to the .pth one is preferred if safetensors is installed."""
+    checkpoint_name = 'metric_video_depth_anything' if metric else 'video_depth_anything'
+    path = os.path.join(checkpoint_dir, f'{checkpoint_name}_{encoder}')
+    if SAFETENSORS_AVAILABLE and os.path.exists(path + '.safetensors'):
+        return path + '.safetensors'
+    return path + '.pth'
+
+
+def load_checkpoint(path):
+    """Load a state dict memory-mapped, so that tensors are paged in from the file instead of read and copied."""
+    if path.endswith('.safetensors'):
+        return load_safetensors(path, device='cpu')
+    try:
+        return torch.load(path, map_location='cpu', mmap=True)
+    except RuntimeError:
+        # checkpoints in the legacy (non-zip) format cannot be memory-mapped
+        return torch.load(path, map_location='cpu')
+
+
+def build_model(encoder='vitl', metric=False, streaming=False):
+    """Build a `VideoDepthAnything` without weights on the meta device.
+
+    Nothing is allocated or initialized, the parameters have to be assigned with
+    `load_state_dict(..., assign=True)`.
+    """
+    with torch.device('meta'):
+        if streaming:
+            from .video_depth_stream import VideoDepthAnything
+            return VideoDepthAnything(**MODEL_CONFIGS[encoder])
+        from .video_depth import VideoDepthAnything
+        return VideoDepthAnything(**MODEL_CONFIGS[encoder], metric=metric)
+
+
+def load_model(encoder='vitl', metric=False, streaming=False, checkpoint_dir='./checkpoints', device='cuda', quantize=None,
+               compiled=False, compile_cache_dir=DEFAULT_CACHE_DIR, optimize=False, stream_weights=False, share_memory=False):
+    """Build a `VideoDepthAnything`, load its checkpoint and move it to `device` in eval mode.
+
+    The model is built on the meta device and the memory-mapped checkpoint tensors are assigned
+    to it directly, which skips the random initialization and the copy of every weight.
+
+    Args:
+        streaming (bool): build the streaming model of video_depth_stream instead of the offline one
+        quantize (str): None, or 'int8-dynamic' to quantize the transformer Linear layers for CPU
+            inference (see `quantization.quantize_model`); the model then has to run on CPU with precision='fp32'
+        compiled (bool): compile the forward passes with torch.compile and bucket the input sizes,
+            with the compile cache in `compile_cache_dir` (see `compile.compile_model`)
+        optimize (bool): fold and fuse layers for inference before quantization and compilation
+            (see `optimize.optimize_for_inference`)
+        stream_weights (bool): keep the weights of the DINOv2 blocks and the DPT head memory-mapped
+            and page them in per block while they run, for hosts with little RAM (see
+            `util.weight_stream.WeightStreamer`); CPU only, without quantize, optimize or compiled
+        share_memory (bool): load on one thread and move the weights to shared memory, for
+            worker processes forked afterwards (see `workers.fork_workers`); CPU only, without stream_weights
+    """
+    if stream_weights and (torch.device(device).type != 'cpu' or quantize is not None or optimize or compiled):
+        raise ValueError("stream_weights needs the unmodified memory-mapped weights on CPU, without quantize, optimize or compiled")
+    if share_memory and (torch.device(device).type != 'cpu' or stream_weights):
+        raise ValueError("share_memory is for forked CPU workers, without stream_weights")
+    if share_memory:
+        with single_threaded():
+            return share_weights(load_model(encoder, metric=metric, streaming=streaming, checkpoint_dir=checkpoint_dir, device=device,
+                                            quantize=quantize, compiled=compiled, compile_cache_dir=compile_cache_dir, optimize=optimize))
+
+    model = build_model(encoder, metric=metric, streaming=streaming)
+    model.load_state_dict(load_checkpoint(checkpoint_path(encoder, metric, checkpoint_dir)), strict=True, assign=True)
+    model = model.eval()
+    if optimize:
+        model = optimize_for_inference(model)
+
+    if quantize is not None:
+        if torch.device(device).type != 'cpu':
+            raise ValueError(f"quantize={quantize} runs on CPU only, got device {device}")
+        model = quantize_model(model, quantize)
+    else:
+        model = model.to(device)
+
+    if stream_weights:
+        model = stream_model_weights(model)
+
+    if compiled:
+        model = compile_model(model, cache_dir=compile_cache_dir)
+    return model
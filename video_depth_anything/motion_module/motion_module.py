@@ -10,6 +10,7 @@ from torch import nn
 from .attention import CrossAttention, FeedForward, apply_rotary_emb, precompute_freqs_cis
 
 from einops import rearrange, repeat
+from ..util.lru import LRUCache
 import math
 
 try:
@@ -57,9 +58,10 @@ class TemporalModule(nn.Module):
         if zero_initialize:
             self.temporal_transformer.proj_out = zero_module(self.temporal_transformer.proj_out)
 
-    def forward(self, input_tensor, encoder_hidden_states, attention_mask=None, cached_hidden_state_list=None):
+    def forward(self, input_tensor, encoder_hidden_states, attention_mask=None, cached_hidden_state_list=None, position_ids=None, micro_batch_size=None):
         hidden_states = input_tensor
-        hidden_states, output_hidden_state_list = self.temporal_transformer(hidden_states, encoder_hidden_states, attention_mask, cached_hidden_state_list)
+        hidden_states, output_hidden_state_list = self.temporal_transformer(hidden_states, encoder_hidden_states, attention_mask, cached_hidden_state_list, position_ids,
+                                                                            micro_batch_size)
 
         output = hidden_states
         return output, output_hidden_state_list  # list of hidden states
@@ -99,7 +101,11 @@ class TemporalTransformer3DModel(nn.Module):
         )
         self.proj_out = nn.Linear(inner_dim, in_channels)
 
-    def forward(self, hidden_states, encoder_hidden_states=None, attention_mask=None, cached_hidden_state_list=None):
+    def forward(self, hidden_states, encoder_hidden_states=None, attention_mask=None, cached_hidden_state_list=None, position_ids=None, micro_batch_size=None):
+        """
+        micro_batch_size: run the transformer blocks on at most this many spatial positions at a time.
+        The blocks attend along time only, so the result is the same with a lower peak memory.
+        """
         assert hidden_states.dim() == 5, f"Expected hidden_states to have ndim=5, but got ndim={hidden_states.dim()}."
         output_hidden_state_list = []
 
@@ -115,14 +121,21 @@ class TemporalTransformer3DModel(nn.Module):
         hidden_states = self.proj_in(hidden_states)
 
         # Transformer Blocks
-        if cached_hidden_state_list is not None:
-            n = len(cached_hidden_state_list) // len(self.transformer_blocks)
+        if micro_batch_size is None or height * width <= micro_batch_size:
+            hidden_states, output_hidden_state_list = self._forward_blocks(hidden_states, encoder_hidden_states, video_length, attention_mask,
+                                                                           cached_hidden_state_list, position_ids)
         else:
-            n = 0
-        for i, block in enumerate(self.transformer_blocks):
-            hidden_states, hidden_state_list = block(hidden_states, encoder_hidden_states=encoder_hidden_states, video_length=video_length, attention_mask=attention_mask,
-                                                     cached_hidden_state_list=cached_hidden_state_list[i*n:(i+1)*n] if n else None)
-            output_hidden_state_list.extend(hidden_state_list)
+            # hidden states of the blocks are laid out as (b d) f c, slice and join them along the positions d
+            b = batch // video_length
+            slices = []
+            for i in range(0, height * width, micro_batch_size):
+                cached_slice = [c.unflatten(0, (b, -1))[:, i:i + micro_batch_size].flatten(0, 1) for c in cached_hidden_state_list] \
+                    if cached_hidden_state_list is not None else None
+                slices.append(self._forward_blocks(hidden_states[:, i:i + micro_batch_size], encoder_hidden_states, video_length, attention_mask,
+                                                   cached_slice, position_ids))
+            hidden_states = torch.cat([h for h, _ in slices], dim=1)
+            output_hidden_state_list = [torch.cat([h_list[k].unflatten(0, (b, -1)) for _, h_list in slices], dim=1).flatten(0, 1)
+                                        for k in range(len(slices[0][1]))]
 
         # output
         hidden_states = self.proj_out(hidden_states)
@@ -133,6 +146,18 @@ class TemporalTransformer3DModel(nn.Module):
 
         return output, output_hidden_state_list
 
+    def _forward_blocks(self, hidden_states, encoder_hidden_states, video_length, attention_mask, cached_hidden_state_list, position_ids):
+        output_hidden_state_list = []
+        if cached_hidden_state_list is not None:
+            n = len(cached_hidden_state_list) // len(self.transformer_blocks)
+        else:
+            n = 0
+        for i, block in enumerate(self.transformer_blocks):
+            hidden_states, hidden_state_list = block(hidden_states, encoder_hidden_states=encoder_hidden_states, video_length=video_length, attention_mask=attention_mask,
+                                                     cached_hidden_state_list=cached_hidden_state_list[i*n:(i+1)*n] if n else None, position_ids=position_ids)
+            output_hidden_state_list.extend(hidden_state_list)
+        return hidden_states, output_hidden_state_list
+
 
 class TemporalTransformerBlock(nn.Module):
     def __init__(
@@ -169,7 +194,7 @@ class TemporalTransformerBlock(nn.Module):
         self.ff_norm = nn.LayerNorm(dim)
 
 
-    def forward(self, hidden_states, encoder_hidden_states=None, attention_mask=None, video_length=None, cached_hidden_state_list=None):
+    def forward(self, hidden_states, encoder_hidden_states=None, attention_mask=None, video_length=None, cached_hidden_state_list=None, position_ids=None):
         output_hidden_state_list = []
         for i, (attention_block, norm) in enumerate(zip(self.attention_blocks, self.norms)):
             norm_hidden_states = norm(hidden_states)
@@ -179,6 +204,7 @@ class TemporalTransformerBlock(nn.Module):
                 video_length=video_length,
                 attention_mask=attention_mask,
                 cached_hidden_states=cached_hidden_state_list[i] if cached_hidden_state_list is not None else None,
+                position_ids=position_ids,
             )
             hidden_states = residual_hidden_states + hidden_states
             output_hidden_state_list.append(output_hidden_states)
@@ -204,9 +230,11 @@ class PositionalEncoding(nn.Module):
         pe[0, :, 0::2] = torch.sin(position * div_term)
         pe[0, :, 1::2] = torch.cos(position * div_term)
         self.register_buffer('pe', pe)
+        self.pe_cache = LRUCache()
 
     def forward(self, x):
-        x = x + self.pe[:, :x.size(1)].to(x.dtype)
+        pe = self.pe_cache.get((x.size(1), x.dtype, x.device, self.pe.data_ptr(), self.pe._version), lambda: self.pe[:, :x.size(1)].to(x.dtype))
+        x = x + pe
         return self.dropout(x)
 
 class TemporalAttention(CrossAttention):
@@ -223,6 +251,7 @@ class TemporalAttention(CrossAttention):
 
         self.pos_encoder = None
         self.freqs_cis = None
+        self.to_qkv = None
         if self.pos_embedding_type == "ape":
             self.pos_encoder = PositionalEncoding(
                 kwargs["query_dim"],
@@ -235,14 +264,23 @@ class TemporalAttention(CrossAttention):
                 kwargs["query_dim"],
                 temporal_max_len
             )
+            self.freqs_cis_cache = LRUCache()
 
         else:
             raise NotImplementedError
 
-    def forward(self, hidden_states, encoder_hidden_states=None, attention_mask=None, video_length=None, cached_hidden_states=None):
+    def forward(self, hidden_states, encoder_hidden_states=None, attention_mask=None, video_length=None, cached_hidden_states=None, position_ids=None):
+        """
+        attention_mask: optional bool mask of shape (f_q, f_k), True where a query frame may attend to a
+        key frame. With cached_hidden_states, f_q is the number of new frames and f_k the number of cached
+        plus new frames; position_ids (f_q, f_k) then gives the temporal position of every key frame in
+        the window of every query frame, so that several frames can be stepped at once against the cache.
+        """
         # TODO: support cache for these
         assert encoder_hidden_states is None
-        assert attention_mask is None
+
+        if attention_mask is not None and cached_hidden_states is not None:
+            return self._forward_cached_masked(hidden_states, attention_mask, position_ids, video_length, cached_hidden_states)
 
         d = hidden_states.shape[1]
         d_in = 0
@@ -263,29 +301,29 @@ class TemporalAttention(CrossAttention):
         if self.group_norm is not None:
             hidden_states = self.group_norm(hidden_states.transpose(1, 2)).transpose(1, 2)
 
-        query = self.to_q(hidden_states[:, d_in:, ...])
-        dim = query.shape[-1]
-
         if self.added_kv_proj_dim is not None:
             raise NotImplementedError
 
-        encoder_hidden_states = encoder_hidden_states if encoder_hidden_states is not None else hidden_states
-        key = self.to_k(encoder_hidden_states)
-        value = self.to_v(encoder_hidden_states)
+        if self.to_qkv is not None and d_in == 0 and encoder_hidden_states is None:
+            # packed projection of optimize_for_inference, one GEMM instead of three
+            query, key, value = self.to_qkv(hidden_states).chunk(3, dim=-1)
+        else:
+            query = self.to_q(hidden_states[:, d_in:, ...])
+            encoder_hidden_states = encoder_hidden_states if encoder_hidden_states is not None else hidden_states
+            key = self.to_k(encoder_hidden_states)
+            value = self.to_v(encoder_hidden_states)
+        dim = query.shape[-1]
 
         if self.freqs_cis is not None:
             seq_len = query.shape[1]
-            freqs_cis = self.freqs_cis[:seq_len].to(query.device)
+            freqs_cis = self.freqs_cis_cache.get((seq_len, query.device), lambda: self.freqs_cis[:seq_len].to(query.device))
             query, key = apply_rotary_emb(query, key, freqs_cis)
 
         if attention_mask is not None:
-            if attention_mask.shape[-1] != query.shape[1]:
-                target_length = query.shape[1]
-                attention_mask = F.pad(attention_mask, (0, target_length), value=0.0)
-                attention_mask = attention_mask.repeat_interleave(self.heads, dim=0)
-
+            # additive mask broadcast over (b d) and heads, only supported by the plain attention path
+            attention_mask = torch.zeros(attention_mask.shape, dtype=query.dtype, device=query.device).masked_fill(~attention_mask, float("-inf"))
 
-        use_memory_efficient = XFORMERS_AVAILABLE and self._use_memory_efficient_attention_xformers
+        use_memory_efficient = XFORMERS_AVAILABLE and self._use_memory_efficient_attention_xformers and attention_mask is None
         if use_memory_efficient and (dim // self.heads) % 8 != 0:
             # print('Warning: the dim {} cannot be divided by 8. Fall into normal attention'.format(dim // self.heads))
             use_memory_efficient = False
@@ -319,3 +357,50 @@ class TemporalAttention(CrossAttention):
         hidden_states = rearrange(hidden_states, "(b d) f c -> (b f) d c", d=d)
 
         return hidden_states, input_hidden_states
+
+    def _forward_cached_masked(self, hidden_states, attention_mask, position_ids, video_length, cached_hidden_states):
+        if self.pos_encoder is None or self.group_norm is not None:
+            raise NotImplementedError
+
+        d = hidden_states.shape[1]
+        hidden_states = rearrange(hidden_states, "(b f) d c -> (b d) f c", f=video_length)
+        input_hidden_states = hidden_states
+        d_in = cached_hidden_states.shape[1]
+        hidden_states = torch.cat([cached_hidden_states, hidden_states], dim=1)
+
+        # Every query frame sees the key frames at its own window positions. The projections are linear,
+        # so to_k(h + pe[p]) = to_k(h) + to_k(pe[p]): project the frames once, and add the projected
+        # positional encodings per (query, key) pair inside the attention instead of re-projecting windows.
+        pe = self.pos_encoder.pe[0].to(hidden_states.dtype)
+        self_position_ids = position_ids[:, d_in:].diagonal()
+        query = self.to_q(input_hidden_states + pe[self_position_ids])
+        key = self.to_k(hidden_states)
+        value = self.to_v(hidden_states)
+        # to_k and to_v have no bias; calling the layers keeps this working for quantized ones
+        key_pe = self.to_k(pe)[position_ids]
+        value_pe = self.to_v(pe)[position_ids]
+
+        query = query.unflatten(-1, (self.heads, -1))
+        key = key.unflatten(-1, (self.heads, -1))
+        value = value.unflatten(-1, (self.heads, -1))
+        key_pe = key_pe.unflatten(-1, (self.heads, -1))
+        value_pe = value_pe.unflatten(-1, (self.heads, -1))
+
+        attention_scores = torch.einsum("bqhc,bkhc->bhqk", query, key) + torch.einsum("bqhc,qkhc->bhqk", query, key_pe)
+        attention_scores = (attention_scores * self.scale).masked_fill(~attention_mask, float("-inf"))
+        if self.upcast_softmax:
+            attention_scores = attention_scores.float()
+        attention_probs = attention_scores.softmax(dim=-1).to(value.dtype)
+
+        hidden_states = torch.einsum("bhqk,bkhc->bqhc", attention_probs, value) + torch.einsum("bhqk,qkhc->bqhc", attention_probs, value_pe)
+        hidden_states = hidden_states.flatten(-2)
+
+        # linear proj
+        hidden_states = self.to_out[0](hidden_states)
+
+        # dropout
+        hidden_states = self.to_out[1](hidden_states)
+
+        hidden_states = rearrange(hidden_states, "(b d) f c -> (b f) d c", d=d)
+
+        return hidden_states, input_hidden_states
@@ -0,0 +1,110 @@
+# Copyright (2025) Bytedance Ltd. and/or its affiliates
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import torch
+import torch.nn as nn
+
+from .dinov2_layers.block import Block
+from .dinov2_layers.layer_scale import LayerScale
+from .motion_module.motion_module import TemporalAttention, TemporalTransformer3DModel
+
+IMAGE_MEAN = (0.485, 0.456, 0.406)
+IMAGE_STD = (0.229, 0.224, 0.225)
+
+
+def fold_input_normalization(model):
+    """Fold the ImageNet mean/std normalization of the input into the patch embedding convolution.
+
+    The convolution has stride == kernel size and no padding, so it is exact, and the transforms
+    of the model then only scale the frames to [0, 1].
+    """
+    if not model.normalize_input:
+        return
+    proj = model.pretrained.patch_embed.proj
+    mean = torch.tensor(IMAGE_MEAN, dtype=proj.weight.dtype, device=proj.weight.device)
+    std = torch.tensor(IMAGE_STD, dtype=proj.weight.dtype, device=proj.weight.device)
+    weight = proj.weight / std[None, :, None, None]
+    proj.bias.sub_((weight * mean[None, :, None, None]).sum(dim=(1, 2, 3)))
+    proj.weight.copy_(weight)
+    model.normalize_input = False
+
+
+def fold_layer_scale(model):
+    """Fold the LayerScale gammas of the DINOv2 blocks into `attn.proj` and `mlp.fc2`."""
+    for block in model.modules():
+        if not isinstance(block, Block):
+            continue
+        for ls_name, linear in (('ls1', block.attn.proj), ('ls2', getattr(block.mlp, 'fc2', None))):
+            ls = getattr(block, ls_name)
+            # quantized Linears keep packed weights, they are left as they are
+            if not isinstance(ls, LayerScale) or type(linear) is not nn.Linear:
+                continue
+            linear.weight.mul_(ls.gamma[:, None])
+            if linear.bias is not None:
+                linear.bias.mul_(ls.gamma)
+            setattr(block, ls_name, nn.Identity())
+
+
+def pack_temporal_qkv(model):
+    """Give every TemporalAttention a packed `to_qkv` Linear; `to_q/k/v` become views of its weight."""
+    for attention in model.modules():
+        if not isinstance(attention, TemporalAttention) or attention.to_qkv is not None:
+            continue
+        linears = (attention.to_q, attention.to_k, attention.to_v)
+        if any(type(linear) is not nn.Linear for linear in linears):
+            continue
+        weight = torch.cat([linear.weight for linear in linears])
+        bias = torch.cat([linear.bias for linear in linears]) if attention.to_q.bias is not None else None
+        to_qkv = nn.Linear(weight.shape[1], weight.shape[0], bias=bias is not None, device=weight.device, dtype=weight.dtype)
+        to_qkv.weight = nn.Parameter(weight, requires_grad=False)
+        if bias is not None:
+            to_qkv.bias = nn.Parameter(bias, requires_grad=False)
+        for i, linear in enumerate(linears):
+            rows = slice(i * linear.out_features, (i + 1) * linear.out_features)
+            linear.weight = nn.Parameter(weight[rows], requires_grad=False)
+            if bias is not None:
+                linear.bias = nn.Parameter(bias[rows], requires_grad=False)
+        attention.to_qkv = to_qkv
+
+
+def fold_group_norm_affine(model):
+    """Fold the affine part of the GroupNorm of every motion module into the `proj_in` Linear after it."""
+    for transformer in model.modules():
+        if not isinstance(transformer, TemporalTransformer3DModel):
+            continue
+        norm, proj_in = transformer.norm, transformer.proj_in
+        if not norm.affine or type(proj_in) is not nn.Linear:
+            continue
+        proj_in.bias.add_(proj_in.weight @ norm.bias)
+        proj_in.weight.mul_(norm.weight[None, :])
+        transformer.norm = nn.GroupNorm(norm.num_groups, norm.num_channels, eps=norm.eps, affine=False)
+
+
+def optimize_for_inference(model):
+    """Fold and fuse the layers of a loaded `VideoDepthAnything` for inference, in place, and return it.
+
+    - the input normalization goes into the patch embedding (`fold_input_normalization`)
+    - the LayerScale gammas go into the Linear before them (`fold_layer_scale`)
+    - the q/k/v projections of the motion modules run as one GEMM (`pack_temporal_qkv`)
+    - the GroupNorm affine of the motion modules goes into `proj_in` (`fold_group_norm_affine`)
+
+    The outputs match the original model up to float rounding. Run it before quantization, the
+    folds skip quantized layers. The folded weights no longer match the checkpoint, so do not
+    save the state dict of an optimized model as a checkpoint.
+    """
+    with torch.no_grad():
+        fold_input_normalization(model)
+        fold_layer_scale(model)
+        pack_temporal_qkv(model)
+        fold_group_norm_affine(model)
+    return model
@@ -0,0 +1,119 @@
+# Copyright (2025) Bytedance Ltd. and/or its affiliates
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import concurrent.futures
+import os
+
+import torch
+
+_END = object()
+
+
+def parse_cpu_list(cpu_list):
+    """Cores of a cpu list such as '0-7,16-23'."""
+    cores = []
+    for part in cpu_list.split(','):
+        first, _, last = part.partition('-')
+        cores += range(int(first), int(last or first) + 1)
+    return cores
+
+
+def default_stage_cores(encoder_share=0.5):
+    """Split the cores this process may run on between the encoder and the head stage.
+
+    On a host with several CPU packages (sockets) the stages get whole packages, the encoder
+    the first `encoder_share` of them, so that the activations of a stage stay in its own
+    caches and memory node. Otherwise the cores are split by `encoder_share`. With a single
+    core both stages share it.
+    """
+    cores = sorted(os.sched_getaffinity(0))
+    if len(cores) == 1:
+        return cores, cores
+    packages = {}
+    for core in cores:
+        path = f'/sys/devices/system/cpu/cpu{core}/topology/physical_package_id'
+        package = int(open(path).read()) if os.path.exists(path) else 0
+        packages.setdefault(package, []).append(core)
+    groups = list(packages.values()) if len(packages) > 1 else [[core] for core in cores]
+    split = min(max(round(len(groups) * encoder_share), 1), len(groups) - 1)
+    return [core for group in groups[:split] for core in group], [core for group in groups[split:] for core in group]
+
+
+def pin_thread(cores):
+    """Pin the calling thread to `cores` and size its intra-op thread pool to match.
+
+    The OpenMP pool of a thread is created by its first parallel operator and inherits the
+    affinity of the thread, so this has to run before the thread runs any operator.
+    """
+    os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+
+
+class StagePipeline:
+    """Run the encoder and the temporal head as two pipelined stages on their own threads and cores.
+
+    While the head decodes window (or frame) k, the encoder already runs on k+1. The stages are
+    threads of one process: PyTorch releases the GIL inside operators, every thread has its own
+    intra-op pool pinned to its cores, and the encoder outputs are handed to the head without a
+    copy. Autocast and grad mode are per thread, so the stage functions set them themselves.
+
+    Args:
+        encoder_cores (list): cores of the encoder stage, see `default_stage_cores`
+        head_cores (list): cores of the head stage
+    """
+
+    def __init__(self, encoder_cores=None, head_cores=None):
+        if encoder_cores is None or head_cores is None:
+            default_encoder_cores, default_head_cores = default_stage_cores()
+            encoder_cores = default_encoder_cores if encoder_cores is None else encoder_cores
+            head_cores = default_head_cores if head_cores is None else head_cores
+        self.encoder_cores = list(encoder_cores)
+        self.head_cores = list(head_cores)
+        self.encoder = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='encoder', initializer=pin_thread, initargs=(self.encoder_cores,))
+        self.head = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='head', initializer=pin_thread, initargs=(self.head_cores,))
+
+    def run(self, inputs, encode, decode):
+        """Yield `decode(x, encode(x))` for every `x` of `inputs`, in order.
+
+        `inputs` is consumed and encoded on the encoder stage, one item ahead of the head stage.
+        """
+        inputs = iter(inputs)
+
+        def next_encoded():
+            x = next(inputs, _END)
+            return None if x is _END else (x, encode(x))
+
+        encoded = self.encoder.submit(next_encoded)
+        try:
+            while True:
+                item = encoded.result()
+                if item is None:
+                    return
+                encoded = self.encoder.submit(next_encoded)
+                yield self.head.submit(decode, *item).result()
+        finally:
+            # the model must not be in use once the caller gets control back
+            concurrent.futures.wait([encoded])
+
+    def shutdown(self):
+        self.encoder.shutdown()
+        self.head.shutdown()
+
+
+def run_stages(pipeline, inputs, encode, decode):
+    """`StagePipeline.run` of `pipeline`, or the stages one after the other on the calling thread if it is None."""
+    if pipeline is not None:
+        yield from pipeline.run(inputs, encode, decode)
+        return
+    for x in inputs:
+        yield decode(x, encode(x))
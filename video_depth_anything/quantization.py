@@ -0,0 +1,59 @@
+# Copyright (2025) Bytedance Ltd. and/or its affiliates
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import torch
+import torch.nn as nn
+
+from .dinov2_layers.attention import Attention
+from .dinov2_layers.mlp import Mlp
+from .motion_module.attention import FeedForward
+from .motion_module.motion_module import TemporalAttention
+
+QUANTIZE_MODES = ('int8-dynamic',)
+
+
+def quantizable_linear_names(model):
+    """Names of the Linear layers that carry the bulk of the compute and tolerate int8 weights.
+
+    These are the DINOv2 block projections (`attn.qkv`, `attn.proj`, `mlp.fc1`, `mlp.fc2`) and,
+    in the motion modules, `to_q/k/v` (and `to_qkv` once packed by `optimize_for_inference`),
+    `to_out.0` and the feed forward (`GEGLU.proj` and the output Linear). Everything else, i.e. the patch embedding, norms, DPT convolutions and `output_conv2`,
+    stays in float.
+    """
+    names = []
+    for module_name, module in model.named_modules():
+        if isinstance(module, Attention):
+            children = ('qkv', 'proj')
+        elif isinstance(module, Mlp):
+            children = ('fc1', 'fc2')
+        elif isinstance(module, TemporalAttention):
+            children = ('to_q', 'to_k', 'to_v', 'to_out.0') + (('to_qkv',) if module.to_qkv is not None else ())
+        elif isinstance(module, FeedForward):
+            children = [name for name, child in module.named_modules() if isinstance(child, nn.Linear)]
+        else:
+            continue
+        names.extend(f'{module_name}.{child}' for child in children)
+    return names
+
+
+def quantize_model(model, mode='int8-dynamic'):
+    """Quantize `model` in place for CPU inference and return it.
+
+    'int8-dynamic' stores the weights of `quantizable_linear_names` as int8 and quantizes the
+    activations per batch at run time. The quantized kernels only run on CPU and expect float32
+    inputs, so the model has to be run with precision='fp32'.
+    """
+    if mode not in QUANTIZE_MODES:
+        raise ValueError(f"unknown quantize mode {mode}, choose from {QUANTIZE_MODES}")
+    qconfig_spec = {name: torch.ao.quantization.default_dynamic_qconfig for name in quantizable_linear_names(model)}
+    return torch.ao.quantization.quantize_dynamic(model.cpu().float(), qconfig_spec, dtype=torch.qint8, inplace=True)
@@ -0,0 +1,178 @@
+# Copyright (2025) Bytedance Ltd. and/or its affiliates
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import collections
+import threading
+import time
+
+import numpy as np
+
+
+class RealtimeStreamDriver:
+    """Drive a streaming `VideoDepthAnything` from a live source under a per-frame latency budget.
+
+    Frames are timestamped when they arrive. Before a frame is inferred, the driver predicts
+    when its depth would be ready (from a running estimate of the inference time); if that
+    misses the frame's deadline (arrival + budget) and a newer frame is already waiting, the
+    frame is dropped. The newest pending frame is always inferred, so output never stalls.
+
+    Dropped frames never reach `infer_video_depth_one`, so the model's frame ids, keyframe and
+    sliding-window cache policy only ever see processed frames, exactly as if the source had
+    been captured at a lower frame rate.
+
+    Args:
+        model: streaming `VideoDepthAnything` (video_depth_stream)
+        latency_budget (float): per-frame latency budget in seconds, from arrival to depth
+        drop_policy (str): "drop" yields nothing for dropped frames, "repeat" yields the last
+            depth again so that the output keeps one depth per input frame
+        max_catchup (int): up to this many pending frames that can still meet their deadline are
+            inferred together in one `infer_video_depth_catchup` step
+        ema (float): smoothing factor of the inference time estimate
+    """
+
+    def __init__(self, model, latency_budget, input_size=518, device='cuda', fp32=False, precision=None, drop_policy='drop', max_catchup=1, ema=0.9):
+        assert drop_policy in ('drop', 'repeat'), f"unknown drop_policy {drop_policy}"
+        self.model = model
+        self.latency_budget = latency_budget
+        self.input_size = input_size
+        self.device = device
+        self.fp32 = fp32
+        self.precision = precision
+        self.drop_policy = drop_policy
+        self.max_catchup = max(max_catchup, 1)
+        self.ema = ema
+
+        self._pending = collections.deque()
+        self._cond = threading.Condition()
+        self._source_done = False
+        self._source_error = None
+
+        self.infer_time = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.num_received = 0
+        self.num_processed = 0
+        self.num_dropped = 0
+        self.latencies = []
+        self.start_time = None
+        self.end_time = None
+
+    @property
+    def stats(self):
+        elapsed = (self.end_time or time.perf_counter()) - self.start_time if self.start_time is not None else 0.0
+        latencies = np.array(self.latencies) if self.latencies else np.zeros(1)
+        return {
+            'received': self.num_received,
+            'processed': self.num_processed,
+            'dropped': self.num_dropped,
+            'elapsed': elapsed,
+            'input_fps': self.num_received / elapsed if elapsed > 0 else 0.0,
+            'achieved_fps': self.num_processed / elapsed if elapsed > 0 else 0.0,
+            'latency_mean': float(latencies.mean()),
+            'latency_p95': float(np.percentile(latencies, 95)),
+            'latency_max': float(latencies.max()),
+        }
+
+    def _feed(self, frames, source_fps):
+        try:
+            t0 = time.perf_counter()
+            for i, frame in enumerate(frames):
+                if source_fps is not None and source_fps > 0:
+                    delay = t0 + i / source_fps - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                with self._cond:
+                    self._pending.append((i, time.perf_counter(), frame))
+                    self.num_received += 1
+                    self._cond.notify()
+        except Exception as e:
+            self._source_error = e
+        finally:
+            with self._cond:
+                self._source_done = True
+                self._cond.notify()
+
+    def _next_frames(self):
+        """Pop the next frames to infer, dropping the ones that would miss their deadline."""
+        dropped = []
+        with self._cond:
+            while not self._pending and not self._source_done:
+                self._cond.wait()
+            if not self._pending:
+                return [], dropped
+            now = time.perf_counter()
+            expected = self.infer_time or 0.0
+            while len(self._pending) > 1:
+                index, arrival, _ = self._pending[0]
+                if now + expected <= arrival + self.latency_budget:
+                    break
+                dropped.append(index)
+                self._pending.popleft()
+            items = []
+            while self._pending and len(items) < self.max_catchup:
+                items.append(self._pending.popleft())
+            return items, dropped
+
+    def run(self, frames, source_fps=None):
+        """Infer depth for `frames` under the latency budget.
+
+        `frames` is any iterable of RGB frames; it is consumed on a separate thread so that a
+        blocking live source keeps being read while inference runs. For a file source pass
+        `source_fps` to release frames at their capture rate instead of as fast as possible.
+
+        Yields:
+            (frame_index, depth, latency): depth is None for dropped frames with the "drop"
+            policy, and latency is None for every dropped frame
+        """
+        self._pending.clear()
+        self._source_done = False
+        self._source_error = None
+        self.reset_stats()
+        self.start_time = time.perf_counter()
+
+        feeder = threading.Thread(target=self._feed, args=(frames, source_fps), daemon=True)
+        feeder.start()
+
+        last_depth = None
+        try:
+            while True:
+                items, dropped = self._next_frames()
+                self.num_dropped += len(dropped)
+                for index in dropped:
+                    yield index, last_depth if self.drop_policy == 'repeat' else None, None
+                if not items:
+                    break
+
+                t_start = time.perf_counter()
+                if len(items) == 1:
+                    depths = [self.model.infer_video_depth_one(items[0][2], input_size=self.input_size, device=self.device, fp32=self.fp32, precision=self.precision)]
+                else:
+                    depths = self.model.infer_video_depth_catchup([frame for _, _, frame in items], input_size=self.input_size, device=self.device, fp32=self.fp32, precision=self.precision)
+                t_end = time.perf_counter()
+
+                cost = t_end - t_start
+                self.infer_time = cost if self.infer_time is None else self.ema * self.infer_time + (1 - self.ema) * cost
+                for (index, arrival, _), depth in zip(items, depths):
+                    self.num_processed += 1
+                    self.latencies.append(t_end - arrival)
+                    last_depth = depth
+                    yield index, depth, t_end - arrival
+        finally:
+            self.end_time = time.perf_counter()
+            with self._cond:
+                self._source_done = True
+            feeder.join(timeout=1.0)
+
+        if self._source_error is not None:
+            raise self._source_error
@@ -0,0 +1,112 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import torch
+
+# numpy has no bfloat16, such features are stored as their raw bits
+NUMPY_DTYPES = {torch.float32: np.float32, torch.float16: np.float16, torch.bfloat16: np.int16}
+
+
+def video_hash(frames):
+    """Hex digest of the pixels and shape of `frames`, an array of frames of one video."""
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(str(frames.shape).encode())
+    for frame in frames:
+        hasher.update(np.ascontiguousarray(frame).data)
+    return hasher.hexdigest()
+
+
+def encoder_name(model):
+    """Name of the encoder of `model` in the feature store: the checkpoint and everything that changes its outputs, optimization, quantization and token merging."""
+    name = model.encoder + ('_metric' if model.metric else '')
+    if not model.normalize_input:
+        name += '_optimized'
+    if any(isinstance(module, torch.ao.nn.quantized.dynamic.Linear) for module in model.pretrained.modules()):
+        name += '_int8-dynamic'
+    ratios = [blk.merge_ratio for blk in model.pretrained.blocks] if model.pretrained.token_merging else []
+    if any(ratios):
+        start_layer = next(i for i, ratio in enumerate(ratios) if ratio > 0)
+        name += f'_tome{ratios[start_layer]:g}from{start_layer}'
+    return name
+
+
+def feature_store_path(root, frames, model_name, input_shape, precision):
+    """Directory in `root` of the features of `frames` by the encoder `model_name` at input size `input_shape` (height, width) and `precision`."""
+    height, width = input_shape
+    return os.path.join(root, f'{video_hash(frames)}_{model_name}_{height}x{width}_{precision}')
+
+
+class FeatureStore:
+    """Encoder outputs of every frame of one video, memory-mapped from .npy files in `path`.
+
+    Every intermediate layer of `get_intermediate_layers(..., return_class_token=True)` is kept
+    as `layer{i}.npy` of shape [num_frames, tokens, channels] and `cls{i}.npy` of shape
+    [num_frames, channels], `filled.npy` marks the frames written so far and `meta.json` keeps
+    the dtype and the number of layers. The files are created by the first `put`, and a store
+    left by an interrupted run is completed by later ones.
+    """
+
+    def __init__(self, path, num_frames):
+        self.path = path
+        self.num_frames = num_frames
+        self.layers = None
+        self.filled = None
+        if os.path.exists(self._file('filled')):
+            with open(os.path.join(path, 'meta.json')) as f:
+                meta = json.load(f)
+            self.dtype = getattr(torch, meta['dtype'])
+            self.filled = np.load(self._file('filled'), mmap_mode='r+')
+            assert len(self.filled) == num_frames, f"{path} holds {len(self.filled)} frames, expected {num_frames}"
+            self.layers = [(np.load(self._file(f'layer{i}'), mmap_mode='r+'), np.load(self._file(f'cls{i}'), mmap_mode='r+')) for i in range(meta['layers'])]
+
+    def _file(self, name):
+        return os.path.join(self.path, name + '.npy')
+
+    def missing(self, indices):
+        """The frames of `indices` that are not stored yet, sorted and without repeats."""
+        indices = sorted(set(indices))
+        if self.filled is None:
+            return indices
+        return [i for i in indices if not self.filled[i]]
+
+    def put(self, indices, features):
+        """Store `features`, the encoder outputs of the frames `indices` in that order."""
+        if self.filled is None:
+            self._create(features)
+        for (tokens, cls_tokens), (out, cls_token) in zip(self.layers, features):
+            tokens[indices] = self._to_numpy(out)
+            cls_tokens[indices] = self._to_numpy(cls_token)
+        for tokens, cls_tokens in self.layers:
+            tokens.flush()
+            cls_tokens.flush()
+        # the frames are marked only once their features are on disk
+        self.filled[indices] = True
+        self.filled.flush()
+
+    def _to_numpy(self, tensor):
+        tensor = tensor.detach().cpu()
+        return (tensor.view(torch.int16) if self.dtype is torch.bfloat16 else tensor).numpy()
+
+    def _create(self, features):
+        os.makedirs(self.path, exist_ok=True)
+        self.dtype = features[0][0].dtype
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump({'dtype': str(self.dtype).split('.')[-1], 'layers': len(features)}, f)
+        np_dtype = NUMPY_DTYPES[self.dtype]
+        self.layers = []
+        for i, (out, cls_token) in enumerate(features):
+            tokens = np.lib.format.open_memmap(self._file(f'layer{i}'), mode='w+', dtype=np_dtype, shape=(self.num_frames, *out.shape[1:]))
+            cls_tokens = np.lib.format.open_memmap(self._file(f'cls{i}'), mode='w+', dtype=np_dtype, shape=(self.num_frames, *cls_token.shape[1:]))
+            self.layers.append((tokens, cls_tokens))
+        self.filled = np.lib.format.open_memmap(self._file('filled'), mode='w+', dtype=np.bool_, shape=(self.num_frames,))
+
+    def get(self, indices, device):
+        """The encoder outputs of the frames `indices` (repeats allowed), as the list `forward_head` takes."""
+        assert not self.missing(indices), f"frames {self.missing(indices)} are not stored"
+
+        def load(array):
+            tensor = torch.from_numpy(array[indices])
+            return (tensor.view(self.dtype) if self.dtype is torch.bfloat16 else tensor).to(device)
+        return [(load(tokens), load(cls_tokens)) for tokens, cls_tokens in self.layers]
@@ -0,0 +1,35 @@
+from collections import OrderedDict
+
+import torch
+
+
+class LRUCache:
+    """A small least-recently-used cache of tensors that only depend on input shapes, dtypes and devices.
+
+    The tensors are computed once per key, without autograd, and reused until `maxsize` newer
+    keys have pushed them out. While grad is enabled or under torch.compile nothing is cached.
+    """
+
+    def __init__(self, maxsize=8):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+
+    def get(self, key, compute):
+        if torch.is_grad_enabled() or _is_compiling():
+            return compute()
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        value = compute()
+        self.entries[key] = value
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        self.entries.clear()
+
+
+def _is_compiling():
+    is_compiling = getattr(getattr(torch, 'compiler', None), 'is_compiling', None) or getattr(torch._dynamo, 'is_compiling', None)
+    return is_compiling is not None and is_compiling()
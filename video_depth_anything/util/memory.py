@@ -0,0 +1,200 @@
+import ctypes
+import os
+import threading
+import time
+
+import torch
+
+from .precision import PRECISION_DTYPES
+
+MICRO_BATCH_STAGES = ('encoder', 'project', 'motion', 'refine', 'output')
+
+
+def autocast_bytes(device):
+    """Bytes per activation value under the autocast state of `device`, 4 outside autocast."""
+    device_type = torch.device(device).type
+    if device_type == 'cuda' and torch.is_autocast_enabled():
+        return torch.finfo(torch.get_autocast_gpu_dtype()).bits // 8
+    if device_type == 'cpu' and torch.is_autocast_cpu_enabled():
+        return torch.finfo(torch.get_autocast_cpu_dtype()).bits // 8
+    return 4
+
+
+def stage_frame_memory(model, height, width):
+    """Rough peak activation values per frame of every micro-batched stage, at input size `height` x `width`.
+
+    'encoder' is the qkv, attention output and MLP hidden state of a ViT block (the fused
+    attention kernels do not materialize the attention matrix), 'project' the readout
+    projections and resize layers at 4x the patch grid, 'refine' refinenet4 and refinenet3,
+    and 'output' refinenet2, refinenet1 and the output convolutions at full resolution.
+    """
+    vit = model.pretrained
+    patch_h, patch_w = height // 14, width // 14
+    tokens = patch_h * patch_w + 1 + vit.num_register_tokens
+    features = model.head.scratch.output_conv1.in_channels
+    out_channels = model.head.projects[0].out_channels
+    return {
+        'encoder': 8 * tokens * vit.embed_dim,
+        'project': patch_h * patch_w * (2 * vit.embed_dim + 16 * 2 * out_channels),
+        'refine': 4 * patch_h * patch_w * features * 4,
+        'output': height * width * (features * 3 * (8 / 14) ** 2 + 32 * 2),
+    }
+
+
+def motion_position_memory(model, num_frames):
+    """Rough peak activation values of the transformer blocks of a motion module per spatial position, over all `num_frames` frames."""
+    channels = max([project.out_channels for project in model.head.projects[2:]] + [model.head.scratch.output_conv1.in_channels])
+    heads = model.head.motion_modules[0].temporal_transformer.transformer_blocks[0].attention_blocks[0].heads
+    return num_frames * (20 * channels + 2 * heads * num_frames)
+
+
+def persistent_frame_memory(model, height, width):
+    """Activation values per frame that live across all micro-batches: the encoder outputs and the head inputs of every scale."""
+    vit = model.pretrained
+    patch_h, patch_w = height // 14, width // 14
+    tokens = patch_h * patch_w + 1 + vit.num_register_tokens
+    features = model.head.scratch.output_conv1.in_channels
+    out_channels = sum(project.out_channels * scale for project, scale in zip(model.head.projects, (16, 4, 1, 0.25)))
+    # the motion modules keep their input, residual and projected input at up to 2x the patch grid
+    return len(model.intermediate_layer_idx[model.encoder]) * tokens * vit.embed_dim \
+        + patch_h * patch_w * (out_channels + features * (16 + 4 + 1 + 0.25) + 3 * 4 * features)
+
+
+def weight_memory(model):
+    return sum(p.numel() * p.element_size() for p in model.parameters())
+
+
+def process_memory(pid='self'):
+    """Resident set size, proportional set size and private memory of process `pid` in bytes, from /proc/<pid>/smaps_rollup.
+
+    Pages shared with other processes count fully in 'rss', divided among the sharers in 'pss'
+    and not at all in 'private'.
+    """
+    fields = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                fields[parts[0].rstrip(':')] = int(parts[1]) * 1024
+    return {'rss': fields['Rss'], 'pss': fields['Pss'], 'private': fields['Private_Clean'] + fields['Private_Dirty']}
+
+
+def estimate_window_memory(model, height, width, precision='fp32', num_frames=32):
+    """Rough peak memory in bytes of inferring one window of `num_frames` frames at input size `height` x `width`, without micro-batching.
+
+    The weights, the activations kept across stages and the largest stage, see
+    `stage_frame_memory`. It is meant to pick sizes, not to be exact.
+    """
+    bytes_per_value = torch.finfo(PRECISION_DTYPES[precision]).bits // 8
+    stages = stage_frame_memory(model, height, width)
+    motion = 4 * (height // 14) * (width // 14) * motion_position_memory(model, num_frames) / num_frames
+    activations = persistent_frame_memory(model, height, width) + max(max(stages.values()), motion)
+    return weight_memory(model) + num_frames * bytes_per_value * activations
+
+
+def micro_batch_sizes(model, height, width, num_frames, memory_budget, bytes_per_value=4):
+    """Largest micro-batch size of every stage in `MICRO_BATCH_STAGES` that keeps the estimated peak under `memory_budget` bytes.
+
+    The weights and the activations kept across stages are taken off the budget first, and the
+    rest bounds every stage on its own. The sizes are in frames, except for 'motion' which is in
+    spatial positions of all frames. A stage that fits at once gets all of them, and one that
+    does not even fit one gets 1.
+    """
+    available = memory_budget - weight_memory(model) - num_frames * bytes_per_value * persistent_frame_memory(model, height, width)
+    sizes = {}
+    for stage, values in stage_frame_memory(model, height, width).items():
+        sizes[stage] = int(min(max(available // (bytes_per_value * values), 1), num_frames))
+
+    positions = 4 * (height // 14) * (width // 14)
+    sizes['motion'] = int(min(max(available // (bytes_per_value * motion_position_memory(model, num_frames)), 1), positions))
+    return sizes
+
+
+class StagePeakMemory:
+    """Peak memory of every stage of the forward passes run inside the context, relative to its start.
+
+    Stages start when one of their modules is called (see `stage_modules`). On CUDA the peaks
+    come from the caching allocator, on CPU from the resident set size sampled every millisecond,
+    with the heap trimmed at every stage switch so that memory freed by earlier stages does not
+    count. `peaks` maps every stage to its peak in bytes.
+    """
+
+    def __init__(self, model, device):
+        self.model = model
+        self.cuda = torch.device(device).type == 'cuda'
+        self.peaks = {}
+        self.stage = None
+        self.handles = []
+        self.sampler = None
+        self.libc = None
+
+    def stage_modules(self):
+        head = self.model.head
+        stages = [('encoder', self.model.pretrained.patch_embed)]
+        stages += [('project', project) for project in head.projects]
+        stages += [('motion', motion_module) for motion_module in head.motion_modules]
+        stages += [('refine', head.scratch.layer1_rn), ('refine', head.scratch.refinenet4), ('refine', head.scratch.refinenet3)]
+        stages += [('output', head.scratch.refinenet2)]
+        return stages
+
+    def _current(self):
+        if self.cuda:
+            return torch.cuda.max_memory_allocated()
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+    def _record(self, value):
+        if self.stage is not None:
+            self.peaks[self.stage] = max(self.peaks.get(self.stage, 0), value - self.base)
+
+    def _switch(self, stage):
+        if stage == self.stage:
+            return
+        self._record(self._current())
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats()
+        elif self.libc is not None:
+            self.libc.malloc_trim(0)
+        self.stage = stage
+
+    def _sample(self):
+        while not self.stop.is_set():
+            self._record(self._current())
+            time.sleep(0.001)
+
+    def __enter__(self):
+        if self.cuda:
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+            self.base = torch.cuda.memory_allocated()
+        else:
+            try:
+                self.libc = ctypes.CDLL('libc.so.6')
+                self.libc.malloc_trim(0)
+            except OSError:
+                self.libc = None
+            self.base = self._current()
+        for stage, module in self.stage_modules():
+            self.handles.append(module.register_forward_pre_hook(lambda module, inputs, stage=stage: self._switch(stage)))
+        self.stage = 'start'
+        if not self.cuda:
+            self.stop = threading.Event()
+            self.sampler = threading.Thread(target=self._sample, daemon=True)
+            self.sampler.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self.cuda:
+            torch.cuda.synchronize()
+        else:
+            self.stop.set()
+            self.sampler.join()
+        self._record(self._current())
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+        self.peaks.pop('start', None)
+        return False
+
+    def report(self):
+        return '\n'.join(f'{stage:>8}: {peak / 2**20:9.1f} MiB' for stage, peak in self.peaks.items())
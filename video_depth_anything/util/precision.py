@@ -0,0 +1,38 @@
+import torch
+
+PRECISION_DTYPES = {
+    'fp32': torch.float32,
+    'bf16': torch.bfloat16,
+    'fp16': torch.float16,
+}
+
+
+def resolve_precision(device, precision=None, fp32=False):
+    """Pick the inference precision for `device`.
+
+    `fp32=True` is the older spelling of precision='fp32'. Without an explicit precision, CUDA
+    runs in fp16 and every other device in bf16, which CPUs with AMX or AVX512-BF16 accelerate
+    and which CPU autocast supports everywhere. fp16 is CUDA only, CPU autocast rejects it.
+    """
+    if fp32:
+        return 'fp32'
+    if precision is None:
+        return 'fp16' if torch.device(device).type == 'cuda' else 'bf16'
+    if precision not in PRECISION_DTYPES:
+        raise ValueError(f"unknown precision {precision}, choose from {list(PRECISION_DTYPES)}")
+    if precision == 'fp16' and torch.device(device).type != 'cuda':
+        raise ValueError(f"precision fp16 runs on CUDA only, use bf16 or fp32 on {device}")
+    return precision
+
+
+def autocast(device, precision):
+    """Autocast context of `precision` on the device type of `device` (e.g. 'cuda:1' -> 'cuda')."""
+    device_type = torch.device(device).type
+    if precision == 'fp32':
+        return torch.autocast(device_type=device_type, enabled=False)
+    return torch.autocast(device_type=device_type, dtype=PRECISION_DTYPES[precision])
+
+
+def float32_island(tensor):
+    """Disable autocast for the device of `tensor`, for layers that have to run in float32."""
+    return torch.autocast(device_type=tensor.device.type, enabled=False)
@@ -0,0 +1,34 @@
+import math
+
+import numpy as np
+
+from .memory import estimate_window_memory
+
+
+def tile_size_for_memory(model, memory_budget, precision='fp32', num_frames=32, max_size=1540):
+    """Largest square input size (a multiple of 14) whose window fits `memory_budget` bytes, see `estimate_window_memory`."""
+    for size in range(max_size, 13, -14):
+        if estimate_window_memory(model, size, size, precision, num_frames) <= memory_budget:
+            return size
+    raise ValueError(f"memory budget of {memory_budget / 2**30:.2f}GiB is below the weights and smallest window")
+
+
+def tile_starts(length, crop, overlap):
+    """Start offsets of tiles of `crop` pixels covering `length`, overlapping by at least `overlap` pixels."""
+    if crop >= length:
+        return [0]
+    count = math.ceil((length - overlap) / (crop - overlap))
+    return [round(i * (length - crop) / (count - 1)) for i in range(count)]
+
+
+def feather_weights(height, width, ramp_top, ramp_bottom, ramp_left, ramp_right):
+    """Blending weights of a tile that fall off linearly over the given ramps (0 keeps the border at weight 1)."""
+    def ramp(size, start, end):
+        pos = np.arange(size, dtype=np.float32) + 0.5
+        weight = np.ones(size, dtype=np.float32)
+        if start > 0:
+            weight = np.minimum(weight, pos / start)
+        if end > 0:
+            weight = np.minimum(weight, (size - pos) / end)
+        return weight
+    return ramp(height, ramp_top, ramp_bottom)[:, None] * ramp(width, ramp_left, ramp_right)[None, :]
@@ -15,6 +15,7 @@ class Resize(object):
         ensure_multiple_of=1,
         resize_method="lower_bound",
         image_interpolation_method=cv2.INTER_AREA,
+        bucket=None,
     ):
         """Init.
 
@@ -38,6 +39,10 @@ class Resize(object):
                 "upper_bound": Output will be at max as large as the given size. (Output size might be smaller than given size.)
                 "minimal": Scale as least as possible.  (Output size might be smaller than given size.)
                 Defaults to "lower_bound".
+            bucket (int, optional):
+                Snap the longer side to a multiple of this parameter, so that inputs of different
+                aspect ratios map to a few output sizes (at a small aspect ratio change).
+                Should be a multiple of ensure_multiple_of. Defaults to None.
         """
         self.__width = width
         self.__height = height
@@ -47,6 +52,7 @@ class Resize(object):
         self.__multiple_of = ensure_multiple_of
         self.__resize_method = resize_method
         self.__image_interpolation_method = image_interpolation_method
+        self.__bucket = bucket
 
     def constrain_to_multiple_of(self, x, min_val=0, max_val=None):
         y = (np.round(x / self.__multiple_of) * self.__multiple_of).astype(int)
@@ -104,6 +110,12 @@ class Resize(object):
         else:
             raise ValueError(f"resize_method {self.__resize_method} not implemented")
 
+        if self.__bucket is not None:
+            if new_width >= new_height:
+                new_width = max(int(np.round(new_width / self.__bucket) * self.__bucket), new_height)
+            else:
+                new_height = max(int(np.round(new_height / self.__bucket) * self.__bucket), new_width)
+
         return (new_width, new_height)
 
     def __call__(self, sample):
@@ -0,0 +1,57 @@
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+def box_filter(x, radius):
+    """Mean of `x` [N, C, H, W] over windows of (2 * radius + 1)^2 pixels, of the pixels inside the image at the borders."""
+    return F.avg_pool2d(x, 2 * radius + 1, stride=1, padding=radius, count_include_pad=False)
+
+
+class GuidedUpsampler:
+    """Upsample depth from the model resolution to the frame resolution along the edges of the frame.
+
+    A fast guided filter (He and Sun, 2015) with the gray frame as guide: the slope `a` of the
+    local linear model depth = a * gray + b is fit at the model resolution, in windows of
+    `radius` pixels and with the regularization `eps` on intensities in [0, 1], and upsampled
+    bilinearly. The offset is not box-filtered like the slope: the output is the bilinear depth
+    plus `a` times the detail of the full-resolution gray frame that the model-resolution one
+    lacks. Where the frame does not explain the depth `a` is close to 0 and the output is the
+    bilinear one instead of the window mean, and depth edges that follow an edge of the frame
+    get its full-resolution position. `batch_size` frames are upsampled at a time to bound the
+    memory of the full-resolution maps.
+    """
+
+    def __init__(self, radius=1, eps=1e-2, batch_size=8):
+        self.radius = radius
+        self.eps = eps
+        self.batch_size = batch_size
+
+    def __call__(self, depth, frames):
+        """`depth` [N, 1, h, w] upsampled to the resolution of `frames`, N uint8 RGB frames [H, W, 3]; returns [N, 1, H, W]."""
+        return torch.cat([self.upsample(depth[start:start + self.batch_size], frames[start:start + self.batch_size])
+                          for start in range(0, len(depth), self.batch_size)])
+
+    def upsample(self, depth, frames):
+        gray = np.stack([cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY) for frame in frames])
+        guide = torch.from_numpy(gray).to(depth.device).unsqueeze(1).float() / 255
+        guide_low = F.interpolate(guide, size=depth.shape[-2:], mode='area')
+
+        mean_guide = box_filter(guide_low, self.radius)
+        mean_depth = box_filter(depth, self.radius)
+        var_guide = box_filter(guide_low * guide_low, self.radius) - mean_guide * mean_guide
+        cov = box_filter(guide_low * depth, self.radius) - mean_guide * mean_depth
+        a = cov / (var_guide + self.eps)
+
+        size = guide.shape[-2:]
+        upsampled = F.interpolate(torch.cat([depth, a, guide_low], dim=1), size=size, mode='bilinear', align_corners=False)
+        depth, a, guide_low = upsampled.split(1, dim=1)
+        return (depth + a * (guide - guide_low)).clamp_(min=0)
+
+
+def upsample_depth(depth, size, frames, upsampler=None):
+    """`depth` [N, 1, h, w] at the model resolution upsampled to `size` (height, width), bilinear, or with `upsampler` guided by `frames`."""
+    if upsampler is None:
+        return F.interpolate(depth, size=size, mode='bilinear', align_corners=True)
+    return upsampler(depth, frames)
@@ -0,0 +1,136 @@
+import ctypes
+import mmap
+from collections import OrderedDict
+
+MADV_WILLNEED = 3
+MADV_DONTNEED = 4
+
+
+def file_backed_ranges():
+    """Address ranges of this process that map a file, from /proc/self/maps."""
+    ranges = []
+    with open('/proc/self/maps') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) >= 6 and fields[4] != '0':
+                start, end = (int(address, 16) for address in fields[0].split('-'))
+                ranges.append((start, end))
+    return ranges
+
+
+def weight_units(model, blocks_per_unit=1):
+    """The paging units of a `VideoDepthAnything`, in the order the forward pass runs them, as (name, modules).
+
+    The DINOv2 blocks are paged in `blocks_per_unit` at a time (one `BlockChunk` each if the
+    blocks are chunked), and the head in the order of `DPTHeadTemporal.forward`: every readout
+    projection with its resize layer, every motion module, the layer*_rn convolutions,
+    refinenet4, refinenet3, and refinenet2, refinenet1 and the output convolutions together,
+    since they alternate within a micro-batch. The patch embedding, the position embedding and
+    the final norm are small and stay resident.
+    """
+    vit, head = model.pretrained, model.head
+    units = []
+    if vit.chunked_blocks:
+        for i, block_chunk in enumerate(vit.blocks):
+            units.append((f'blocks.{i}', [blk for blk in block_chunk if any(True for _ in blk.parameters())]))
+    else:
+        for i in range(0, len(vit.blocks), blocks_per_unit):
+            units.append((f'blocks.{i}', list(vit.blocks[i:i + blocks_per_unit])))
+
+    scratch = head.scratch
+    units += [(f'projects.{i}', [project, resize]) for i, (project, resize) in enumerate(zip(head.projects, head.resize_layers))]
+    units += [(f'motion_modules.{i}', [head.motion_modules[i]]) for i in (0, 1)]
+    units.append(('layer_rn', [scratch.layer1_rn, scratch.layer2_rn, scratch.layer3_rn, scratch.layer4_rn]))
+    units.append(('refinenet4', [scratch.refinenet4]))
+    units.append(('motion_modules.2', [head.motion_modules[2]]))
+    units.append(('refinenet3', [scratch.refinenet3]))
+    units.append(('motion_modules.3', [head.motion_modules[3]]))
+    units.append(('output', [scratch.refinenet2, scratch.refinenet1, scratch.output_conv1, scratch.output_conv2]))
+    return units
+
+
+class WeightStreamer:
+    """Keep the memory-mapped weights of a model out of the resident set except for the units that run.
+
+    The weights have to be the unmodified tensors of a memory-mapped checkpoint (see
+    `loader.load_checkpoint`). When a unit of `weight_units` starts, its pages are faulted in
+    from the mapping and the least recently used units beyond `resident_units` are dropped from
+    the process with madvise(MADV_DONTNEED); with `prefetch` the next unit is read ahead with
+    MADV_WILLNEED. The dropped pages stay in the page cache while there is memory to spare, so
+    the cost is page faults, and reads from disk once the kernel reclaims them.
+
+    Dropping a page of a private mapping also drops any change to it, so the weights must not be
+    modified in place (optimize_for_inference) or converted while they are streamed. The units
+    are switched by forward pre-hooks, so the blocks that the static-region reuse of the streaming
+    model runs through `forward_cached_kv` stay resident. Linux only.
+    """
+
+    def __init__(self, model, resident_units=1, blocks_per_unit=1, prefetch=True):
+        try:
+            self.libc = ctypes.CDLL('libc.so.6', use_errno=True)
+        except OSError as e:
+            raise RuntimeError("weight streaming needs madvise of the Linux C library") from e
+        self.libc.madvise.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int]
+        self.resident_units = resident_units
+        self.prefetch = prefetch
+
+        mapped = file_backed_ranges()
+        self.units, self.handles = [], []
+        for name, modules in weight_units(model, blocks_per_unit):
+            ranges = self._page_ranges(modules, mapped)
+            if not ranges:
+                continue
+            index = len(self.units)
+            self.units.append((name, ranges))
+            for module in modules:
+                self.handles.append(module.register_forward_pre_hook(lambda module, inputs, index=index: self.touch(index)))
+        if not self.units:
+            raise ValueError("no weights are memory-mapped from a file, load the checkpoint with loader.load_checkpoint")
+        self.resident = OrderedDict()
+        # the checkpoint has just been loaded, so nothing is resident yet except what was touched since
+        for index in range(len(self.units)):
+            self._advise(index, MADV_DONTNEED)
+
+    @staticmethod
+    def _page_ranges(modules, mapped):
+        ranges = []
+        for module in modules:
+            for tensor in list(module.parameters()) + list(module.buffers()):
+                start = tensor.data_ptr()
+                end = start + tensor.numel() * tensor.element_size()
+                if tensor.device.type != 'cpu' or not any(lo <= start and end <= hi for lo, hi in mapped):
+                    continue
+                ranges.append((start - start % mmap.PAGESIZE, end + (-end) % mmap.PAGESIZE))
+        return ranges
+
+    def _advise(self, index, advice):
+        for start, end in self.units[index][1]:
+            if self.libc.madvise(start, end - start, advice) != 0:
+                raise OSError(ctypes.get_errno(), f"madvise of the weights of {self.units[index][0]} failed")
+
+    def touch(self, index):
+        if index in self.resident:
+            self.resident.move_to_end(index)
+            return
+        self.resident[index] = True
+        while len(self.resident) > self.resident_units:
+            self._advise(self.resident.popitem(last=False)[0], MADV_DONTNEED)
+        if self.prefetch and index + 1 < len(self.units):
+            self._advise(index + 1, MADV_WILLNEED)
+
+    def resident_bytes(self):
+        return sum(end - start for index in self.resident for start, end in self.units[index][1])
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+
+def stream_weights(model, resident_units=1, blocks_per_unit=1, prefetch=True):
+    """Page the weights of the DINOv2 blocks and the DPT head of `model` in and out per unit, see `WeightStreamer`.
+
+    The streamer is kept as `model.weight_streamer`, `model.weight_streamer.remove()` stops it.
+    """
+    model.weight_streamer = WeightStreamer(model, resident_units, blocks_per_unit, prefetch)
+    return model
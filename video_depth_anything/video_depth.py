@@ -18,11 +18,16 @@ from torchvision.transforms import Compose
 import cv2
 from tqdm import tqdm
 import numpy as np
-import gc
 
 from .dinov2 import DINOv2
 from .dpt_temporal import DPTHeadTemporal
+from .pipeline import run_stages
+from .util.feature_store import FeatureStore, encoder_name, feature_store_path
 from .util.transform import Resize, NormalizeImage, PrepareForNet
+from .util.memory import autocast_bytes, micro_batch_sizes
+from .util.precision import autocast, resolve_precision
+from .util.tiling import feather_weights, tile_size_for_memory, tile_starts
+from .util.upsample import upsample_depth
 
 from utils.util import compute_scale_and_shift, get_interpolate_frames
 
@@ -57,17 +62,57 @@ class VideoDepthAnything(nn.Module):
 
         self.head = DPTHeadTemporal(self.pretrained.embed_dim, features, use_bn, out_channels=out_channels, use_clstoken=use_clstoken, num_frames=num_frames, pe=pe)
         self.metric = metric
+        self.size_bucket = None
+        # False once optimize_for_inference folds the normalization into the patch embedding
+        self.normalize_input = True
+        self.memory_budget = None
+        # a pipeline.StagePipeline runs the encoder of the next window while the head decodes this one
+        self.pipeline = None
+        # a util.upsample.GuidedUpsampler brings the depth to the frame resolution along the frame edges, bilinear if None
+        self.upsampler = None
 
     def forward(self, x):
-        B, T, C, H, W = x.shape
+        return self.forward_head(self.forward_features(x), x.shape, self.micro_batch_plan(x.shape, x.device))
+
+    def forward_features(self, x):
+        # a list, so that the head can release every encoder output once it is projected
+        return list(self.pretrained.get_intermediate_layers(x.flatten(0,1), self.intermediate_layer_idx[self.encoder], return_class_token=True,
+                                                            micro_batch_size=self.micro_batch_plan(x.shape, x.device).get('encoder')))
+
+    def micro_batch_plan(self, x_shape, device):
+        """Micro-batch sizes of the encoder and head stages for an input of `x_shape`, picked to fit `memory_budget` bytes if it is set."""
+        if self.memory_budget is None:
+            return {'output': 4}
+        B, T, C, H, W = x_shape
+        return micro_batch_sizes(self, H, W, B * T, self.memory_budget, autocast_bytes(device))
+
+    def forward_list(self, x_list):
+        """`forward` of windows of different resolutions, e.g. videos of different aspect ratios.
+
+        The encoder runs all windows as one nested batch, the head runs on each window. Returns
+        the depth of every window, of shape [B, T, H, W] of that window.
+        """
+        features_list = self.pretrained.get_intermediate_layers_list([x.flatten(0,1) for x in x_list], self.intermediate_layer_idx[self.encoder],
+                                                                     return_class_token=True)
+        return [self.forward_head(list(features), x.shape, self.micro_batch_plan(x.shape, x.device)) for x, features in zip(x_list, features_list)]
+
+    def forward_head(self, features, x_shape, micro_batch_size=4):
+        B, T, C, H, W = x_shape
         patch_h, patch_w = H // 14, W // 14
-        features = self.pretrained.get_intermediate_layers(x.flatten(0,1), self.intermediate_layer_idx[self.encoder], return_class_token=True)
-        depth = self.head(features, patch_h, patch_w, T)[0]
+        depth = self.head(features, patch_h, patch_w, T, micro_batch_size=micro_batch_size, return_hidden_states=False)[0]
         depth = F.interpolate(depth, size=(H, W), mode="bilinear", align_corners=True)
         depth = F.relu(depth)
         return depth.squeeze(1).unflatten(0, (B, T)) # return shape [B, T, H, W]
 
-    def infer_video_depth(self, frames, target_fps, input_size=518, device='cuda', fp32=False):
+    def infer_video_depth(self, frames, target_fps, input_size=518, device='cuda', fp32=False, precision=None, feature_cache=None):
+        """Depth of every frame of `frames`, inferred in overlapping windows of INFER_LEN frames that are aligned to each other.
+
+        With `feature_cache`, a directory, the encoder outputs of every frame are kept in a
+        `util.feature_store.FeatureStore` there, keyed by the video, the model (see
+        `util.feature_store.encoder_name`), the input size and the precision, and later calls on
+        the same frames only run the head on them.
+        """
+        precision = resolve_precision(device, precision, fp32)
         frame_height, frame_width = frames[0].shape[:2]
         ratio = max(frame_height, frame_width) / min(frame_height, frame_width)
         if ratio > 1.78:  # we recommend to process video with ratio smaller than 16:9 due to memory limitation
@@ -83,39 +128,62 @@ class VideoDepthAnything(nn.Module):
                 ensure_multiple_of=14,
                 resize_method='lower_bound',
                 image_interpolation_method=cv2.INTER_CUBIC,
+                bucket=self.size_bucket,
             ),
-            NormalizeImage(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+            NormalizeImage(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]) if self.normalize_input else (lambda sample: sample),
             PrepareForNet(),
         ])
 
-        frame_list = [frames[i] for i in range(frames.shape[0])]
         frame_step = INFER_LEN - OVERLAP
-        org_video_len = len(frame_list)
-        append_frame_len = (frame_step - (org_video_len % frame_step)) % frame_step + (INFER_LEN - frame_step)
-        frame_list = frame_list + [frame_list[-1].copy()] * append_frame_len
+        org_video_len = frames.shape[0]
 
-        depth_list = []
-        pre_input = None
-        for frame_id in tqdm(range(0, org_video_len, frame_step)):
-            cur_list = []
-            for i in range(INFER_LEN):
-                cur_list.append(torch.from_numpy(transform({'image': frame_list[frame_id+i].astype(np.float32) / 255.0})['image']).unsqueeze(0).unsqueeze(0))
-            cur_input = torch.cat(cur_list, dim=1).to(device)
-            if pre_input is not None:
-                cur_input[:, :OVERLAP, ...] = pre_input[:, KEYFRAMES, ...]
+        def prepare(indices):
+            return torch.cat([torch.from_numpy(transform({'image': frames[i].astype(np.float32) / 255.0})['image']).unsqueeze(0) for i in indices]).unsqueeze(0).to(device)
 
-            with torch.no_grad():
-                with torch.autocast(device_type=device, enabled=(not fp32)):
-                    depth = self.forward(cur_input) # depth shape: [1, T, H, W]
+        def window_indices():
+            # the frame at every position of every window: the windows after the first start with the
+            # keyframes of the one before, and the last frame pads the last window
+            pre_indices = None
+            for frame_id in tqdm(range(0, org_video_len, frame_step)):
+                indices = [min(frame_id + i, org_video_len - 1) for i in range(INFER_LEN)]
+                if pre_indices is not None:
+                    indices[:OVERLAP] = [pre_indices[k] for k in KEYFRAMES]
+                yield indices
+                pre_indices = indices
 
-            depth = depth.to(cur_input.dtype)
-            depth = F.interpolate(depth.flatten(0,1).unsqueeze(1), size=(frame_height, frame_width), mode='bilinear', align_corners=True)
-            depth_list += [depth[i][0].cpu().numpy() for i in range(depth.shape[0])]
+        store = None
+        if feature_cache is not None:
+            input_shape = transform({'image': frames[0].astype(np.float32) / 255.0})['image'].shape[1:]
+            store = FeatureStore(feature_store_path(feature_cache, frames, encoder_name(self), input_shape, precision), org_video_len)
 
-            pre_input = cur_input
+        def encode(indices):
+            if store is None:
+                cur_input = prepare(indices)
+                with torch.no_grad():
+                    with autocast(device, precision):
+                        return cur_input.shape, self.forward_features(cur_input)
+            # every frame is encoded once, the keyframes that start the next window are reused
+            missing = store.missing(indices)
+            if missing:
+                cur_input = prepare(missing)
+                with torch.no_grad():
+                    with autocast(device, precision):
+                        store.put(missing, self.forward_features(cur_input))
+            return (1, INFER_LEN, 3, *input_shape), store.get(indices, device)
 
-        del frame_list
-        gc.collect()
+        def decode(indices, encoded):
+            x_shape, features = encoded
+            with torch.no_grad():
+                with autocast(device, precision):
+                    depth = self.forward_head(features, x_shape, self.micro_batch_plan(x_shape, device)) # depth shape: [1, T, H, W]
+
+            depth = depth.float()
+            depth = upsample_depth(depth.flatten(0,1).unsqueeze(1), (frame_height, frame_width), [frames[i] for i in indices], self.upsampler)
+            return [depth[i][0].cpu().numpy() for i in range(depth.shape[0])]
+
+        depth_list = []
+        for window_depths in run_stages(self.pipeline, window_indices(), encode, decode):
+            depth_list += window_depths
 
         depth_list_aligned = []
         ref_align = []
@@ -161,3 +229,43 @@ class VideoDepthAnything(nn.Module):
 
         return np.stack(depth_list[:org_video_len], axis=0), target_fps
 
+    def infer_video_depth_tiled(self, frames, target_fps, input_size=518, tiles=2, tile_overlap=0.25, tile_size=None, memory_budget=None,
+                                device='cuda', fp32=False, precision=None, feature_cache=None):
+        """High-resolution inference over overlapping square tiles, each inferred as a video of its own.
+
+        `tiles` tiles span the shorter side of the frames, overlapping by `tile_overlap` of their
+        size, and as many as needed span the longer side, so wide aspect ratios keep their input
+        size. Each tile is inferred at input size `tile_size`, by default the largest one whose
+        window fits `memory_budget` bytes (see `util.tiling.estimate_window_memory`) or else
+        `input_size`. A pass over the whole frames at `input_size` gives the reference every tile
+        is aligned to with one scale and shift over all its frames (scale only for metric depth),
+        then the tiles are blended with weights that fall off linearly across the overlaps.
+        `feature_cache` keeps the encoder outputs of the reference and of every tile, see
+        `infer_video_depth`.
+        """
+        precision = resolve_precision(device, precision, fp32)
+        if tile_size is None:
+            tile_size = input_size if memory_budget is None else tile_size_for_memory(self, memory_budget, precision)
+        reference, _ = self.infer_video_depth(frames, target_fps, input_size=min(input_size, tile_size), device=device, precision=precision,
+                                              feature_cache=feature_cache)
+
+        frame_height, frame_width = frames.shape[1:3]
+        crop = min(round(min(frame_height, frame_width) / (tiles - (tiles - 1) * tile_overlap)), frame_height, frame_width)
+        overlap = round(crop * tile_overlap)
+        depths = np.zeros_like(reference)
+        weight_sum = np.zeros((frame_height, frame_width), dtype=np.float32)
+        for y in tile_starts(frame_height, crop, overlap):
+            for x in tile_starts(frame_width, crop, overlap):
+                tile_depths, _ = self.infer_video_depth(frames[:, y:y+crop, x:x+crop], target_fps, input_size=tile_size, device=device, precision=precision,
+                                                        feature_cache=feature_cache)
+                # a subsampled grid is plenty for two parameters
+                tile_ref = reference[:, y:y+crop:4, x:x+crop:4]
+                scale, shift = compute_scale_and_shift(tile_depths[:, ::4, ::4], tile_ref, tile_ref > 0, scale_only=self.metric)
+                tile_depths = np.maximum(tile_depths * scale + shift, 0)
+
+                weight = feather_weights(crop, crop, overlap if y > 0 else 0, overlap if y + crop < frame_height else 0,
+                                         overlap if x > 0 else 0, overlap if x + crop < frame_width else 0)
+                depths[:, y:y+crop, x:x+crop] += tile_depths * weight
+                weight_sum[y:y+crop, x:x+crop] += weight
+
+        return depths / weight_sum, target_fps
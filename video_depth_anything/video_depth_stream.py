@@ -20,7 +20,11 @@ import numpy as np
 
 from .dinov2 import DINOv2
 from .dpt_temporal import DPTHeadTemporal
+from .pipeline import run_stages
 from .util.transform import Resize, NormalizeImage, PrepareForNet
+from .util.memory import autocast_bytes, micro_batch_sizes
+from .util.precision import autocast, resolve_precision
+from .util.upsample import upsample_depth
 
 from utils.util import compute_scale_and_shift, get_interpolate_frames
 
@@ -52,6 +56,16 @@ class VideoDepthAnything(nn.Module):
         self.pretrained = DINOv2(model_name=encoder)
 
         self.head = DPTHeadTemporal(self.pretrained.embed_dim, features, use_bn, out_channels=out_channels, use_clstoken=use_clstoken, num_frames=num_frames, pe=pe)
+        self.size_bucket = None
+        # False once optimize_for_inference folds the normalization into the patch embedding
+        self.normalize_input = True
+        self.memory_budget = None
+        # a pipeline.StagePipeline runs the encoder of the next frame while the head decodes this one
+        self.pipeline = None
+        # a util.upsample.GuidedUpsampler brings the depth to the frame resolution along the frame edges, bilinear if None
+        self.upsampler = None
+        self.static_reuse = None
+        self.reuse_state = None
         self.transform = None
         self.frame_id_list = []
         self.frame_cache_list = []
@@ -59,60 +73,203 @@ class VideoDepthAnything(nn.Module):
         assert self.gap == 41
         self.id = -1
 
+    def init_transform(self, frame_height, frame_width, input_size, size_bucket=None):
+        self.frame_height = frame_height
+        self.frame_width = frame_width
+        self.input_size = input_size
+        self.input_size_bucket = size_bucket
+        self.transform = Compose([
+            Resize(
+                width=input_size,
+                height=input_size,
+                resize_target=False,
+                keep_aspect_ratio=True,
+                ensure_multiple_of=14,
+                resize_method='lower_bound',
+                image_interpolation_method=cv2.INTER_CUBIC,
+                bucket=size_bucket,
+            ),
+            NormalizeImage(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]) if self.normalize_input else (lambda sample: sample),
+            PrepareForNet(),
+        ])
+
+    def reset_session(self):
+        self.transform = None
+        self.frame_id_list = []
+        self.frame_cache_list = []
+        self.id = -1
+        self.reuse_state = None
+
+    def set_static_reuse(self, refresh_interval, diff_threshold=8, halo=1):
+        """Approximate mode for static cameras: re-encode only the patches that changed.
+
+        A patch is changed if any pixel of the frame, resized to the input size, differs by more
+        than `diff_threshold` (uint8 levels) from when the patch was last encoded. Changed patches,
+        dilated by `halo` patches, are re-encoded and attend to the keys and values the other
+        tokens had when they were last encoded, whose outputs are reused as they are. Every
+        `refresh_interval` frames the whole frame is encoded again; 0 turns the mode off. It cannot
+        be combined with token merging.
+        """
+        if refresh_interval > 0 and self.pretrained.token_merging:
+            raise ValueError("static reuse cannot be combined with token merging, turn token merging off first")
+        self.pretrained.token_reuse = refresh_interval > 0
+        self.static_reuse = {'refresh_interval': refresh_interval, 'diff_threshold': diff_threshold, 'halo': halo} if refresh_interval > 0 else None
+        self.reuse_state = None
+
+    def export_session(self):
+        """Return the streaming state as a dict of CPU tensors and plain values.
+
+        Cache entries that are shared (the first frame is repeated to fill the window) are stored
+        once, and every hidden state is stacked over the unique entries.
+        """
+        if self.transform is None:
+            return {'encoder': self.encoder, 'id': self.id}
+
+        unique_entries, entry_index = [], []
+        for entry in self.frame_cache_list:
+            for i, unique_entry in enumerate(unique_entries):
+                if unique_entry is entry:
+                    entry_index.append(i)
+                    break
+            else:
+                entry_index.append(len(unique_entries))
+                unique_entries.append(entry)
+        hidden_states = [torch.cat([entry[i] for entry in unique_entries], dim=1).cpu() for i in range(len(unique_entries[0]))]
+
+        return {
+            'encoder': self.encoder,
+            'id': self.id,
+            'frame_height': self.frame_height,
+            'frame_width': self.frame_width,
+            'input_size': self.input_size,
+            'size_bucket': self.input_size_bucket,
+            'frame_id_list': list(self.frame_id_list),
+            'cache_index': entry_index,
+            'cache_hidden_states': hidden_states,
+        }
+
+    def import_session(self, session, device='cuda'):
+        assert session['encoder'] == self.encoder, f"session was recorded with {session['encoder']}, model is {self.encoder}"
+        self.reset_session()
+        self.id = session['id']
+        if 'cache_hidden_states' not in session:
+            return
+
+        # the cached hidden states only fit the input size the session was recorded with
+        self.init_transform(session['frame_height'], session['frame_width'], session['input_size'], session.get('size_bucket'))
+        self.frame_id_list = list(session['frame_id_list'])
+        hidden_states = [h.to(device) for h in session['cache_hidden_states']]
+        unique_entries = [[h[:, i:i+1].contiguous() for h in hidden_states] for i in range(hidden_states[0].shape[1])]
+        self.frame_cache_list = [unique_entries[i] for i in session['cache_index']]
+
+    def save_session(self, path):
+        """Snapshot the streaming state so that another process can resume the stream without a cold start."""
+        torch.save(self.export_session(), path)
+
+    def load_session(self, path, device='cuda'):
+        self.import_session(torch.load(path, map_location='cpu'), device=device)
+
     def forward(self, x):
         return self.forward_depth(self.forward_features(x), x.shape)[0]
     
     def forward_features(self, x):
-        features = self.pretrained.get_intermediate_layers(x.flatten(0,1), self.intermediate_layer_idx[self.encoder], return_class_token=True)
+        features = self.pretrained.get_intermediate_layers(x.flatten(0,1), self.intermediate_layer_idx[self.encoder], return_class_token=True,
+                                                           micro_batch_size=self.micro_batch_plan(x.shape, x.device).get('encoder'))
         return features
 
-    def forward_depth(self, features, x_shape, cached_hidden_state_list=None):
+    def micro_batch_plan(self, x_shape, device):
+        """Micro-batch sizes of the encoder and head stages for an input of `x_shape`, picked to fit `memory_budget` bytes if it is set."""
+        if self.memory_budget is None:
+            return {'output': 4}
+        B, T, C, H, W = x_shape
+        return micro_batch_sizes(self, H, W, B * T, self.memory_budget, autocast_bytes(device))
+
+    def forward_features_reuse(self, x, frame):
+        """`forward_features` of one frame in the static reuse mode, see `set_static_reuse`."""
+        H, W = x.shape[-2:]
+        patch_h, patch_w = H // 14, W // 14
+        image = cv2.resize(frame, (W, H), interpolation=cv2.INTER_AREA)
+        state = self.reuse_state
+        if state is None or state['reference'].shape != image.shape or state['since_refresh'] + 1 >= self.static_reuse['refresh_interval']:
+            state = self.reuse_state = {'reference': image, 'cache': {}, 'since_refresh': 0, 'recomputed': 1.0}
+            rows = None
+        else:
+            diff = cv2.absdiff(image, state['reference']).max(axis=-1) > self.static_reuse['diff_threshold']
+            changed = diff.reshape(patch_h, 14, patch_w, 14).any(axis=(1, 3)).astype(np.uint8)
+            halo = self.static_reuse['halo']
+            if halo > 0:
+                changed = cv2.dilate(changed, np.ones((2 * halo + 1, 2 * halo + 1), np.uint8))
+            changed = changed.astype(bool)
+            # the reference keeps the pixels every patch was encoded from, so a slow drift is
+            # caught as soon as it adds up to the threshold
+            pixel_mask = changed.repeat(14, axis=0).repeat(14, axis=1)
+            state['reference'][pixel_mask] = image[pixel_mask]
+            num_prefix_tokens = 1 + self.pretrained.num_register_tokens
+            rows = np.concatenate([np.arange(num_prefix_tokens), num_prefix_tokens + np.flatnonzero(changed)])
+            rows = torch.from_numpy(rows).to(x.device)
+            state['since_refresh'] += 1
+            state['recomputed'] = float(changed.mean())
+        return self.pretrained.get_intermediate_layers(x.flatten(0,1), self.intermediate_layer_idx[self.encoder], return_class_token=True,
+                                                       reuse_cache=state['cache'], reuse_rows=rows)
+
+    def forward_depth(self, features, x_shape, cached_hidden_state_list=None, attention_mask=None, position_ids=None):
         B, T, C, H, W = x_shape
         patch_h, patch_w = H // 14, W // 14
-        depth, cur_cached_hidden_state_list = self.head(features, patch_h, patch_w, T, cached_hidden_state_list=cached_hidden_state_list)
+        micro_batch_size = self.micro_batch_plan(x_shape, features[0][0].device)
+        depth, cur_cached_hidden_state_list = self.head(features, patch_h, patch_w, T, micro_batch_size=micro_batch_size, cached_hidden_state_list=cached_hidden_state_list,
+                                                        attention_mask=attention_mask, position_ids=position_ids)
         depth = F.interpolate(depth, size=(H, W), mode="bilinear", align_corners=True)
         depth = F.relu(depth)
         return depth.squeeze(1).unflatten(0, (B, T)), cur_cached_hidden_state_list # return shape [B, T, H, W]
     
-    def infer_video_depth_one(self, frame, input_size=518, device='cuda', fp32=False):
-        self.id += 1
+    def infer_video_depth_one(self, frame, input_size=518, device='cuda', fp32=False, precision=None):
+        precision = resolve_precision(device, precision, fp32)
+        return self.decode_frame(self.encode_frame(frame, input_size, device, precision), device, precision)
+
+    def infer_video_depth_frames(self, frames, input_size=518, device='cuda', fp32=False, precision=None):
+        """`infer_video_depth_one` of every frame of `frames`, yielding the depth of every frame in order.
+
+        With a `pipeline.StagePipeline` as `self.pipeline`, the encoder already runs on the next
+        frame while the head decodes the current one.
+        """
+        precision = resolve_precision(device, precision, fp32)
+        yield from run_stages(self.pipeline, frames, lambda frame: self.encode_frame(frame, input_size, device, precision),
+                              lambda frame, encoded: self.decode_frame(encoded, device, precision))
 
+    def encode_frame(self, frame, input_size, device, precision):
+        """The encoder half of `infer_video_depth_one`, returns the input shape, the features of `frame` and `frame` itself for the upsampler."""
         if self.transform is None:  # first frame
             # Initialize the transform
             frame_height, frame_width = frame.shape[:2]
-            self.frame_height = frame_height
-            self.frame_width = frame_width
             ratio = max(frame_height, frame_width) / min(frame_height, frame_width)
             if ratio > 1.78:  # we recommend to process video with ratio smaller than 16:9 due to memory limitation
                 input_size = int(input_size * 1.777 / ratio)
                 input_size = round(input_size / 14) * 14
+            self.init_transform(frame_height, frame_width, input_size, self.size_bucket)
+        else:
+            frame_height, frame_width = frame.shape[:2]
+            assert frame_height == self.frame_height
+            assert frame_width == self.frame_width
+
+        # infer feature
+        cur_input = torch.from_numpy(self.transform({'image': frame.astype(np.float32) / 255.0})['image']).unsqueeze(0).unsqueeze(0).to(device)
+        with torch.no_grad():
+            with autocast(device, precision):
+                cur_feature = self.forward_features(cur_input) if self.static_reuse is None else self.forward_features_reuse(cur_input, frame)
+        return cur_input.shape, cur_feature, frame
+
+    def decode_frame(self, encoded, device, precision):
+        """The head half of `infer_video_depth_one`, steps the sliding window and returns the depth of the frame `encoded` is from."""
+        x_shape, cur_feature, frame = encoded
+        self.id += 1
 
-            self.transform = Compose([
-                Resize(
-                    width=input_size,
-                    height=input_size,
-                    resize_target=False,
-                    keep_aspect_ratio=True,
-                    ensure_multiple_of=14,
-                    resize_method='lower_bound',
-                    image_interpolation_method=cv2.INTER_CUBIC,
-                ),
-                NormalizeImage(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-                PrepareForNet(),
-            ])
-
-            # Inference the first frame
-            cur_list = [torch.from_numpy(self.transform({'image': frame.astype(np.float32) / 255.0})['image']).unsqueeze(0).unsqueeze(0)]
-            cur_input = torch.cat(cur_list, dim=1).to(device)
-            
+        if not self.frame_cache_list:  # first frame
             with torch.no_grad():
-                with torch.autocast(device_type=device, enabled=(not fp32)):
-                    cur_feature = self.forward_features(cur_input)
-                    x_shape = cur_input.shape
+                with autocast(device, precision):
                     depth, cached_hidden_state_list = self.forward_depth(cur_feature, x_shape)
 
-            depth = depth.to(cur_input.dtype)
-            depth = F.interpolate(depth.flatten(0,1).unsqueeze(1), size=(frame_height, frame_width), mode='bilinear', align_corners=True)
+            depth = depth.float()
+            depth = upsample_depth(depth.flatten(0,1).unsqueeze(1), (self.frame_height, self.frame_width), [frame], self.upsampler)
 
             # Copy multiple cache to simulate the windows
             self.frame_cache_list = [cached_hidden_state_list] * INFER_LEN
@@ -120,17 +277,6 @@ class VideoDepthAnything(nn.Module):
 
             new_depth = depth[0][0].cpu().numpy()
         else:
-            frame_height, frame_width = frame.shape[:2]
-            assert frame_height == self.frame_height
-            assert frame_width == self.frame_width
-
-            # infer feature
-            cur_input = torch.from_numpy(self.transform({'image': frame.astype(np.float32) / 255.0})['image']).unsqueeze(0).unsqueeze(0).to(device)
-            with torch.no_grad():
-                with torch.autocast(device_type=device, enabled=(not fp32)):
-                    cur_feature = self.forward_features(cur_input)
-                    x_shape = cur_input.shape
-
             cur_list = self.frame_cache_list[0:2] + self.frame_cache_list[-INFER_LEN+3:]
             '''
             cur_id = self.frame_id_list[0:2] + self.frame_id_list[-INFER_LEN+3:]
@@ -141,11 +287,11 @@ class VideoDepthAnything(nn.Module):
 
             # infer depth
             with torch.no_grad():
-                with torch.autocast(device_type=device, enabled=(not fp32)):
+                with autocast(device, precision):
                     depth, new_cache = self.forward_depth(cur_feature, x_shape, cached_hidden_state_list=cur_cache)
 
-            depth = depth.to(cur_input.dtype)
-            depth = F.interpolate(depth.flatten(0,1).unsqueeze(1), size=(frame_height, frame_width), mode='bilinear', align_corners=True)
+            depth = depth.float()
+            depth = upsample_depth(depth.flatten(0,1).unsqueeze(1), (self.frame_height, self.frame_width), [frame], self.upsampler)
             depth_list = [depth[i][0].cpu().numpy() for i in range(depth.shape[0])]
 
             new_depth = depth_list[-1]
@@ -159,3 +305,79 @@ class VideoDepthAnything(nn.Module):
             del self.frame_cache_list[1]
 
         return new_depth
+
+    def infer_video_depth_catchup(self, frames, input_size=518, device='cuda', fp32=False, precision=None):
+        """Infer several pending frames in one streaming step.
+
+        The frames are encoded as one batch and the temporal head runs over all of them at once,
+        each frame attending only to the cached frames and earlier pending frames that sequential
+        `infer_video_depth_one` calls would have put in its window. The cache is updated as if the
+        frames had been stepped one by one. The depth matches sequential stepping in fp32 and bf16,
+        but not exactly for a model quantized with 'int8-dynamic', whose activation scales are
+        computed over the whole batch (around 1e-2 relative difference).
+
+        Returns:
+            list of depth maps, one per frame
+        """
+        precision = resolve_precision(device, precision, fp32)
+        frames = list(frames)
+        depth_list = []
+        if self.transform is None:
+            depth_list.append(self.infer_video_depth_one(frames[0], input_size=input_size, device=device, precision=precision))
+            frames = frames[1:]
+        if len(frames) == 0:
+            return depth_list
+        if len(frames) == 1:
+            return depth_list + [self.infer_video_depth_one(frames[0], input_size=input_size, device=device, precision=precision)]
+
+        for frame in frames:
+            assert frame.shape[0] == self.frame_height
+            assert frame.shape[1] == self.frame_width
+
+        # replay the sliding window policy to find the window of every pending frame,
+        # entries are ('cache', index into frame_cache_list) or ('new', index into frames)
+        num_frames = len(frames)
+        entry_list = [('cache', i) for i in range(len(self.frame_cache_list))]
+        windows = []
+        cur_id = self.id
+        for i in range(num_frames):
+            cur_id += 1
+            windows.append(entry_list[0:2] + entry_list[-INFER_LEN+3:] + [('new', i)])
+            entry_list.append(('new', i))
+            if cur_id + INFER_LEN > self.gap + 1:
+                del entry_list[1]
+
+        cache_ids = sorted(set(idx for window in windows for kind, idx in window if kind == 'cache'))
+        columns = {('cache', idx): col for col, idx in enumerate(cache_ids)}
+        columns.update({('new', i): len(cache_ids) + i for i in range(num_frames)})
+        attention_mask = torch.zeros(num_frames, len(columns), dtype=torch.bool)
+        position_ids = torch.zeros(num_frames, len(columns), dtype=torch.long)
+        for i, window in enumerate(windows):
+            assert len(window) == INFER_LEN
+            for pos, entry in enumerate(window):
+                attention_mask[i, columns[entry]] = True
+                position_ids[i, columns[entry]] = pos
+
+        cur_cache = [torch.cat([self.frame_cache_list[idx][i] for idx in cache_ids], dim=1) for i in range(len(self.frame_cache_list[0]))]
+        cur_input = torch.cat([torch.from_numpy(self.transform({'image': frame.astype(np.float32) / 255.0})['image']).unsqueeze(0) for frame in frames]).unsqueeze(0).to(device)
+
+        with torch.no_grad():
+            with autocast(device, precision):
+                cur_feature = self.forward_features(cur_input)
+                depth, new_cache = self.forward_depth(cur_feature, cur_input.shape, cached_hidden_state_list=cur_cache,
+                                                      attention_mask=attention_mask.to(device), position_ids=position_ids.to(device))
+
+        depth = depth.to(cur_input.dtype)
+        depth = upsample_depth(depth.flatten(0,1).unsqueeze(1), (self.frame_height, self.frame_width), frames, self.upsampler)
+        depth_list += [depth[i][0].cpu().numpy() for i in range(depth.shape[0])]
+
+        # adjust the sliding window as the sequential steps would have
+        for i in range(num_frames):
+            self.id += 1
+            self.frame_cache_list.append([h[:, i:i+1].contiguous() for h in new_cache])
+            self.frame_id_list.append(self.id)
+            if self.id + INFER_LEN > self.gap + 1:
+                del self.frame_id_list[1]
+                del self.frame_cache_list[1]
+
+        return depth_list
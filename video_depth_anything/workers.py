@@ -0,0 +1,197 @@
+# Copyright (2025) Bytedance Ltd. and/or its affiliates
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import contextlib
+import multiprocessing
+import os
+import time
+
+import cv2
+import torch
+
+from .util.precision import autocast, resolve_precision
+
+
+@contextlib.contextmanager
+def single_threaded():
+    """Run the operators inside the context on one intra-op thread.
+
+    GNU OpenMP does not survive a fork: a forked process that runs a parallel region after its
+    parent did with several threads hangs. A parent that forks workers has to run everything
+    before the fork in here.
+    """
+    num_threads = torch.get_num_threads()
+    torch.set_num_threads(1)
+    try:
+        yield
+    finally:
+        torch.set_num_threads(num_threads)
+
+
+def share_weights(model):
+    """Move the parameters and buffers of `model` to shared memory, in place, and return it.
+
+    Processes forked afterwards map the same pages with MAP_SHARED, so neither reading nor
+    writing them copies anything, whether the weights came from the memory-mapped checkpoint or
+    were rebuilt by optimize or quantize. The packed weights of dynamically quantized Linear
+    layers are not tensors of the module and stay in the heap of the parent, which forked
+    workers share as long as nothing writes to it.
+
+    The parameters also stop requiring grad: autocast keeps the low-precision copy of every
+    parameter that requires grad until the autocast context exits, which would be a private
+    copy of the weights in every worker.
+    """
+    return model.requires_grad_(False).share_memory()
+
+
+def core_groups(cores=None):
+    """`cores` (by default the cores this process may run on) grouped by physical core, SMT siblings together, in the order of their package and core id."""
+    cores = sorted(os.sched_getaffinity(0)) if cores is None else sorted(cores)
+    groups = {}
+    for core in cores:
+        key = []
+        for name in ('physical_package_id', 'core_id'):
+            path = f'/sys/devices/system/cpu/cpu{core}/topology/{name}'
+            key.append(int(open(path).read()) if os.path.exists(path) else core)
+        groups.setdefault(tuple(key), []).append(core)
+    return [groups[key] for key in sorted(groups)]
+
+
+def split_cores(num_workers, cores=None):
+    """Split `cores` (by default the cores this process may run on) into `num_workers` disjoint slices.
+
+    Whole physical cores are handed out in topology order, so that SMT siblings, which share
+    the execution units, go to the same worker and a worker stays within a package where it
+    can. With fewer physical cores than workers the logical cores are split instead, and with
+    fewer logical cores than workers they are shared.
+    """
+    groups = core_groups(cores)
+    if len(groups) < num_workers:
+        groups = [[core] for group in groups for core in group]
+    if len(groups) < num_workers:
+        return [groups[i % len(groups)] for i in range(num_workers)]
+    size, extra = divmod(len(groups), num_workers)
+    slices, start = [], 0
+    for i in range(num_workers):
+        end = start + size + (i < extra)
+        slices.append([core for group in groups[start:end] for core in group])
+        start = end
+    return slices
+
+
+def configure_threads(cores=None, threads=None, interop_threads=1, opencv_threads=1):
+    """Pin this process to `cores` and size the thread pools of torch and OpenCV to them; returns (cores, threads).
+
+    All threads of the process are pinned and threads started later inherit the affinity.
+    `threads` intra-op threads default to one per physical core. The inter-op pool only runs
+    independent operators, which inference does not have, and its size can only be set once;
+    OpenCV's own pool (decoding, resizing) would compete with the intra-op threads for the same
+    cores.
+    """
+    if cores is not None:
+        for thread in os.listdir('/proc/self/task'):
+            try:
+                os.sched_setaffinity(int(thread), cores)
+            except ProcessLookupError:
+                # exited meanwhile
+                pass
+    cores = sorted(os.sched_getaffinity(0))
+    threads = threads or len(core_groups(cores))
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(interop_threads)
+    except RuntimeError:
+        # already set, or the pool is running
+        pass
+    cv2.setNumThreads(opencv_threads)
+    return cores, threads
+
+
+def _run_worker(cores, threads, rank, target, args):
+    configure_threads(cores, threads)
+    target(rank, *args)
+
+
+def fork_workers(num_workers, target, args=(), cores=None, threads=None):
+    """Fork and start `num_workers` processes running `target(rank, *args)`, each pinned to its slice of `cores` (see `split_cores`) with `threads` intra-op threads (see `configure_threads`).
+
+    A model passed in `args` is inherited by the workers rather than pickled. Load it with
+    `load_model(..., share_memory=True)`, or at least inside `single_threaded`, so that the
+    workers share its weights and can run their own thread pools.
+    """
+    context = multiprocessing.get_context('fork')
+    workers = []
+    for rank, worker_cores in enumerate(split_cores(num_workers, cores)):
+        worker = context.Process(target=_run_worker, args=(worker_cores, threads, rank, target, args), name=f'worker{rank}')
+        worker.start()
+        workers.append(worker)
+    return workers
+
+
+def time_synthetic_window(model, input_size=518, num_frames=8, precision=None, ready=None):
+    """Frames per second of `model` on CPU on random frames of `input_size` x `input_size`, after a warm-up run.
+
+    The offline model runs one window of `num_frames` frames, the streaming model `num_frames`
+    single frames. With `ready`, a barrier, the timing starts once all parties are warmed up.
+    """
+    precision = resolve_precision('cpu', precision)
+    streaming = hasattr(model, 'forward_depth')
+    x = torch.randn(1, 1 if streaming else num_frames, 3, input_size, input_size)
+    with torch.no_grad(), autocast('cpu', precision):
+        model(x)
+        if ready is not None:
+            ready.wait()
+        start = time.perf_counter()
+        for _ in range(num_frames if streaming else 1):
+            model(x)
+    return num_frames / (time.perf_counter() - start)
+
+
+def candidate_splits(workers=None, cores=None):
+    """(workers, intra-op threads per worker) pairs to time: one thread per physical core of a slice and one per logical core, for `workers` or else 1, 2, 4, ... workers up to one per physical core."""
+    groups = core_groups(cores)
+    logical = sum(len(group) for group in groups)
+    counts = [workers] if workers else [2 ** i for i in range(len(groups).bit_length()) if 2 ** i <= len(groups)]
+    return [(count, threads) for count in counts for threads in sorted({max(len(groups) // count, 1), max(logical // count, 1)})]
+
+
+def _time_worker(rank, model, input_size, num_frames, precision, ready, results):
+    results.put(time_synthetic_window(model, input_size, num_frames, precision, ready))
+
+
+def autotune_threads(model, input_size=518, num_frames=8, precision=None, workers=1, cores=None):
+    """Time a synthetic window with every split of `candidate_splits` and return the (workers, threads, fps) of each, fastest first.
+
+    With one worker the splits are timed in this process. Otherwise the workers of a split run
+    at once, forked on their slices of `cores` like `fork_workers` does, and their frames per
+    second add up; the model has to be safe to fork (see `fork_workers`), and `workers=None`
+    also tries the number of workers.
+    """
+    results = []
+    for count, threads in candidate_splits(workers, cores):
+        if workers == 1:
+            num_threads = torch.get_num_threads()
+            torch.set_num_threads(threads)
+            try:
+                fps = time_synthetic_window(model, input_size, num_frames, precision)
+            finally:
+                torch.set_num_threads(num_threads)
+        else:
+            context = multiprocessing.get_context('fork')
+            ready, queue = context.Barrier(count), context.Queue()
+            processes = fork_workers(count, _time_worker, args=(model, input_size, num_frames, precision, ready, queue), cores=cores, threads=threads)
+            fps = sum(queue.get() for _ in processes)
+            for process in processes:
+                process.join()
+        results.append((count, threads, fps))
+    return sorted(results, key=lambda result: -result[2])